@@ -1,24 +1,33 @@
+import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 import models
-from database import get_db
+from database import get_db, get_async_db
+from services import password_service
 
 SECRET_KEY = "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_service.verify_password(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_service.hash_password(password)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -27,31 +36,144 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+class Principal:
+    """
+    Detached snapshot of the authenticated user. Exposes the same attributes
+    endpoints read from models.User, so it can be returned as a UserResponse.
+    """
+    __slots__ = (
+        "id", "email", "username", "role", "is_active", "permissions",
+        "referral_code", "referred_by_id", "created_by",
+    )
+
+    def __init__(self, user: models.User):
+        for name in self.__slots__:
+            value = getattr(user, name)
+            setattr(self, name, dict(value) if name == "permissions" and value else value)
+
+class PrincipalCache:
+    """
+    In-process TTL + LRU cache of principals keyed by user id.
+    Role changes, deactivation and permission edits must call invalidate()
+    after their commit. Every invalidation bumps `generation`; a loader reads
+    it before querying the user and passes it to put(), which drops the entry
+    if an invalidation happened in between, so a row read before the commit
+    is never cached after it.
+    """
+    def __init__(self, ttl: float = PRINCIPAL_CACHE_TTL, maxsize: int = PRINCIPAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            principal, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return principal
+
+    def put(self, principal: Principal, generation: int):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[principal.id] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(principal.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+principal_cache = PrincipalCache()
+
+def create_user_token(user: models.User):
+    # "uid" lets get_current_user resolve the principal by primary key
+    return create_access_token(data={"sub": user.email, "uid": user.id})
+
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode_token(token: str):
+    """(email, user_id) of a valid token; user_id is None for old tokens."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
+        user_id: Optional[int] = payload.get("uid")
         if email is None:
-            raise credentials_exception
+            raise _credentials_exception()
     except JWTError:
-        raise credentials_exception
-    
-    user = db.query(models.User).filter(models.User.email == email).first()
-    if user is None:
-        raise credentials_exception
-    return user
+        raise _credentials_exception()
+    return email, user_id
+
+def _user_statement(email: str, user_id: Optional[int]):
+    if user_id is not None:
+        return select(models.User).where(models.User.id == user_id)
+    # Tokens issued before "uid" was added
+    return select(models.User).where(models.User.email == email)
+
+def _principal_for(user: Optional[models.User], email: str, generation: int) -> Principal:
+    if user is None or user.email != email:
+        raise _credentials_exception()
+    principal = Principal(user)
+    principal_cache.put(principal, generation)
+    return principal
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    email, user_id = _decode_token(token)
+    principal = principal_cache.get(user_id) if user_id is not None else None
+    if principal is None:
+        generation = principal_cache.generation
+        user = db.scalars(_user_statement(email, user_id)).first()
+        principal = _principal_for(user, email, generation)
+    return principal
+
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    """
+    get_current_user for async endpoints: a cache miss loads the user on the
+    request's AsyncSession instead of checking out a sync pool connection.
+    """
+    email, user_id = _decode_token(token)
+    principal = principal_cache.get(user_id) if user_id is not None else None
+    if principal is None:
+        generation = principal_cache.generation
+        user = (await db.scalars(_user_statement(email, user_id))).first()
+        principal = _principal_for(user, email, generation)
+    return principal
+
+def _role_checker(allowed_roles: list, current_user: Principal):
+    if current_user.role not in allowed_roles:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    return current_user
 
 def require_role(allowed_roles: list):
-    def role_checker(current_user: models.User = Depends(get_current_user)):
-        if current_user.role not in allowed_roles:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not enough permissions"
-            )
-        return current_user
+    def role_checker(current_user: Principal = Depends(get_current_user)):
+        return _role_checker(allowed_roles, current_user)
+    return role_checker
+
+def require_role_async(allowed_roles: list):
+    async def role_checker(current_user: Principal = Depends(get_current_user_async)):
+        return _role_checker(allowed_roles, current_user)
     return role_checker
@@ -0,0 +1,17 @@
+from database import SessionLocal, engine
+import models
+from services.referral_service import ReferralService
+
+def backfill_closure():
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        print("🚀 Rebuilding referral closure index...")
+        rows = ReferralService.rebuild_closure(db)
+        users = db.query(models.User).count()
+        print(f"✅ Indexed {users} users ({rows} closure rows).")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    backfill_closure()
@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# Generates a synthetic referral forest in a throwaway database, then times the
+# referral service and the auth/referral endpoints against it. Results can be
+# saved as a baseline and later runs compared against it:
+#
+#   python benchmark.py --shape powerlaw -n 100000 --save bench_baseline.json
+#   python benchmark.py --shape powerlaw -n 100000 --compare bench_baseline.json
+
+SHAPES = ("chain", "star", "powerlaw")
+PASSWORD = "password123"
+
+
+def generate_forest(shape, nodes, seed=0):
+    """
+    Parent index for every node (None for roots). Parents always come first.
+
+    chain:    one line, node i refers node i - 1
+    star:     a single root referring everyone else
+    powerlaw: preferential attachment, so a few users have huge fan-out and
+              most have none (roughly what real referral networks look like)
+    """
+    rng = random.Random(seed)
+    if shape == "chain":
+        return [None] + list(range(nodes - 1))
+    if shape == "star":
+        return [None] + [0] * (nodes - 1)
+    if shape == "powerlaw":
+        parents = [None]
+        # Every node appears once per referral it made, plus once for itself
+        tickets = [0]
+        for i in range(1, nodes):
+            parent = tickets[rng.randrange(len(tickets))]
+            parents.append(parent)
+            tickets.append(parent)
+            tickets.append(i)
+        return parents
+    raise ValueError(f"Unknown shape: {shape}")
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_benchmarks(shape, nodes, repeat, seed):
+    from fastapi.testclient import TestClient
+    from sqlalchemy import event, insert, select, update
+    import main, models, auth
+    from database import SessionLocal, engine, async_engine
+    from services.referral_service import ReferralService, MAX_LEVELS
+    from services.bulk_import import BulkImportService, _chunks
+    from services.counter_service import CounterService
+    from services.referral_codes import ReferralCodeAllocator
+    from services.stats_worker import stats_worker
+    from services.graph_index import graph_index, GRAPH_INDEX_ENABLED
+
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    for bind in (engine, async_engine.sync_engine):
+        event.listen(bind, "before_cursor_execute", count_query)
+
+    # 1. Build the forest with bulk statements, the same way the importer does
+    rng = random.Random(seed)
+    parents = generate_forest(shape, nodes, seed)
+    print(f"🚀 Building {shape} forest with {nodes} users...")
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        hashed = auth.get_password_hash(PASSWORD)
+        codes = ReferralCodeAllocator.allocate(db, nodes)
+        ids = []
+        for batch in _chunks(list(range(nodes)), 5000):
+            values = [{
+                "email": f"bench{i}@example.com",
+                "username": f"bench_{i}",
+                "hashed_password": hashed,
+                "role": "user",
+                "is_active": True,
+                "permissions": {},
+                "referral_code": codes[i],
+            } for i in batch]
+            ids.extend(uid for (uid,) in db.execute(insert(models.User).returning(models.User.id), values))
+        # Parents may sit in the same insert batch, so link them once all ids are known
+        links = [{"id": ids[i], "referred_by_id": ids[p]} for i, p in enumerate(parents) if p is not None]
+        for batch in _chunks(links, 5000):
+            db.execute(update(models.User), batch)
+        db.commit()
+        closure_rows = ReferralService.rebuild_closure(db)
+        BulkImportService.write_stats(db, ids, 5000)
+        db.commit()
+        CounterService.reconcile(db)
+        if GRAPH_INDEX_ENABLED:
+            graph_index.load(db, MAX_LEVELS)
+    finally:
+        db.close()
+    print(f"✅ Built in {time.perf_counter() - started:.1f}s ({closure_rows} closure rows)")
+
+    root_id = ids[0]
+    results = {}
+
+    def record(name, samples, counts):
+        results[name] = r = {
+            "samples": len(samples),
+            "p50_ms": percentile(samples, 50),
+            "p95_ms": percentile(samples, 95),
+            "p99_ms": percentile(samples, 99),
+            "mean_ms": statistics.fmean(samples),
+            "queries": statistics.fmean(counts),
+        }
+        print(f"  {name:<40} p50 {r['p50_ms']:9.2f}ms  p95 {r['p95_ms']:9.2f}ms  "
+              f"p99 {r['p99_ms']:9.2f}ms  {r['queries']:6.1f} queries")
+
+    def measure(name, fn, args_list):
+        samples, counts = [], []
+        for args in args_list:
+            before = queries[0]
+            started = time.perf_counter()
+            fn(*args)
+            samples.append((time.perf_counter() - started) * 1000)
+            counts.append(queries[0] - before)
+        record(name, samples, counts)
+
+    def random_ids():
+        return [(rng.choice(ids),) for _ in range(repeat)]
+
+    print("⏱️  Service")
+    db = SessionLocal()
+    try:
+        measure("get_referral_tree[root,depth=3]",
+                lambda uid: ReferralService.get_referral_tree(db, uid, max_depth=3), [(root_id,)] * repeat)
+        measure("get_referral_tree[random,depth=20]",
+                lambda uid: ReferralService.get_referral_tree(db, uid, max_depth=20), random_ids())
+        measure("update_stats[random]",
+                lambda uid: ReferralService.update_stats(db, uid), random_ids())
+
+        created = iter(range(10 ** 9))
+
+        def add_and_propagate(parent_id, incremental):
+            i = next(created)
+            user = models.User(
+                email=f"bench_new{i}@example.com",
+                username=f"bench_new_{i}",
+                hashed_password=hashed,
+                role="user",
+                is_active=True,
+                permissions={},
+                referral_code=ReferralCodeAllocator.allocate(db)[0],
+                referred_by_id=parent_id,
+            )
+            db.add(user)
+            db.flush()
+            ReferralService.index_user(db, user.id, parent_id)
+            db.add(models.ReferralStat(user_id=user.id, total_directs=0, total_team_size=0))
+            db.commit()
+            before = queries[0]
+            started = time.perf_counter()
+            ReferralService.propagate_stats_update(db, user.id, incremental=incremental)
+            db.commit()
+            return (time.perf_counter() - started) * 1000, queries[0] - before
+
+        # Time only the propagation, not the user set-up around it
+        for incremental in (True, False):
+            runs = [add_and_propagate(rng.choice(ids), incremental) for _ in range(repeat)]
+            record("propagate_stats_update[%s]" % ("incremental" if incremental else "full"),
+                   [ms for ms, _ in runs], [count for _, count in runs])
+        user_of = {u.id: u for u in db.scalars(select(models.User).where(models.User.id.in_(ids[:1000])))}
+    finally:
+        db.close()
+
+    print("⏱️  Endpoints")
+    with TestClient(main.app) as client:
+        counter = iter(range(10 ** 9))
+
+        def register(code):
+            i = next(counter)
+            response = client.post("/api/auth/register", json={
+                "email": f"bench_reg{i}@example.com",
+                "username": f"bench_reg_{i}",
+                "password": PASSWORD,
+                "referral_code": code,
+            })
+            assert response.status_code == 200, response.text
+
+        def login(index):
+            response = client.post("/api/auth/login", json={"email": f"bench{index}@example.com", "password": PASSWORD})
+            assert response.status_code == 200, response.text
+
+        def get(path, uid):
+            token = auth.create_user_token(user_of[uid])
+            response = client.get(path, headers={"Authorization": f"Bearer {token}"})
+            assert response.status_code == 200, response.text
+
+        sample_users = [(rng.choice(list(user_of)),) for _ in range(repeat)]
+        measure("POST /api/auth/register", register, [(rng.choice(codes),) for _ in range(repeat)])
+        measure("POST /api/auth/login", login, [(rng.randrange(nodes),) for _ in range(repeat)])
+        measure("GET /api/referral/tree[root]",
+                lambda uid: get("/api/referral/tree", uid), [(root_id,)] * repeat)
+        measure("GET /api/referral/tree[random]",
+                lambda uid: get("/api/referral/tree", uid), sample_users)
+        measure("GET /api/referral/stats[random]",
+                lambda uid: get("/api/referral/stats", uid), sample_users)
+        measure("GET /api/referral/children[root]",
+                lambda uid: get(f"/api/referral/children?parent_id={uid}", uid), [(root_id,)] * repeat)
+        stats_worker.drain()
+
+    return results
+
+
+def compare(results, baseline, tolerance, floor_ms):
+    """
+    Regressions against a saved baseline: p95 slower by more than `tolerance`
+    (and by more than `floor_ms`, to ignore timer noise) or more queries.
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        slower = current["p95_ms"] - previous["p95_ms"]
+        if slower > floor_ms and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']:.2f}ms -> {current['p95_ms']:.2f}ms")
+        # Endpoint query counts include the stats worker's, so allow some slack
+        if current["queries"] > previous["queries"] * (1 + tolerance) + 0.5:
+            regressions.append(f"{name}: queries {previous['queries']:.1f} -> {current['queries']:.1f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the referral tree code on a synthetic network.")
+    parser.add_argument("--shape", choices=SHAPES, default="powerlaw")
+    parser.add_argument("-n", "--nodes", type=int, default=1000, help="users in the generated forest")
+    parser.add_argument("-r", "--repeat", type=int, default=50, help="samples per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=["inline", "deferred"], default="deferred", help="stats propagation on register")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4,
+                        help="bcrypt cost; the default keeps login/register timings about the database")
+    parser.add_argument("--graph-index", action="store_true", help="serve reads from the in-memory graph index")
+    parser.add_argument("--save", metavar="PATH", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="fail if slower than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed p95 slowdown, as a fraction")
+    parser.add_argument("--floor-ms", type=float, default=1.0, help="ignore p95 differences below this")
+    args = parser.parse_args()
+
+    # Configure before the app is imported: a fresh database in a temp dir
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["STATS_PROPAGATION"] = args.mode
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ["GRAPH_INDEX_ENABLED"] = "true" if args.graph_index else "false"
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    save_path = os.path.abspath(args.save) if args.save else None
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    results = run_benchmarks(args.shape, args.nodes, args.repeat, args.seed)
+    config = {"shape": args.shape, "nodes": args.nodes, "repeat": args.repeat,
+              "mode": args.mode, "bcrypt_rounds": args.bcrypt_rounds, "graph_index": args.graph_index}
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        print(f"✅ Baseline saved to {save_path}")
+
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"⚠️ Baseline was recorded with {baseline['config']}")
+        regressions = compare(results, baseline["results"], args.tolerance, args.floor_ms)
+        for regression in regressions:
+            print(f"❌ {regression}")
+        print("✅ No regressions" if not regressions else f"❌ {len(regressions)} regressions")
+        sys.exit(1 if regressions else 0)
@@ -1,14 +1,112 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+
+# Connection pool, used for every backend except SQLite
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# SQLite: how long a writer waits for the lock before "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Attempts of a write that keeps finding the database locked before a request
+# gives up with 503
+DB_LOCK_RETRIES = int(os.getenv("DB_LOCK_RETRIES", "3"))
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def is_sqlite(url) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+# libpq (psycopg2) URL parameters asyncpg takes under another name in the URL,
+# and those it only takes as connect() arguments
+ASYNCPG_URL_PARAMS = {
+    "sslmode": "ssl",
+    "target_session_attrs": "target_session_attrs",
+}
+ASYNCPG_CONNECT_ARGS = {
+    "connect_timeout": lambda value: {"timeout": float(value)},
+    "application_name": lambda value: {"server_settings": {"application_name": value}},
+}
+
+def async_url(url) -> str:
+    """
+    Same database as `url`, through the matching asyncio driver. For asyncpg
+    the libpq parameters of a psycopg2 URL are translated (see
+    async_connect_args for the ones that move out of the URL); any other
+    parameter raises ValueError, since asyncpg would refuse it on connect.
+    """
+    url = make_url(url)
+    if url.get_backend_name() == "postgresql":
+        query = {}
+        for name, value in url.query.items():
+            if name in ASYNCPG_URL_PARAMS:
+                query[ASYNCPG_URL_PARAMS[name]] = value
+            elif name not in ASYNCPG_CONNECT_ARGS:
+                raise ValueError(f"DATABASE_URL parameter '{name}' is not supported by the asyncpg driver")
+        url = url.set(query=query)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername)).render_as_string(hide_password=False)
+
+def async_connect_args(url) -> dict:
+    """connect() arguments for the asyncpg equivalents of libpq URL parameters."""
+    url = make_url(url)
+    args = {}
+    if url.get_backend_name() == "postgresql":
+        for name, value in url.query.items():
+            if name in ASYNCPG_CONNECT_ARGS:
+                args.update(ASYNCPG_CONNECT_ARGS[name](value))
+    return args
+
+def is_lock_error(exc) -> bool:
+    """True for an OperationalError a retry can get past (lock wait ran out, deadlock)."""
+    message = str(getattr(exc, "orig", exc)).lower()
+    return any(text in message for text in ("database is locked", "database is busy", "deadlock detected"))
+
+def engine_options(url) -> dict:
+    if is_sqlite(url):
+        return {"connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer; NORMAL sync is safe with WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async path for read-heavy endpoints, so waiting on the database does not
+# hold a threadpool worker
+async_engine_options = engine_options(SQLALCHEMY_DATABASE_URL)
+if not is_sqlite(SQLALCHEMY_DATABASE_URL):
+    async_engine_options["connect_args"] = async_connect_args(SQLALCHEMY_DATABASE_URL)
+async_engine = create_async_engine(async_url(SQLALCHEMY_DATABASE_URL), **async_engine_options)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+if is_sqlite(SQLALCHEMY_DATABASE_URL):
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
 Base = declarative_base()
 
 def get_db():
@@ -17,3 +115,54 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def stream_with_session(produce, *args):
+    """
+    Body for a StreamingResponse that reads while it streams. The request's
+    session is closed before the body runs, so `produce(db, *args)` gets a
+    session of its own, closed when the stream ends or is abandoned.
+    """
+    db = SessionLocal()
+    try:
+        yield from produce(db, *args)
+    finally:
+        db.close()
+
+def add_missing_columns(bind=engine):
+    """
+    create_all() only creates missing tables. Add columns that were introduced
+    after a table was first created (nullable, without backfill).
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                if column.index:
+                    conn.execute(text(
+                        f'CREATE INDEX IF NOT EXISTS ix_{table.name}_{column.name} ON {table.name} ({column.name})'
+                    ))
+
+def add_missing_indexes(bind=engine):
+    """
+    create_all() skips tables that already exist, so indexes added to an
+    existing table's __table_args__ are created here.
+    """
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind)
@@ -0,0 +1,59 @@
+import argparse
+import os
+import sys
+import time
+from datetime import date
+
+from database import SessionLocal, engine
+import models
+from services.commission_service import CommissionService
+
+def distribute_commissions(run_date, trades_file=None, replace=False):
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        if trades_file:
+            fmt = os.path.splitext(trades_file)[1].lstrip(".").lower()
+            try:
+                with open(trades_file, "rb") as f:
+                    user_ids, volumes = CommissionService.parse_trades(f.read(), fmt)
+            except (OSError, ValueError) as e:
+                print(f"❌ Could not read trades file {trades_file}: {e}")
+                return False
+            source = os.path.basename(trades_file)
+        else:
+            user_ids, volumes = CommissionService.load_trades(db, run_date)
+            source = "trades"
+        print(f"🚀 Distributing commissions for {run_date}: {len(user_ids)} trade rows from {source}...")
+        try:
+            report = CommissionService.distribute(db, run_date, user_ids, volumes, source=source, replace=replace)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return False
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ Run {report['run_id']} in {elapsed:.1f}s: {report['traders']} traders, "
+          f"volume {report['total_volume']:.2f}, paid {report['total_paid']:.2f} "
+          f"in {report['payouts']} payouts over {report['levels_reached']} levels")
+    if report["rejected"]:
+        print(f"⚠️  {report['rejected']} trade rows rejected")
+        for rejected in report["rejected_rows"]:
+            print(f"   row {rejected['row']}: {rejected['error']}")
+    return True
+
+def run_date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a date as YYYY-MM-DD, got {value!r}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distribute one day's trading volume as upline commissions.")
+    parser.add_argument("--date", type=run_date, default=date.today(), help="run date (YYYY-MM-DD)")
+    parser.add_argument("--file", help="broker report (.csv or .parquet with user_id and volume columns) instead of the trades table")
+    parser.add_argument("--replace", action="store_true", help="replace an existing run for the date")
+    args = parser.parse_args()
+    sys.exit(0 if distribute_commissions(args.date, args.file, args.replace) else 1)
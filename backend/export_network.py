@@ -0,0 +1,43 @@
+import argparse
+import os
+import time
+
+from database import SessionLocal, engine, add_missing_columns
+import models
+from services.export_service import ExportService, NetworkExport, EXPORT_DATASETS, EXPORT_FORMATS
+
+def export_network(out_dir, fmt="parquet", datasets=None, consumer=None, incremental=False):
+    models.Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    os.makedirs(out_dir, exist_ok=True)
+    db = SessionLocal()
+    try:
+        for dataset in datasets or list(EXPORT_DATASETS):
+            since = ExportService.get_watermark(db, consumer, dataset) if incremental else None
+            export = NetworkExport(dataset, fmt, since)
+            path = os.path.join(out_dir, f"{dataset}.{fmt}")
+            print(f"🚀 Exporting {dataset}" + (f" changed since {since.isoformat()}" if since else "") + "...")
+            started = time.perf_counter()
+            # Write next to the target and rename, so a failed export leaves no partial file
+            with open(path + ".tmp", "wb") as f:
+                for data in export.iter_bytes(db):
+                    f.write(data)
+            os.replace(path + ".tmp", path)
+            if consumer:
+                export.save_watermark(db, consumer)
+            print(f"✅ {export.rows} rows to {path} in {time.perf_counter() - started:.1f}s")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the referral network for offline analytics.")
+    parser.add_argument("out_dir", help="directory for one file per dataset")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="parquet")
+    parser.add_argument("--dataset", action="append", choices=list(EXPORT_DATASETS),
+                        help="dataset to export (repeatable); all by default")
+    parser.add_argument("--consumer", help="save a watermark under this name")
+    parser.add_argument("--incremental", action="store_true", help="only rows changed since the consumer's watermark")
+    args = parser.parse_args()
+    if args.incremental and not args.consumer:
+        parser.error("--incremental needs --consumer")
+    export_network(args.out_dir, args.format, args.dataset, args.consumer, args.incremental)
@@ -0,0 +1,40 @@
+import argparse
+import os
+import time
+
+from database import SessionLocal, engine
+import models
+from services.bulk_import import BulkImportService, IMPORT_FORMATS, IMPORT_BATCH_SIZE, IMPORT_HASH_WORKERS
+
+def import_users(path, fmt=None, batch_size=IMPORT_BATCH_SIZE, workers=IMPORT_HASH_WORKERS):
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in IMPORT_FORMATS:
+        print(f"❌ Unknown format '{fmt}', use one of: {', '.join(IMPORT_FORMATS)}")
+        return
+
+    models.Base.metadata.create_all(bind=engine)
+    with open(path, encoding="utf-8") as f:
+        rows = BulkImportService.parse_rows(f.read(), fmt)
+
+    print(f"🚀 Importing {len(rows)} rows from {path}...")
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        summary = BulkImportService.import_users(db, rows, batch_size=batch_size, hash_workers=workers)
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ Created {summary['created']} users in {summary['generations']} generations "
+          f"({summary['stats_updated']} stats rows) in {elapsed:.1f}s")
+    for error in summary["errors"]:
+        print(f"❌ Row {error['row']}: {error['error']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import users with known referrers.")
+    parser.add_argument("path", help="CSV (with header) or JSON-lines file")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=IMPORT_HASH_WORKERS, help="bcrypt hashing processes")
+    args = parser.parse_args()
+    import_users(args.path, args.format, args.batch_size, args.workers)
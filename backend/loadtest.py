@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+# Replays a mix of auth and referral traffic at a target request rate with
+# asyncio and reports throughput, errors and latency percentiles per endpoint.
+# By default it starts its own uvicorn on a throwaway database:
+#
+#   python loadtest.py --rps 200 --duration 30 --mix register=1,login=1,me=4,tree=2,stats=4
+#   python loadtest.py --url http://localhost:8000 --rps 50
+#
+# Requests are started on schedule whether or not earlier ones finished (an
+# open loop), so a slow server shows up as latency instead of a lower rate.
+# Starts that had to wait for a free connection are reported as late.
+
+PASSWORD = "password123"
+OPERATIONS = ("register", "login", "me", "tree", "stats")
+DEFAULT_MIX = "register=1,login=1,me=4,tree=2,stats=4"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The mix needs at least one positive weight")
+    return mix
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, workers, env_overrides):
+    """uvicorn on a temp database; returns (process, workdir)."""
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    env = dict(os.environ)
+    env["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    env.update(env_overrides)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        # Own process group, so worker and password hashing processes go with it
+        start_new_session=True,
+    )
+    return process, workdir
+
+
+def stop_server(process, timeout=10):
+    # SIGINT lets uvicorn run the app's shutdown handlers; whatever is left
+    # of the process group afterwards is killed
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+async def wait_until_ready(client, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if (await client.get("/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not come up")
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.late = 0
+
+    def record(self, name, seconds, status):
+        self.latencies.setdefault(name, []).append(seconds * 1000)
+        key = str(status)
+        self.statuses.setdefault(name, {}).setdefault(key, 0)
+        self.statuses[name][key] += 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self, elapsed):
+        report = {}
+        for name, samples in sorted(self.latencies.items()):
+            report[name] = {
+                "requests": len(samples),
+                "rps": len(samples) / elapsed,
+                "error_rate": self.errors.get(name, 0) / len(samples),
+                "p50_ms": percentile(samples, 50),
+                "p95_ms": percentile(samples, 95),
+                "p99_ms": percentile(samples, 99),
+                "max_ms": max(samples),
+                "statuses": self.statuses[name],
+            }
+        return report
+
+
+class LoadTest:
+    """
+    Simulated users share one pool: registrations add to it (under a random
+    referrer already in it), logins refresh a member's token, and the read
+    operations act as a random member that has a token.
+    """
+
+    def __init__(self, client, mix, seed=0):
+        self.client = client
+        self.mix = mix
+        self.rng = random.Random(seed)
+        self.results = Results()
+        self.members = [{"email": "superadmin@example.com", "password": "superadmin123", "code": "SUPERADMIN"}]
+        self.with_token = []
+        self.counter = 0
+        self.prefix = f"load{int(time.time())}"
+
+    async def call(self, name, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            response, status = None, type(e).__name__
+        self.results.record(name, time.perf_counter() - started, status)
+        return response if status == 200 else None
+
+    async def register(self):
+        self.counter += 1
+        i = self.counter
+        referrer = self.rng.choice(self.members)
+        member = {"email": f"{self.prefix}_{i}@example.com", "password": PASSWORD}
+        response = await self.call("POST /api/auth/register", "POST", "/api/auth/register", json={
+            "email": member["email"],
+            "username": f"{self.prefix}_{i}",
+            "password": PASSWORD,
+            "referral_code": referrer["code"],
+        })
+        if response is not None:
+            member["code"] = response.json()["referral_code"]
+            self.members.append(member)
+        return member if response is not None else None
+
+    async def login(self, member=None):
+        member = member or self.rng.choice(self.members)
+        response = await self.call("POST /api/auth/login", "POST", "/api/auth/login", json={
+            "email": member["email"], "password": member["password"],
+        })
+        if response is not None:
+            if "token" not in member:
+                self.with_token.append(member)
+            member["token"] = response.json()["access_token"]
+
+    async def get(self, path):
+        if not self.with_token:
+            return await self.login()
+        member = self.rng.choice(self.with_token)
+        await self.call(f"GET {path}", "GET", path, headers={"Authorization": f"Bearer {member['token']}"})
+
+    async def operation(self, name):
+        if name == "register":
+            await self.register()
+        elif name == "login":
+            await self.login()
+        elif name == "me":
+            await self.get("/api/auth/me")
+        elif name == "tree":
+            await self.get("/api/referral/tree")
+        else:
+            await self.get("/api/referral/stats")
+
+    async def seed(self, users, concurrency):
+        """Register and log in `users` members before the measured run."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                member = await self.register()
+                if member is not None:
+                    await self.login(member)
+
+        await self.login(self.members[0])
+        await asyncio.gather(*(one() for _ in range(users)))
+        self.results = Results()
+
+    async def run(self, rps, duration, concurrency):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = set()
+
+        async def one(name):
+            try:
+                await self.operation(name)
+            finally:
+                semaphore.release()
+
+        started = time.perf_counter()
+        interval = 1 / rps
+        for n in range(int(rps * duration)):
+            # Absolute schedule, so timer drift does not lower the rate
+            delay = started + n * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if semaphore.locked():
+                self.results.late += 1
+            await semaphore.acquire()
+            task = asyncio.create_task(one(self.rng.choices(names, weights)[0]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+async def run_load_test(args):
+    mix = parse_mix(args.mix)
+    process = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        process, workdir = start_server(port, args.workers, {
+            "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+            "STATS_PROPAGATION": args.mode,
+        })
+        url = f"http://127.0.0.1:{port}"
+        print(f"🚀 Started uvicorn ({args.workers} worker(s)) on {url} with a database in {workdir}")
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+            await wait_until_ready(client)
+            test = LoadTest(client, mix, args.seed)
+            print(f"🌱 Seeding {args.users} users...")
+            await test.seed(args.users, args.concurrency)
+            print(f"⏱️  {args.rps} req/s for {args.duration}s, mix {mix}")
+            elapsed = await test.run(args.rps, args.duration, args.concurrency)
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    report = test.results.summary(elapsed)
+    total = sum(r["requests"] for r in report.values())
+    errors = sum(r["error_rate"] * r["requests"] for r in report.values())
+    print(f"✅ {total} requests in {elapsed:.1f}s: {total / elapsed:.1f} req/s (target {args.rps}), "
+          f"{errors / max(total, 1):.2%} errors, {test.results.late} late starts")
+    for name, r in report.items():
+        print(f"  {name:<26} {r['requests']:>7} {r['rps']:>8.1f}/s  err {r['error_rate']:>6.2%}  "
+              f"p50 {r['p50_ms']:>8.2f}ms  p95 {r['p95_ms']:>8.2f}ms  p99 {r['p99_ms']:>8.2f}ms")
+        if r["error_rate"]:
+            print(f"  {'':<26} statuses {r['statuses']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"target_rps": args.rps, "elapsed_s": elapsed, "late": test.results.late,
+                       "endpoints": report}, f, indent=2)
+        print(f"💾 Saved results to {args.json}")
+    return errors == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Asyncio load test of the auth and referral endpoints.")
+    parser.add_argument("--url", help="target server; by default a local uvicorn on a temp database is started")
+    parser.add_argument("--rps", type=float, default=50, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measured traffic")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights per operation: " + ", ".join(OPERATIONS))
+    parser.add_argument("--users", type=int, default=100, help="members registered before the measured run")
+    parser.add_argument("--concurrency", type=int, default=100, help="max requests in flight")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the local server")
+    parser.add_argument("--mode", choices=("inline", "deferred"), default="deferred",
+                        help="stats propagation of the local server")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4,
+                        help="bcrypt cost of the local server; raise it to measure production hashing")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.rps <= 0:
+        parser.error("--rps must be positive")
+    ok = asyncio.run(run_load_test(args))
+    sys.exit(0 if ok else 1)
@@ -1,17 +1,33 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import asyncio
+import time
+
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 import models, schemas, auth
-from routers import referral
-from utils import generate_referral_code
-from services.referral_service import ReferralService
-from database import engine, get_db
+from routers import referral, admin
+from services.referral_service import ReferralService, MAX_LEVELS
+from services.graph_index import graph_index, GRAPH_INDEX_ENABLED
+from services.stats_worker import stats_worker, STATS_PROPAGATION
+from services.password_service import password_service
+from services.counter_service import CounterService, counter_reconciler
+from services.leaderboard import leaderboard_refresher, LEADERBOARD_SNAPSHOT_ENABLED
+from services.referral_codes import ReferralCodeAllocator, referral_code_cache
+from services import metrics
+from database import engine, async_engine, get_db, SessionLocal, add_missing_columns, add_missing_indexes, is_lock_error, stream_with_session, DB_LOCK_RETRIES
 
 models.Base.metadata.create_all(bind=engine)
+add_missing_columns(engine)
+add_missing_indexes(engine)
 
 app = FastAPI()
 app.include_router(referral.router)
+app.include_router(admin.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,6 +37,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    stats, token = metrics.start_request()
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Label by route template so ids in the path do not explode cardinality.
+        # Streaming responses are timed up to the first byte.
+        route = request.scope.get("route")
+        metrics.observe_request(
+            request.method,
+            route.path if route is not None else "unmatched",
+            status_code,
+            time.perf_counter() - started,
+            stats,
+        )
+        metrics.end_request(token)
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.on_event("startup")
 def create_super_admin():
     db = next(get_db())
@@ -36,109 +81,258 @@ def create_super_admin():
             referral_code="SUPERADMIN"
         )
         db.add(super_admin)
+        db.flush()
+        ReferralService.index_user(db, super_admin.id)
+        db.add(models.ReferralStat(user_id=super_admin.id, total_directs=0, total_team_size=0))
         db.commit()
 
+    # Backfill the referral closure index and stats rows for databases that predate them
+    ReferralService.ensure_closure(db)
+    ReferralService.ensure_stats_rows(db)
+    ReferralService.ensure_level_stats(db)
+    ReferralService.ensure_active_stats(db)
+
+@app.on_event("startup")
+def load_graph_index():
+    if GRAPH_INDEX_ENABLED:
+        db = SessionLocal()
+        try:
+            graph_index.load(db, MAX_LEVELS)
+        finally:
+            db.close()
+
+@app.on_event("startup")
+def start_stats_worker():
+    if STATS_PROPAGATION == "deferred":
+        stats_worker.start()
+
+@app.on_event("shutdown")
+def stop_stats_worker():
+    stats_worker.stop()
+
+@app.on_event("startup")
+def start_counter_reconciler():
+    # First run reconciles right away, e.g. counters missing after an upgrade
+    counter_reconciler.start()
+
+@app.on_event("shutdown")
+def stop_counter_reconciler():
+    counter_reconciler.stop()
+
+@app.on_event("startup")
+def start_leaderboard_refresher():
+    if LEADERBOARD_SNAPSHOT_ENABLED:
+        leaderboard_refresher.start()
+
+@app.on_event("shutdown")
+def stop_leaderboard_refresher():
+    leaderboard_refresher.stop()
+
+@app.on_event("shutdown")
+def stop_password_service():
+    password_service.shutdown()
+
+# bcrypt runs in the password service's process pool. The endpoints below are
+# async so a request waiting on a hash holds neither the event loop nor a
+# threadpool worker; their database work is pushed to the threadpool.
+
+def _get_user_by_email(db: Session, email: str):
+    return db.query(models.User).filter(models.User.email == email).first()
+
 @app.post("/api/auth/register", response_model=schemas.UserResponse)
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     if user.role in ["super_admin", "admin"]:
         raise HTTPException(status_code=400, detail="Cannot register as admin or super_admin")
     
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
+    db_user = await run_in_threadpool(_get_user_by_email, db, user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
+    hashed_password = await password_service.hash(user.password)
+    for attempt in range(DB_LOCK_RETRIES + 1):
+        try:
+            return await run_in_threadpool(_create_user, db, user, hashed_password)
+        except OperationalError as e:
+            db.rollback()
+            if not is_lock_error(e):
+                raise
+        # Another writer held the lock past busy_timeout: back off and go again
+        await asyncio.sleep(0.05 * 2 ** attempt)
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Registration is busy, please try again",
+        headers={"Retry-After": "1"},
+    )
+
+def _create_user(db: Session, user: schemas.UserCreate, hashed_password: str):
+    """
+    Create the user, its closure rows, its stats row, the upline stats updates
+    and the counter updates as one unit of work with a single commit.
+    """
     # Referral Logic
     referrer_id = None
     if user.referral_code:
-        referrer = db.query(models.User).filter(models.User.referral_code == user.referral_code).first()
-        if referrer:
-            referrer_id = referrer.id
-    
-    # Generate unique referral code
-    new_referral_code = generate_referral_code()
-    while db.query(models.User).filter(models.User.referral_code == new_referral_code).first():
-        new_referral_code = generate_referral_code()
+        referrer_id = referral_code_cache.resolve(db, user.referral_code)
 
     new_user = models.User(
         email=user.email,
         username=user.username,
-        hashed_password=auth.get_password_hash(user.password),
+        hashed_password=hashed_password,
         role="user",
         is_active=True,
         permissions={},
-        referral_code=new_referral_code,
         referred_by_id=referrer_id
     )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
 
-    # Initialize Referral Stats
-    new_stats = models.ReferralStat(user_id=new_user.id)
-    db.add(new_stats)
-    db.commit()
+    try:
+        # The code is derived from the new id, so concurrent signups share no
+        # counter row
+        db.add(new_user)
+        db.flush()
+        try:
+            with db.begin_nested():
+                new_user.referral_code = ReferralCodeAllocator.for_user(new_user.id)
+                db.flush()
+        except IntegrityError:
+            # Only a code from before the derived scheme can clash; take a
+            # sequence one instead
+            new_user.referral_code = ReferralCodeAllocator.allocate(db)[0]
+            db.flush()
 
-    # Propagate stats to uplines (async in production)
-    if referrer_id:
-        ReferralService.propagate_stats_update(db, new_user.id)
+        ReferralService.index_user(db, new_user.id, referrer_id)
+
+        # Initialize Referral Stats
+        db.add(models.ReferralStat(user_id=new_user.id, total_directs=0, total_team_size=0))
+
+        # Propagate stats to uplines (queued for the stats worker in deferred mode)
+        if referrer_id:
+            ReferralService.propagate_stats_update(
+                db, new_user.id, defer=STATS_PROPAGATION == "deferred"
+            )
+
+        CounterService.record_users_created(db, referred=1 if referrer_id else 0)
+        db.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent signup using the same email/username
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email or username already registered")
 
-    db.commit()
     db.refresh(new_user)
+    referral_code_cache.put(new_user.referral_code, new_user.id)
+    graph_index.sync(db, force=True)
     return new_user
 
 @app.post("/api/auth/login", response_model=schemas.Token)
-def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if not db_user or not auth.verify_password(user.password, db_user.hashed_password):
+async def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
+    db_user = await run_in_threadpool(_get_user_by_email, db, user.email)
+    if not db_user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    valid, new_hash = await password_service.verify_and_update(user.password, db_user.hashed_password)
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     if not db_user.is_active:
         raise HTTPException(status_code=403, detail="Account is inactive")
+
+    # Transparently upgrade hashes made with a different bcrypt cost
+    if new_hash:
+        db_user.hashed_password = new_hash
+        await run_in_threadpool(_commit_and_refresh, db, db_user)
     
-    access_token = auth.create_access_token(data={"sub": db_user.email})
+    access_token = auth.create_user_token(db_user)
     return {
         "access_token": access_token,
         "token_type": "bearer",
         "user": db_user
     }
 
+def _commit_and_refresh(db: Session, instance):
+    db.commit()
+    db.refresh(instance)
+    return instance
+
 @app.get("/api/auth/me", response_model=schemas.UserResponse)
-def get_me(current_user: models.User = Depends(auth.get_current_user)):
+def get_me(current_user: auth.Principal = Depends(auth.get_current_user)):
     return current_user
 
 @app.post("/api/admin/create", response_model=schemas.UserResponse)
-def create_admin(
+async def create_admin(
     admin_data: schemas.AdminCreate,
-    current_user: models.User = Depends(auth.require_role(["super_admin"])),
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
     db: Session = Depends(get_db)
 ):
-    db_user = db.query(models.User).filter(models.User.email == admin_data.email).first()
+    db_user = await run_in_threadpool(_get_user_by_email, db, admin_data.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
+    hashed_password = await password_service.hash(admin_data.password)
+    return await run_in_threadpool(_create_admin, db, admin_data, hashed_password, current_user.id)
+
+def _create_admin(db: Session, admin_data: schemas.AdminCreate, hashed_password: str, creator_id: int):
     new_admin = models.User(
         email=admin_data.email,
         username=admin_data.username,
-        hashed_password=auth.get_password_hash(admin_data.password),
+        hashed_password=hashed_password,
         role="admin",
         is_active=True,
         permissions=admin_data.permissions,
-        created_by=current_user.id
+        created_by=creator_id
     )
     db.add(new_admin)
+    db.flush()
+    ReferralService.index_user(db, new_admin.id)
+    db.add(models.ReferralStat(user_id=new_admin.id, total_directs=0, total_team_size=0))
+    CounterService.record_users_created(db)
     db.commit()
     db.refresh(new_admin)
+    graph_index.sync(db, force=True)
     return new_admin
 
+def _users_query(role: str, after_id: Optional[int]):
+    stmt = select(models.User).order_by(models.User.id)
+    if role != "super_admin":
+        stmt = stmt.where(models.User.role == "user")
+    if after_id is not None:
+        stmt = stmt.where(models.User.id > after_id)
+    return stmt
+
+def _stream_users(db: Session, role: str, after_id: Optional[int], limit: Optional[int]):
+    stmt = _users_query(role, after_id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    for user in db.scalars(stmt.execution_options(yield_per=1000)):
+        yield schemas.UserResponse.model_validate(user).model_dump_json() + "\n"
+
 @app.get("/api/users", response_model=List[schemas.UserResponse])
 def get_users(
-    current_user: models.User = Depends(auth.require_role(["super_admin", "admin"])),
+    response: Response,
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None,
+    format: str = "json",
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin", "admin"])),
     db: Session = Depends(get_db)
 ):
-    if current_user.role == "super_admin":
-        users = db.query(models.User).all()
-    else:
-        users = db.query(models.User).filter(models.User.role == "user").all()
+    """
+    Users ordered by id. Pass limit (and after_id) to page through them; the
+    next page's after_id is returned in the X-Next-Cursor header.
+    format=ndjson streams the rows as newline-delimited JSON instead.
+    """
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+
+    if format == "ndjson":
+        return StreamingResponse(
+            stream_with_session(_stream_users, current_user.role, after_id, limit),
+            media_type="application/x-ndjson",
+        )
+
+    stmt = _users_query(current_user.role, after_id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    users = db.scalars(stmt).all()
+    if limit is not None and len(users) == limit:
+        response.headers["X-Next-Cursor"] = str(users[-1].id)
     return users
 
 @app.get("/")
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, JSON
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, JSON, Index, DateTime, Date, Float
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -13,6 +14,8 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     permissions = Column(JSON, default=dict)  # For admin permissions
     created_by = Column(Integer, ForeignKey("users.id"), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Referral System Fields
     referral_code = Column(String, unique=True, index=True, nullable=True)
@@ -32,10 +35,91 @@ class ReferralStat(Base):
     
     total_directs = Column(Integer, default=0)
     total_team_size = Column(Integer, default=0)  # Total downline across 20 levels
-    level_breakdown = Column(JSON, default=dict)  # e.g., {"1": 5, "2": 10}
+    active_directs = Column(Integer, default=0)
+    active_team_size = Column(Integer, default=0)  # Members of the above with is_active set
+    subtree_version = Column(Integer, default=0)  # Bumped whenever the downline or these stats change
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     user = relationship("User", back_populates="referral_stats")
 
+    # Leaderboards read these in (value, user_id) order
+    __table_args__ = (
+        Index("ix_referral_stats_team_size", "total_team_size", "user_id"),
+        Index("ix_referral_stats_directs", "total_directs", "user_id"),
+    )
+
+    # Written with SQL upserts by ReferralService, never through this relationship
+    levels = relationship(
+        "ReferralLevelStat",
+        primaryjoin="ReferralStat.user_id == foreign(ReferralLevelStat.user_id)",
+        order_by="ReferralLevelStat.level",
+        viewonly=True,
+    )
+
+    @property
+    def level_breakdown(self):
+        # Same shape as the former JSON column, e.g. {"1": 5, "2": 10}
+        return {str(row.level): row.count for row in self.levels if row.count}
+
+    @property
+    def active_level_breakdown(self):
+        return {str(row.level): row.active_count for row in self.levels if row.active_count}
+
+class ReferralLevelStat(Base):
+    __tablename__ = "referral_level_stats"
+    
+    # Downline size of a user on one level (1 = direct referrals)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    level = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    active_count = Column(Integer, default=0)  # Of which is_active is set
+    
+    __table_args__ = (
+        Index("ix_referral_level_stats_level_count", "level", "count", "user_id"),
+    )
+
+class ReferralClosure(Base):
+    __tablename__ = "referral_closure"
+    
+    # One row per (ancestor, descendant) pair up to 20 levels apart,
+    # plus a depth 0 row pointing every user at themselves
+    ancestor_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    depth = Column(Integer, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_referral_closure_ancestor_depth", "ancestor_id", "depth"),
+        Index("ix_referral_closure_descendant_depth", "descendant_id", "depth"),
+    )
+
+class StatsOutbox(Base):
+    __tablename__ = "stats_outbox"
+    
+    # Pending stats changes, drained by the stats worker: one active member
+    # joined on `level` of user_id, or a full refresh of user_id if level is NULL
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    level = Column(Integer, nullable=True)
+    enqueued_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class SystemCounter(Base):
+    __tablename__ = "system_counters"
+    
+    # System-wide aggregates kept current in the transactions that change them,
+    # e.g. "total_users" or "signups:2024-01-31"
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+class ExportWatermark(Base):
+    __tablename__ = "export_watermarks"
+    
+    # Start time of a consumer's last complete export of a dataset; the next
+    # incremental export reads rows updated since then
+    consumer = Column(String, primary_key=True)
+    dataset = Column(String, primary_key=True)
+    exported_at = Column(DateTime, nullable=False)
+    rows = Column(Integer, default=0)
+
 class BrokerAccount(Base):
     __tablename__ = "broker_accounts"
     
@@ -48,3 +132,52 @@ class BrokerAccount(Base):
     is_active = Column(Boolean, default=True)
     
     user = relationship("User", back_populates="broker_account")
+
+class Trade(Base):
+    __tablename__ = "trades"
+    
+    # Broker trade volume per user, as reported for a trading day
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    trade_date = Column(Date, nullable=False)
+    volume = Column(Float, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_trades_date_user", "trade_date", "user_id"),
+    )
+
+class CommissionLevel(Base):
+    __tablename__ = "commission_levels"
+    
+    # Share of a downline member's volume paid to the upline `level` above them
+    level = Column(Integer, primary_key=True)
+    percent = Column(Float, nullable=False, default=0.0)
+
+class CommissionRun(Base):
+    __tablename__ = "commission_runs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    run_date = Column(Date, unique=True, nullable=False)
+    source = Column(String)  # "trades" or the uploaded file name
+    traders = Column(Integer, default=0)
+    total_volume = Column(Float, default=0.0)
+    total_paid = Column(Float, default=0.0)
+    payouts = Column(Integer, default=0)
+    level_percents = Column(JSON, default=list)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class CommissionPayout(Base):
+    __tablename__ = "commission_payouts"
+    
+    # One ledger row per (run, recipient, level)
+    id = Column(Integer, primary_key=True, index=True)
+    run_id = Column(Integer, ForeignKey("commission_runs.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    level = Column(Integer, nullable=False)
+    volume = Column(Float, nullable=False)
+    amount = Column(Float, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_commission_payouts_run_user", "run_id", "user_id"),
+        Index("ix_commission_payouts_user_run", "user_id", "run_id"),
+    )
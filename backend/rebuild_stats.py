@@ -0,0 +1,30 @@
+import argparse
+import time
+
+from database import SessionLocal, engine
+import models
+from services.referral_service import ReferralService
+
+def rebuild_stats(dry_run=False):
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        print(f"🚀 {'Checking' if dry_run else 'Rebuilding'} referral stats for every user...")
+        started = time.perf_counter()
+        report = ReferralService.rebuild_all_stats(db, dry_run=dry_run)
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ {report['users']} users in {elapsed:.1f}s: {report['drifted']} drifted, "
+          f"{report['missing']} missing, {report['written']} written")
+    for diff in report["sample"]:
+        print(f"❌ User {diff['user_id']}: stored {diff['stored']} expected {diff['expected']}")
+    if report["unreachable"]:
+        print(f"⚠️ {len(report['unreachable'])} users sit in a referral cycle: {report['unreachable'][:20]}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute all referral_stats rows in one pass.")
+    parser.add_argument("--dry-run", action="store_true", help="only report drifted rows")
+    args = parser.parse_args()
+    rebuild_stats(args.dry_run)
@@ -0,0 +1,330 @@
+import os
+from datetime import date, datetime
+
+from fastapi import APIRouter, Depends, HTTPException, Response, UploadFile, File
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from typing import List, Optional
+
+from database import get_db, stream_with_session
+import models, schemas, auth
+from services.bulk_import import BulkImportService, IMPORT_FORMATS
+from services.commission_service import CommissionService, TRADE_FORMATS
+from services.counter_service import CounterService
+from services.export_service import ExportService, NetworkExport, EXPORT_DATASETS, EXPORT_FORMATS
+from services.graph_index import graph_index
+from services.referral_service import ReferralService, MAX_LEVELS
+from services.leaderboard import (
+    LeaderboardService, LEADERBOARD_METRICS, LEADERBOARD_SNAPSHOT_ENABLED, leaderboard_snapshot,
+)
+
+router = APIRouter(
+    prefix="/api/admin",
+    tags=["admin"]
+)
+
+@router.post("/users/import", response_model=dict)
+def import_users(
+    file: UploadFile = File(...),
+    format: Optional[str] = None,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Bulk import users from a CSV or JSON-lines file.
+    Each row may name its referrer by referral_code (`referrer_code`), either an
+    existing user or another row of the same file.
+    """
+    fmt = format or os.path.splitext(file.filename or "")[1].lstrip(".").lower()
+    if fmt not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of {', '.join(IMPORT_FORMATS)}")
+
+    try:
+        rows = BulkImportService.parse_rows(file.file.read().decode("utf-8"), fmt)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse import file: {e}")
+
+    return BulkImportService.import_users(db, rows)
+
+@router.patch("/users/{user_id}", response_model=schemas.UserResponse)
+def update_user(
+    user_id: int,
+    changes: schemas.UserUpdate,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Change a user's role, active flag or admin permissions.
+    """
+    user = db.get(models.User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    if user.role == "super_admin":
+        raise HTTPException(status_code=400, detail="Cannot modify the super admin")
+    if changes.role is not None and changes.role not in ["admin", "user"]:
+        raise HTTPException(status_code=400, detail="Role must be admin or user")
+
+    if changes.role is not None:
+        user.role = changes.role
+    if changes.is_active is not None and changes.is_active != user.is_active:
+        # Also adjusts the uplines' active counts and subtree versions
+        ReferralService.set_active(db, [user.id], changes.is_active)
+        CounterService.record_activation_change(db, 1 if changes.is_active else -1)
+    if changes.permissions is not None:
+        user.permissions = changes.permissions
+    db.commit()
+    db.refresh(user)
+
+    # Cached principals carry role, is_active and permissions
+    auth.principal_cache.invalidate(user.id)
+    return user
+
+@router.post("/users/activation", response_model=dict)
+def set_users_active(
+    activation: schemas.BulkActivation,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Activate or deactivate many users at once. The uplines'
+    active counts are adjusted in one batched pass.
+    """
+    changed = ReferralService.set_active(db, activation.user_ids, activation.is_active)
+    CounterService.record_activation_change(db, len(changed) if activation.is_active else -len(changed))
+    db.commit()
+
+    for uid in changed:
+        auth.principal_cache.invalidate(uid)
+    return {"requested": len(set(activation.user_ids)), "changed": len(changed)}
+
+@router.post("/users/{user_id}/move", response_model=dict)
+def move_user(
+    user_id: int,
+    move: schemas.SubtreeMove,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Move a user, with their whole downline, under another
+    referrer. Refused if the new referrer is in the user's own downline.
+    """
+    try:
+        report = ReferralService.move_subtree(db, user_id, move.new_referrer_id)
+    except ValueError as e:
+        status = 404 if "not found" in str(e) else 400
+        raise HTTPException(status_code=status, detail=str(e))
+
+    graph_index.move_user(db, user_id, move.new_referrer_id)
+    # Cached principals carry referred_by_id
+    auth.principal_cache.invalidate(user_id)
+    return report
+
+@router.post("/stats/rebuild", response_model=dict)
+def rebuild_stats(
+    dry_run: bool = True,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Recompute every user's referral stats in one pass.
+    Defaults to a dry run that only reports drifted and missing rows;
+    pass dry_run=false to write the fixes.
+    """
+    return ReferralService.rebuild_all_stats(db, dry_run=dry_run)
+
+@router.get("/leaderboard", response_model=List[dict])
+def get_leaderboard(
+    response: Response,
+    metric: str = "team_size",
+    level: Optional[int] = None,
+    active: Optional[bool] = None,
+    days: int = 7,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Top users by team_size, directs, the size of one `level`,
+    or recent_directs (referrals who joined in the last `days` days).
+    active filters on the leaders' is_active flag. Rows are ordered by
+    (value, user_id) descending; the next page's cursor ("<value>:<user_id>")
+    is returned in the X-Next-Cursor header.
+    """
+    if metric not in LEADERBOARD_METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join(LEADERBOARD_METRICS)}")
+    if metric == "level" and (level is None or not 1 <= level <= MAX_LEVELS):
+        raise HTTPException(status_code=400, detail=f"level must be between 1 and {MAX_LEVELS}")
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    if days < 1:
+        raise HTTPException(status_code=400, detail="days must be positive")
+    after = None
+    if cursor is not None:
+        try:
+            value, user_id = cursor.split(":")
+            after = (int(value), int(user_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    rows = None
+    if LEADERBOARD_SNAPSHOT_ENABLED and active is None:
+        rows = leaderboard_snapshot.get(db, metric, limit, level=level, days=days, after=after)
+        if rows is not None:
+            response.headers["X-Leaderboard-Snapshot"] = (leaderboard_snapshot.refreshed_at or datetime.utcnow()).isoformat()
+    if rows is None:
+        rows = LeaderboardService.top(db, metric, limit, level=level, active=active, days=days, after=after)
+
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = f"{rows[-1]['value']}:{rows[-1]['user_id']}"
+    return rows
+
+@router.get("/commissions/levels", response_model=List[float])
+def get_commission_levels(
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Commission percent of each upline level, level 1 first.
+    """
+    return CommissionService.get_level_percents(db)
+
+@router.put("/commissions/levels", response_model=List[float])
+def set_commission_levels(
+    percents: List[float],
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Replace the per-level commission percentages (level 1 first,
+    up to MAX_LEVELS entries; missing levels pay nothing).
+    """
+    try:
+        return CommissionService.set_level_percents(db, percents)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/commissions/run", response_model=dict)
+def run_commissions(
+    run_date: date,
+    replace: bool = False,
+    file: Optional[UploadFile] = File(None),
+    format: Optional[str] = None,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Distribute one day's commissions over the upline of every
+    trader. Volume comes from the trades table for run_date, or from an
+    uploaded broker report (CSV or Parquet with user_id and volume columns).
+    A day already distributed is refused unless replace=true.
+    """
+    source = "trades"
+    if file is not None:
+        fmt = format or os.path.splitext(file.filename or "")[1].lstrip(".").lower()
+        if fmt not in TRADE_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Format must be one of {', '.join(TRADE_FORMATS)}")
+        try:
+            user_ids, volumes = CommissionService.parse_trades(file.file.read(), fmt)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Could not parse trades file: {e}")
+        source = file.filename or fmt
+    else:
+        user_ids, volumes = CommissionService.load_trades(db, run_date)
+
+    try:
+        return CommissionService.distribute(db, run_date, user_ids, volumes, source=source, replace=replace)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.get("/commissions/runs", response_model=List[dict])
+def get_commission_runs(
+    limit: int = 30,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Most recent commission runs with their totals.
+    """
+    return [
+        {
+            "id": run.id,
+            "run_date": run.run_date.isoformat(),
+            "source": run.source,
+            "traders": run.traders,
+            "total_volume": run.total_volume,
+            "total_paid": run.total_paid,
+            "payouts": run.payouts,
+            "created_at": run.created_at.isoformat() if run.created_at else None,
+        }
+        for run in CommissionService.get_runs(db, limit)
+    ]
+
+@router.get("/commissions/users/{user_id}", response_model=List[dict])
+def get_user_commissions(
+    user_id: int,
+    run_id: Optional[int] = None,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: A user's commission ledger, per run and level.
+    """
+    return CommissionService.get_user_payouts(db, user_id, run_id)
+
+def _stream_export(db: Session, export: NetworkExport, consumer: Optional[str]):
+    yield from export.iter_bytes(db)
+    if consumer:
+        export.save_watermark(db, consumer)
+
+@router.get("/export/{dataset}")
+def export_dataset(
+    dataset: str,
+    format: str = "csv",
+    consumer: Optional[str] = None,
+    incremental: bool = False,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Stream users, links (parent ids), stats or levels as CSV or
+    Parquet, read in chunks from a server-side cursor. With a consumer name
+    the export's start time is saved as that consumer's watermark once the
+    body was sent completely; incremental=true then only exports rows
+    changed since the previous watermark.
+    """
+    if dataset not in EXPORT_DATASETS:
+        raise HTTPException(status_code=404, detail=f"Dataset must be one of {', '.join(EXPORT_DATASETS)}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of {', '.join(EXPORT_FORMATS)}")
+    if incremental and not consumer:
+        raise HTTPException(status_code=400, detail="Incremental exports need a consumer")
+
+    since = ExportService.get_watermark(db, consumer, dataset) if incremental else None
+    export = NetworkExport(dataset, format, since)
+    headers = {
+        "Content-Disposition": f'attachment; filename="{dataset}.{format}"',
+        "X-Export-Watermark": export.started_at.isoformat(),
+    }
+    if since is not None:
+        headers["X-Export-Since"] = since.isoformat()
+    media_type = "text/csv" if format == "csv" else "application/vnd.apache.parquet"
+    return StreamingResponse(stream_with_session(_stream_export, export, consumer), media_type=media_type, headers=headers)
+
+@router.get("/export-watermarks", response_model=List[dict])
+def get_export_watermarks(
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Super Admin: Last complete export of every consumer and dataset.
+    """
+    return [
+        {
+            "consumer": watermark.consumer,
+            "dataset": watermark.dataset,
+            "exported_at": watermark.exported_at.isoformat(),
+            "rows": watermark.rows,
+        }
+        for watermark in ExportService.get_watermarks(db)
+    ]
@@ -1,103 +1,276 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+import json
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
 from typing import List, Optional
 
-from database import get_db
+from database import get_db, get_async_db, stream_with_session
 import models, schemas, auth
 from services.referral_service import ReferralService
+from services.stats_worker import stats_worker
+from services.graph_index import graph_index
+from services.counter_service import CounterService
+from services.response_cache import response_cache
 
 router = APIRouter(
     prefix="/api/referral",
     tags=["referral"]
 )
 
+def _parse_tree_cursor(cursor: Optional[str]):
+    """Tree cursors are "<level>:<id>" of the last row already received."""
+    if cursor is None:
+        return None
+    try:
+        level, node_id = cursor.split(":")
+        return int(level), int(node_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _stream_tree(db: Session, root_user_id: Optional[int], depth: int, after):
+    for node in ReferralService.iter_referral_tree(db, root_user_id, max_depth=depth, after=after):
+        yield json.dumps(node) + "\n"
+
+# Read endpoints below are async and use AsyncSession.run_sync, so the
+# ReferralService queries run on the asyncio driver without holding a
+# threadpool worker while they wait on the database.
+
 @router.get("/admin/tree", response_model=List[dict])
-def get_admin_tree(
+async def get_admin_tree(
+    response: Response,
     user_id: Optional[int] = None,
     depth: int = 3,
-    current_user: models.User = Depends(auth.require_role(["super_admin"])),
-    db: Session = Depends(get_db)
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    format: str = "json",
+    nested: bool = False,
+    current_user: auth.Principal = Depends(auth.require_role_async(["super_admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Admin: Get referral tree for ANY user, or global forest if user_id is None.
     If user_id is provided, acts like get_referral_tree for that user.
     If user_id is None, finds all root users (referred_by_id IS NULL) and builds forest.
+    Rows are ordered by (level, id). Pass limit to page through them; the next
+    page's cursor is returned in the X-Next-Cursor header. format=ndjson
+    streams every row after the cursor as newline-delimited JSON instead.
+    nested=true returns the rows as a hierarchy with 'children' lists.
     """
     if depth > 20: 
         raise HTTPException(status_code=400, detail="Max depth is 20")
-    
-    # If user_id is None, we need a slight modification to the service or call it differently
-    # The current service expects a root_user_id. 
-    # If we pass None, it filters by referred_by_id == None, which finds all roots.
-    # PRO TIP: The recursion works fine starting from multiple roots (SQLAlchemy/Postgres handles this).
-    
-    tree = ReferralService.get_referral_tree(db, user_id, max_depth=depth)
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    after = _parse_tree_cursor(cursor)
+
+    if format == "ndjson":
+        return StreamingResponse(stream_with_session(_stream_tree, user_id, depth, after), media_type="application/x-ndjson")
+
+    tree = await db.run_sync(ReferralService.get_referral_tree, user_id, max_depth=depth, limit=limit, after=after)
+    if limit is not None and len(tree) == limit:
+        last = tree[-1]
+        response.headers["X-Next-Cursor"] = f"{last['level']}:{last['id']}"
+    if nested:
+        return ReferralService.build_nested(tree)
     return tree
 
 @router.get("/admin/stats", response_model=dict)
-def get_admin_stats(
-    current_user: models.User = Depends(auth.require_role(["super_admin"])),
-    db: Session = Depends(get_db)
+async def get_admin_stats(
+    current_user: auth.Principal = Depends(auth.require_role_async(["super_admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Admin: System-wide referral stats.
+    Read from the system_counters table, which registration, admin creation and
+    activation changes keep current; no scans of users.
     """
-    total_users = db.query(models.User).count()
-    active_users = db.query(models.User).filter(models.User.is_active == True).count()
-    users_with_referrals = db.query(models.User).filter(models.User.referral_code != None).count() # Everyone has one now
-    
-    # Example stat: Total referral connections
-    total_referrals = db.query(models.User).filter(models.User.referred_by_id != None).count()
-    
-    return {
-        "total_users": total_users,
-        "active_users": active_users,
-        "total_referrals_made": total_referrals,
-    }
+    return await db.run_sync(CounterService.get_summary)
+
+@router.post("/admin/stats/reconcile", response_model=dict)
+def reconcile_admin_stats(
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Admin: Recount the system counters from users and report any drift.
+    Also runs periodically in the background.
+    """
+    return {"drift": CounterService.reconcile(db)}
+
+@router.get("/admin/verify-stats/{user_id}", response_model=dict)
+def verify_user_stats(
+    user_id: int,
+    repair: bool = False,
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Admin: Check a user's stored stats against a full downline recompute.
+    Pass repair=true to overwrite a drifted row.
+    """
+    if not db.query(models.User).filter(models.User.id == user_id).first():
+        raise HTTPException(status_code=404, detail="User not found")
+    return ReferralService.verify_stats(db, user_id, repair=repair)
+
+@router.get("/admin/stats-queue", response_model=dict)
+def get_stats_queue(
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+):
+    """
+    Admin: Depth and lag of the pending stats refresh queue.
+    """
+    return stats_worker.status()
+
+@router.get("/admin/graph-index", response_model=dict)
+def get_graph_index_status(
+    current_user: auth.Principal = Depends(auth.require_role(["super_admin"])),
+):
+    """
+    Admin: State of the in-memory graph index (GRAPH_INDEX_ENABLED).
+    """
+    return graph_index.status()
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+async def _subtree_version(db: AsyncSession, user_id: int) -> Optional[int]:
+    """Current subtree version of a user, or None without a stats row."""
+    return await db.scalar(
+        select(func.coalesce(models.ReferralStat.subtree_version, 0))
+        .where(models.ReferralStat.user_id == user_id)
+    )
+
+def _cache_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+def _cached_response(etag: str, if_none_match: Optional[str]) -> Optional[Response]:
+    """
+    A 304 if the client already has this version, the cached body if the
+    server has it, otherwise None.
+    """
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=_cache_headers(etag))
+    body = response_cache.get(etag)
+    if body is not None:
+        return Response(body, media_type="application/json", headers=_cache_headers(etag))
+    return None
+
+def _cache_response(etag: str, body: bytes) -> Response:
+    response_cache.put(etag, body)
+    return Response(body, media_type="application/json", headers=_cache_headers(etag))
 
 @router.get("/tree", response_model=List[dict])
-def get_referral_tree(
+async def get_referral_tree(
     depth: int = 3,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
+    nested: bool = False,
+    if_none_match: Optional[str] = Header(None),
+    current_user: auth.Principal = Depends(auth.get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get the referral tree for the current user.
+    nested=true returns it as a hierarchy with 'children' lists.
+    The response carries an ETag derived from the user's subtree version;
+    a matching If-None-Match gets a 304.
     """
     if depth > 20:
         raise HTTPException(status_code=400, detail="Max depth is 20")
-    
-    # Logic: get downline
-    # We use a custom service to handle recursive queries
-    # In a real app, this should return a nested structure or flat list with level indicators
-    # The service returns a list of users with 'level'
-    
-    tree = ReferralService.get_referral_tree(db, current_user.id, max_depth=depth)
-    return tree
+
+    version = await _subtree_version(db, current_user.id)
+    etag = None
+    if version is not None:
+        etag = f'"tree-{current_user.id}-{depth}-{int(nested)}-{version}"'
+        cached = _cached_response(etag, if_none_match)
+        if cached is not None:
+            return cached
+
+    # The service returns a flat list of users with 'level'
+    tree = await db.run_sync(ReferralService.get_referral_tree, current_user.id, max_depth=depth)
+    if nested:
+        tree = ReferralService.build_nested(tree)
+    if etag is None:
+        return tree
+    return _cache_response(etag, json.dumps(tree).encode())
+
+@router.get("/upline", response_model=List[dict])
+async def get_upline(
+    depth: int = 20,
+    current_user: auth.Principal = Depends(auth.get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    The current user's sponsors, nearest first; 'level' counts the steps up.
+    """
+    if depth > 20:
+        raise HTTPException(status_code=400, detail="Max depth is 20")
+    return await db.run_sync(ReferralService.get_upline_nodes, current_user.id, max_depth=depth)
+
+@router.get("/children", response_model=List[dict])
+async def get_children(
+    parent_id: Optional[int] = None,
+    current_user: auth.Principal = Depends(auth.get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Direct referrals of one node, for expanding the network view on demand.
+    Each child carries total_team_size, total_directs and has_children.
+    Defaults to the current user's directs; the super admin may pass no
+    parent_id to list the root users. Users may only expand nodes in their
+    own downline.
+    """
+    if parent_id is None:
+        if current_user.role != "super_admin":
+            parent_id = current_user.id
+    elif current_user.role != "super_admin":
+        if not await db.run_sync(ReferralService.is_in_downline, current_user.id, parent_id):
+            raise HTTPException(status_code=403, detail="Not in your network")
+
+    return await db.run_sync(ReferralService.get_children, parent_id)
 
 @router.get("/stats", response_model=schemas.ReferralStatsResponse)
-def get_referral_stats(
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
+async def get_referral_stats(
+    if_none_match: Optional[str] = Header(None),
+    current_user: auth.Principal = Depends(auth.get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get referral statistics for current user.
     If stats are missing, calculate them on the fly (or return defaults).
+    Carries an ETag like /tree and honors If-None-Match.
     """
-    stat = db.query(models.ReferralStat).filter(models.ReferralStat.user_id == current_user.id).first()
+    version = await _subtree_version(db, current_user.id)
+    etag = None
+    if version is not None:
+        etag = f'"stats-{current_user.id}-{version}"'
+        cached = _cached_response(etag, if_none_match)
+        if cached is not None:
+            return cached
+
+    # Per-level counts are a relationship; load them up front on the async session
+    stat_query = select(models.ReferralStat).options(
+        selectinload(models.ReferralStat.levels)
+    ).where(models.ReferralStat.user_id == current_user.id)
+    stat = await db.scalar(stat_query)
     
     if not stat:
         # Generate on fly if missing (fallback)
-        ReferralService.update_stats(db, current_user.id)
-        stat = db.query(models.ReferralStat).filter(models.ReferralStat.user_id == current_user.id).first()
+        await db.run_sync(ReferralService.update_stats, current_user.id)
+        stat = await db.scalar(stat_query)
         if not stat:
-             return {"total_directs": 0, "total_team_size": 0, "level_breakdown": {}}
+             return {"total_directs": 0, "total_team_size": 0, "level_breakdown": {},
+                     "active_directs": 0, "active_team_size": 0, "active_level_breakdown": {}}
+        etag = f'"stats-{current_user.id}-{stat.subtree_version or 0}"'
 
-    return stat
+    return _cache_response(etag, schemas.ReferralStatsResponse.model_validate(stat).model_dump_json().encode())
 
 @router.get("/link")
 def get_referral_link(
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     # Construct link. In production, use env var for domain.
     base_url = "https://domain.com/register"
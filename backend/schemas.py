@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
 class UserCreate(BaseModel):
     email: EmailStr
@@ -36,10 +36,25 @@ class AdminCreate(BaseModel):
     password: str
     permissions: Dict
 
+class UserUpdate(BaseModel):
+    role: Optional[str] = None
+    is_active: Optional[bool] = None
+    permissions: Optional[Dict] = None
+
+class BulkActivation(BaseModel):
+    user_ids: List[int]
+    is_active: bool
+
+class SubtreeMove(BaseModel):
+    new_referrer_id: Optional[int] = None  # None makes the user a root
+
 class ReferralStatsResponse(BaseModel):
     total_directs: int
     total_team_size: int
     level_breakdown: Dict[str, int]
+    active_directs: int = 0
+    active_team_size: int = 0
+    active_level_breakdown: Dict[str, int] = {}
 
     class Config:
         from_attributes = True
@@ -0,0 +1,343 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.orm import Session
+
+from models import User, ReferralStat, ReferralClosure
+from services.referral_service import ReferralService, MAX_LEVELS, count_active
+from services.password_service import hash_password
+from services.counter_service import CounterService
+from services.referral_codes import ReferralCodeAllocator
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_HASH_WORKERS = int(os.getenv("IMPORT_HASH_WORKERS", str(os.cpu_count() or 1)))
+
+# Chunk size for IN (...) lookups, well below SQLite's bound parameter limit
+LOOKUP_CHUNK_SIZE = 500
+
+IMPORT_FORMATS = ("csv", "jsonl")
+
+# Fields that must be text when present (JSON-lines rows can hold anything)
+TEXT_FIELDS = ("email", "username", "password", "hashed_password", "referral_code", "referrer_code")
+
+
+def _chunks(items: List[Any], size: int) -> Iterable[List[Any]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _parse_active(value: Any) -> Optional[bool]:
+    """
+    is_active of a row: missing, null or a blank cell means the default
+    (active). None for a value that is not a recognisable boolean.
+    """
+    if value is None or isinstance(value, bool):
+        return True if value is None else value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in ("", "1", "true", "yes", "y", "t"):
+            return True
+        if text in ("0", "false", "no", "n", "f"):
+            return False
+    return None
+
+
+class BulkImportService:
+    @staticmethod
+    def parse_rows(data: str, fmt: str) -> List[Dict[str, Any]]:
+        """
+        Parse a CSV (with header) or JSON-lines document into row dicts.
+        Recognised fields: email, username, password or hashed_password,
+        referral_code (the user's own, optional), referrer_code and is_active.
+        """
+        if fmt == "csv":
+            return [dict(row) for row in csv.DictReader(io.StringIO(data))]
+        if fmt == "jsonl":
+            return [json.loads(line) for line in data.splitlines() if line.strip()]
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+    @staticmethod
+    def _lookup(db: Session, column, values: Iterable[str]) -> Dict[str, int]:
+        """
+        Map existing values of a unique users column to user ids, in chunks.
+        """
+        found = {}
+        for chunk in _chunks(list(set(values)), LOOKUP_CHUNK_SIZE):
+            for value, uid in db.execute(select(column, User.id).where(column.in_(chunk))):
+                found[value] = uid
+        return found
+
+    @staticmethod
+    def _hash_passwords(passwords: List[str], workers: int) -> List[str]:
+        if workers <= 1 or len(passwords) < workers * 2:
+            return [hash_password(p) for p in passwords]
+        chunksize = max(1, len(passwords) // (workers * 4))
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            return list(pool.map(hash_password, passwords, chunksize=chunksize))
+
+    @staticmethod
+    def import_users(
+        db: Session,
+        rows: List[Dict[str, Any]],
+        batch_size: int = IMPORT_BATCH_SIZE,
+        hash_workers: int = IMPORT_HASH_WORKERS,
+    ) -> Dict[str, Any]:
+        """
+        Import users with known referrers in one transaction.
+
+        Rows are validated, ordered parent-first (a referrer_code may point at an
+        existing user or at another row of the same import), hashed in a process
+        pool and inserted in bulk batches per generation. The closure index is
+        extended per batch and the referral_stats of the new users and of their
+        existing uplines are computed once at the end.
+        """
+        errors = []
+        valid = []
+
+        def reject(line, message):
+            errors.append({"row": line, "error": message})
+
+        # 1. Validate rows and duplicates within the file
+        seen_emails, seen_usernames = set(), set()
+        for line, row in enumerate(rows, start=1):
+            if not isinstance(row, dict):
+                reject(line, "Row must be an object")
+                continue
+            not_text = [f for f in TEXT_FIELDS if row.get(f) is not None and not isinstance(row[f], str)]
+            if not_text:
+                reject(line, f"{', '.join(not_text)} must be text")
+                continue
+            is_active = _parse_active(row.get("is_active"))
+            if is_active is None:
+                reject(line, "is_active must be true or false")
+                continue
+            email = (row.get("email") or "").strip()
+            username = (row.get("username") or "").strip()
+            if not email or not username:
+                reject(line, "email and username are required")
+                continue
+            if not row.get("password") and not row.get("hashed_password"):
+                reject(line, "password or hashed_password is required")
+                continue
+            if email in seen_emails or username in seen_usernames:
+                reject(line, "Duplicate email or username in import")
+                continue
+            seen_emails.add(email)
+            seen_usernames.add(username)
+            valid.append({
+                "line": line,
+                "email": email,
+                "username": username,
+                "password": row.get("password"),
+                "hashed_password": row.get("hashed_password"),
+                "referral_code": (row.get("referral_code") or "").strip() or None,
+                "referrer_code": (row.get("referrer_code") or "").strip() or None,
+                "is_active": is_active,
+            })
+
+        # 2. Drop rows clashing with existing users
+        existing_emails = BulkImportService._lookup(db, User.email, [r["email"] for r in valid])
+        existing_usernames = BulkImportService._lookup(db, User.username, [r["username"] for r in valid])
+        candidates = []
+        for r in valid:
+            if r["email"] in existing_emails:
+                reject(r["line"], "Email already registered")
+            elif r["username"] in existing_usernames:
+                reject(r["line"], "Username already taken")
+            else:
+                candidates.append(r)
+
+        # 3. Give every row a referral code that is unique in the file and the DB
+        own_codes = [r["referral_code"] for r in candidates if r["referral_code"]]
+        taken = set(BulkImportService._lookup(db, User.referral_code, own_codes))
+        file_codes = set()
+        for r in candidates:
+            code = r["referral_code"]
+            if code and (code in taken or code in file_codes):
+                reject(r["line"], f"Referral code {code} already in use")
+                r["rejected"] = True
+                continue
+            if code:
+                file_codes.add(code)
+        candidates = [r for r in candidates if not r.get("rejected")]
+
+        # Allocated codes only need checking against explicit and legacy codes
+        pending = [r for r in candidates if not r["referral_code"]]
+        while pending:
+            for r, code in zip(pending, ReferralCodeAllocator.allocate(db, len(pending))):
+                r["referral_code"] = code
+            generated = [r["referral_code"] for r in pending]
+            clashes = set(BulkImportService._lookup(db, User.referral_code, generated))
+            retry = []
+            for r in pending:
+                if r["referral_code"] in clashes or r["referral_code"] in file_codes:
+                    retry.append(r)
+                else:
+                    file_codes.add(r["referral_code"])
+            pending = retry
+
+        # 4. Order parent-first: generation 0 hangs off existing users (or no one)
+        by_code = {r["referral_code"]: r for r in candidates}
+        external = BulkImportService._lookup(
+            db, User.referral_code,
+            [r["referrer_code"] for r in candidates if r["referrer_code"] and r["referrer_code"] not in by_code],
+        )
+        children = {}
+        generation = []
+        for r in candidates:
+            ref = r["referrer_code"]
+            if ref is None or ref in external:
+                generation.append(r)
+            elif ref in by_code:
+                children.setdefault(ref, []).append(r)
+            else:
+                reject(r["line"], f"Unknown referrer code {ref}")
+
+        generations = []
+        while generation:
+            generations.append(generation)
+            generation = [c for r in generation for c in children.pop(r["referral_code"], [])]
+
+        # Whatever is still waiting hangs off a rejected row or sits in a cycle
+        for waiting in children.values():
+            for r in waiting:
+                reject(r["line"], f"Referrer {r['referrer_code']} was not imported")
+
+        # 5. Hash the plain passwords in a process pool
+        to_hash = [r for gen in generations for r in gen if not r["hashed_password"]]
+        hashes = BulkImportService._hash_passwords([r["password"] for r in to_hash], hash_workers)
+        for r, hashed in zip(to_hash, hashes):
+            r["hashed_password"] = hashed
+
+        # 6. Insert generation by generation so parent ids are always known
+        code_to_id = dict(external)
+        new_ids = []
+        for gen in generations:
+            for batch in _chunks(gen, batch_size):
+                values = [{
+                    "email": r["email"],
+                    "username": r["username"],
+                    "hashed_password": r["hashed_password"],
+                    "role": "user",
+                    "is_active": r["is_active"],
+                    "permissions": {},
+                    "referral_code": r["referral_code"],
+                    "referred_by_id": code_to_id.get(r["referrer_code"]),
+                } for r in batch]
+                result = db.execute(insert(User).returning(User.id, User.referral_code), values)
+                batch_ids = []
+                for uid, code in result:
+                    code_to_id[code] = uid
+                    batch_ids.append(uid)
+                new_ids.extend(batch_ids)
+
+                # Extend the closure index: self rows plus the parents' ancestors
+                db.execute(insert(ReferralClosure), [
+                    {"ancestor_id": uid, "descendant_id": uid, "depth": 0} for uid in batch_ids
+                ])
+                db.execute(
+                    insert(ReferralClosure).from_select(
+                        ["ancestor_id", "descendant_id", "depth"],
+                        select(
+                            ReferralClosure.ancestor_id,
+                            User.id,
+                            ReferralClosure.depth + 1,
+                        ).join(
+                            User, User.referred_by_id == ReferralClosure.descendant_id
+                        ).where(
+                            User.id.in_(batch_ids),
+                            ReferralClosure.depth < MAX_LEVELS,
+                        ),
+                    )
+                )
+
+        # 7. One pass over the closure for the stats of everyone affected
+        affected = set(new_ids)
+        for chunk in _chunks(new_ids, LOOKUP_CHUNK_SIZE):
+            affected.update(
+                uid for (uid,) in db.execute(
+                    select(ReferralClosure.ancestor_id).where(
+                        ReferralClosure.descendant_id.in_(chunk),
+                        ReferralClosure.depth > 0,
+                    ).distinct()
+                )
+            )
+        BulkImportService.write_stats(db, sorted(affected), batch_size)
+
+        imported = [r for gen in generations for r in gen]
+        CounterService.record_users_created(
+            db,
+            created=len(imported),
+            active=sum(1 for r in imported if r["is_active"]),
+            referred=sum(1 for r in imported if r["referrer_code"]),
+        )
+        db.commit()
+        return {
+            "created": len(new_ids),
+            "generations": len(generations),
+            "stats_updated": len(affected),
+            "errors": errors,
+        }
+
+    @staticmethod
+    def write_stats(db: Session, user_ids: List[int], batch_size: int = IMPORT_BATCH_SIZE):
+        """
+        Recompute referral_stats for the given users from the closure index and
+        write them with bulk UPDATE/INSERT statements.
+        """
+        levels = {uid: {} for uid in user_ids}
+        active_levels = {uid: {} for uid in user_ids}
+        for chunk in _chunks(user_ids, LOOKUP_CHUNK_SIZE):
+            rows = db.execute(
+                select(
+                    ReferralClosure.ancestor_id,
+                    ReferralClosure.depth,
+                    func.count(),
+                    count_active(),
+                ).join(
+                    User, User.id == ReferralClosure.descendant_id
+                ).where(
+                    ReferralClosure.ancestor_id.in_(chunk),
+                    ReferralClosure.depth.between(1, MAX_LEVELS),
+                ).group_by(ReferralClosure.ancestor_id, ReferralClosure.depth)
+            )
+            for uid, depth, count, active in rows:
+                levels[uid][str(depth)] = count
+                if active:
+                    active_levels[uid][str(depth)] = active
+
+        existing = {}
+        for chunk in _chunks(user_ids, LOOKUP_CHUNK_SIZE):
+            for stat_id, uid in db.execute(
+                select(ReferralStat.id, ReferralStat.user_id).where(ReferralStat.user_id.in_(chunk))
+            ):
+                existing[uid] = stat_id
+
+        updates, inserts = [], []
+        for uid, level_counts in levels.items():
+            values = {
+                "total_directs": level_counts.get("1", 0),
+                "total_team_size": sum(level_counts.values()),
+                "active_directs": active_levels[uid].get("1", 0),
+                "active_team_size": sum(active_levels[uid].values()),
+            }
+            if uid in existing:
+                updates.append({"id": existing[uid], **values})
+            else:
+                inserts.append({"user_id": uid, **values})
+
+        for batch in _chunks(updates, batch_size):
+            db.execute(update(ReferralStat), batch)
+        for batch in _chunks(inserts, batch_size):
+            db.execute(insert(ReferralStat), batch)
+        ReferralService.write_level_counts(db, levels, active_levels)
+        ReferralService.bump_subtree_versions(db, list(existing))
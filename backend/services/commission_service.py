@@ -0,0 +1,255 @@
+import csv
+import io
+import os
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.orm import Session
+
+from models import User, Trade, CommissionLevel, CommissionRun, CommissionPayout
+from services.referral_service import MAX_LEVELS
+
+COMMISSION_BATCH_SIZE = int(os.getenv("COMMISSION_BATCH_SIZE", "5000"))
+
+# Defaults of the distributions page: 5% direct bonus plus 0.5% on each of 20 levels
+DEFAULT_LEVEL_PERCENTS = [5.5] + [0.5] * (MAX_LEVELS - 1)
+
+TRADE_FORMATS = ("csv", "parquet")
+
+# Rejected trade rows listed in a run's report; the count covers all of them
+REJECTED_SAMPLE_SIZE = 20
+
+
+class CommissionService:
+    @staticmethod
+    def get_level_percents(db: Session) -> List[float]:
+        """Percent per upline level, index 0 = level 1 (the direct referrer)."""
+        rows = db.execute(select(CommissionLevel.level, CommissionLevel.percent)).all()
+        if not rows:
+            return list(DEFAULT_LEVEL_PERCENTS)
+        percents = [0.0] * MAX_LEVELS
+        for level, percent in rows:
+            if 1 <= level <= MAX_LEVELS:
+                percents[level - 1] = percent
+        return percents
+
+    @staticmethod
+    def set_level_percents(db: Session, percents: List[float]) -> List[float]:
+        if len(percents) > MAX_LEVELS:
+            raise ValueError(f"At most {MAX_LEVELS} levels")
+        if any(p < 0 for p in percents):
+            raise ValueError("Percentages cannot be negative")
+        if sum(percents) > 100:
+            raise ValueError("Percentages add up to more than 100")
+        db.execute(delete(CommissionLevel))
+        db.execute(insert(CommissionLevel), [
+            {"level": level, "percent": percent} for level, percent in enumerate(percents, start=1)
+        ])
+        db.commit()
+        return CommissionService.get_level_percents(db)
+
+    @staticmethod
+    def parse_trades(data: bytes, fmt: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (user_ids, volumes) from a CSV with user_id and volume columns, or a
+        Parquet file with the same columns. Rows may repeat a user.
+        """
+        if fmt == "csv":
+            rows = csv.DictReader(io.StringIO(data.decode("utf-8")))
+            missing = {"user_id", "volume"} - set(rows.fieldnames or ())
+            if missing:
+                raise ValueError(f"Missing column(s): {', '.join(sorted(missing))}")
+            user_ids, volumes = [], []
+            for row in rows:
+                try:
+                    user_ids.append(int(row["user_id"]))
+                    volumes.append(float(row["volume"]))
+                except (TypeError, ValueError):
+                    raise ValueError(
+                        f"Line {rows.line_num}: expected a numeric user_id and volume, "
+                        f"got {row['user_id']!r} and {row['volume']!r}"
+                    )
+            return np.array(user_ids, dtype=np.int64), np.array(volumes, dtype=np.float64)
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            table = pq.read_table(io.BytesIO(data), columns=["user_id", "volume"])
+            return (
+                table.column("user_id").to_numpy().astype(np.int64),
+                table.column("volume").to_numpy().astype(np.float64),
+            )
+        raise ValueError(f"Unsupported trades format: {fmt}")
+
+    @staticmethod
+    def load_trades(db: Session, run_date: date) -> Tuple[np.ndarray, np.ndarray]:
+        """(user_ids, volumes) summed per user from the trades table for one day."""
+        rows = db.execute(
+            select(Trade.user_id, func.sum(Trade.volume))
+            .where(Trade.trade_date == run_date)
+            .group_by(Trade.user_id)
+        ).all()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        user_ids, volumes = zip(*rows)
+        return np.array(user_ids, dtype=np.int64), np.array(volumes, dtype=np.float64)
+
+    @staticmethod
+    def parent_array(db: Session) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        parent[id] (0 for roots and unused ids), active[id] and exists[id]
+        over all users, indexed by user id, read in the run's transaction.
+        """
+        rows = db.execute(select(User.id, User.referred_by_id, User.is_active)).all()
+        size = max((uid for uid, _, _ in rows), default=0) + 1
+        active = np.zeros(size, dtype=bool)
+        if rows:
+            ids = np.fromiter((uid for uid, _, _ in rows), dtype=np.int64, count=len(rows))
+            active[ids] = np.fromiter((bool(a) for _, _, a in rows), dtype=bool, count=len(rows))
+
+        parent = np.zeros(size, dtype=np.int64)
+        if rows:
+            parent[ids] = np.fromiter((p or 0 for _, p, _ in rows), dtype=np.int64, count=len(rows))
+        # Referrers that no longer exist end the chain
+        parent[(parent < 0) | (parent >= size)] = 0
+        exists = np.zeros(size, dtype=bool)
+        if rows:
+            exists[ids] = True
+        parent[~exists[parent]] = 0
+        return parent, active, exists
+
+    @staticmethod
+    def check_trades(exists: np.ndarray, user_ids: np.ndarray,
+                     volumes: np.ndarray) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """
+        Mask of the trade rows a run can use, and why each other row is
+        rejected: an unknown user id, or a volume that is negative or not a
+        number. Rows are numbered from 1 in input order.
+        """
+        known = (user_ids > 0) & (user_ids < len(exists))
+        known[known] = exists[user_ids[known]]
+        valid_volume = np.isfinite(volumes) & (volumes >= 0)
+        rejected = []
+        for i in np.flatnonzero(~(known & valid_volume)).tolist():
+            if not known[i]:
+                error = f"Unknown user {int(user_ids[i])}"
+            else:
+                error = f"Volume must be a non-negative number, got {float(volumes[i])}"
+            rejected.append({"row": i + 1, "user_id": int(user_ids[i]), "error": error})
+        return known & valid_volume, rejected
+
+    @staticmethod
+    def compute_payouts(parent: np.ndarray, active: np.ndarray, user_ids: np.ndarray, volumes: np.ndarray,
+                        percents: List[float]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Walk every trader's upline one level at a time, all traders at once.
+        Returns, per level, the (recipients, volume, amount) arrays of that
+        level. Inactive uplines are skipped: their share is not paid, and the
+        walk continues above them.
+        """
+        size = len(parent)
+        known = (user_ids > 0) & (user_ids < size)
+        volume = np.bincount(user_ids[known], weights=volumes[known], minlength=size)
+
+        traders = np.flatnonzero(volume)
+        current = traders
+        carried = volume[traders]
+        levels = []
+        for percent in percents:
+            current = parent[current]
+            reached = current > 0
+            current, carried = current[reached], carried[reached]
+            if not len(current):
+                break
+            paid = active[current]
+            level_volume = np.bincount(current[paid], weights=carried[paid], minlength=size)
+            recipients = np.flatnonzero(level_volume)
+            level_volume = level_volume[recipients]
+            levels.append((recipients, level_volume, level_volume * (percent / 100.0)))
+        return levels
+
+    @staticmethod
+    def distribute(db: Session, run_date: date, user_ids: np.ndarray, volumes: np.ndarray,
+                   source: str = "trades", replace: bool = False,
+                   batch_size: int = COMMISSION_BATCH_SIZE) -> Dict[str, Any]:
+        """
+        Settle one day's volume: resolve every upline with the parent array,
+        apply the level percentages and bulk-write the payout ledger, all in
+        one transaction. Rows for unknown users or with an invalid volume are
+        left out and reported. A date can only be settled once unless replace=True,
+        which deletes that day's previous ledger first.
+        """
+        existing = db.scalar(select(CommissionRun).where(CommissionRun.run_date == run_date))
+        if existing is not None:
+            if not replace:
+                raise ValueError(f"Commissions for {run_date} were already distributed (run {existing.id})")
+            db.execute(delete(CommissionPayout).where(CommissionPayout.run_id == existing.id))
+            db.delete(existing)
+            db.flush()
+
+        percents = CommissionService.get_level_percents(db)
+        parent, active, exists = CommissionService.parent_array(db)
+        # Totals and payouts only cover the rows that pass
+        used, rejected = CommissionService.check_trades(exists, user_ids, volumes)
+        user_ids, volumes = user_ids[used], volumes[used]
+        levels = CommissionService.compute_payouts(parent, active, user_ids, volumes, percents)
+
+        run = CommissionRun(
+            run_date=run_date,
+            source=source,
+            traders=int(np.unique(user_ids).size),
+            total_volume=float(volumes.sum()),
+            level_percents=percents,
+        )
+        db.add(run)
+        db.flush()
+
+        payouts = 0
+        total_paid = 0.0
+        for level, (recipients, level_volume, amounts) in enumerate(levels, start=1):
+            keep = amounts > 0
+            recipients, level_volume, amounts = recipients[keep], level_volume[keep], amounts[keep]
+            total_paid += float(amounts.sum())
+            for i in range(0, len(recipients), batch_size):
+                rows = [
+                    {"run_id": run.id, "user_id": uid, "level": level, "volume": vol, "amount": amount}
+                    for uid, vol, amount in zip(
+                        recipients[i:i + batch_size].tolist(),
+                        level_volume[i:i + batch_size].tolist(),
+                        amounts[i:i + batch_size].tolist(),
+                    )
+                ]
+                db.execute(insert(CommissionPayout), rows)
+                payouts += len(rows)
+
+        run.payouts = payouts
+        run.total_paid = total_paid
+        db.commit()
+        return {
+            "run_id": run.id,
+            "run_date": run_date.isoformat(),
+            "traders": run.traders,
+            "total_volume": run.total_volume,
+            "total_paid": total_paid,
+            "payouts": payouts,
+            "levels_reached": len(levels),
+            "rejected": len(rejected),
+            "rejected_rows": rejected[:REJECTED_SAMPLE_SIZE],
+        }
+
+    @staticmethod
+    def get_runs(db: Session, limit: int = 30) -> List[CommissionRun]:
+        return db.scalars(select(CommissionRun).order_by(CommissionRun.run_date.desc()).limit(limit)).all()
+
+    @staticmethod
+    def get_user_payouts(db: Session, user_id: int, run_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        stmt = select(
+            CommissionPayout.run_id,
+            CommissionRun.run_date,
+            CommissionPayout.level,
+            CommissionPayout.volume,
+            CommissionPayout.amount,
+        ).join(CommissionRun, CommissionRun.id == CommissionPayout.run_id).where(CommissionPayout.user_id == user_id)
+        if run_id is not None:
+            stmt = stmt.where(CommissionPayout.run_id == run_id)
+        return [dict(row) for row in db.execute(stmt.order_by(CommissionRun.run_date.desc(), CommissionPayout.level)).mappings()]
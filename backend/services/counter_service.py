@@ -0,0 +1,132 @@
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import User, SystemCounter
+from services.periodic import PeriodicJob
+
+TOTAL_USERS = "total_users"
+ACTIVE_USERS = "active_users"
+TOTAL_REFERRALS = "total_referrals"
+# Bumped by every subtree move, so graph index copies know to reload
+GRAPH_MOVES = "graph_moves"
+SIGNUPS_PREFIX = "signups:"
+
+COUNTER_RECONCILE_INTERVAL = float(os.getenv("COUNTER_RECONCILE_INTERVAL", "3600"))
+
+
+def signups_key(day) -> str:
+    return f"{SIGNUPS_PREFIX}{day.isoformat()}"
+
+
+class CounterService:
+    @staticmethod
+    def increment(db: Session, name: str, delta: int = 1) -> Optional[int]:
+        """
+        Atomically add `delta` to a counter, creating it if needed, and return
+        the new value. Runs in the caller's transaction.
+        """
+        if not delta:
+            return None
+        dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+        stmt = dialect.insert(SystemCounter).values(name=name, value=delta)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SystemCounter.name],
+            set_={"value": SystemCounter.value + delta},
+        ).returning(SystemCounter.value)
+        return db.execute(stmt).scalar_one()
+
+    @staticmethod
+    def record_users_created(db: Session, created: int = 1, active: int = 1, referred: int = 0):
+        today = datetime.utcnow().date()
+        CounterService.increment(db, TOTAL_USERS, created)
+        CounterService.increment(db, ACTIVE_USERS, active)
+        CounterService.increment(db, TOTAL_REFERRALS, referred)
+        CounterService.increment(db, signups_key(today), created)
+
+    @staticmethod
+    def record_activation_change(db: Session, delta: int):
+        """delta is +1 per user activated and -1 per user deactivated."""
+        CounterService.increment(db, ACTIVE_USERS, delta)
+
+    @staticmethod
+    def get_counters(db: Session) -> Dict[str, int]:
+        return {name: value for name, value in db.execute(select(SystemCounter.name, SystemCounter.value))}
+
+    @staticmethod
+    def compute(db: Session) -> Dict[str, int]:
+        """
+        Recompute every counter with full scans of users.
+        """
+        total_users = db.query(func.count(User.id)).scalar()
+        active_users = db.query(func.count(User.id)).filter(User.is_active == True).scalar()
+        total_referrals = db.query(func.count(User.id)).filter(User.referred_by_id != None).scalar()
+        counters = {
+            TOTAL_USERS: total_users,
+            ACTIVE_USERS: active_users,
+            TOTAL_REFERRALS: total_referrals,
+        }
+        signup_day = func.date(User.created_at)
+        rows = db.query(signup_day, func.count(User.id)).filter(
+            User.created_at != None
+        ).group_by(signup_day).all()
+        for day, count in rows:
+            counters[f"{SIGNUPS_PREFIX}{day}"] = count
+        return counters
+
+    @staticmethod
+    def reconcile(db: Session) -> Dict[str, Dict[str, int]]:
+        """
+        Correct the stored counters to freshly computed values.
+        Returns the counters that had drifted as {name: {"stored", "actual"}}.
+        """
+        # Write to every counter row before reading anything: that takes
+        # SQLite's write lock (SELECT ... FOR UPDATE is a no-op there) and
+        # the row locks elsewhere, so no increment commits between the
+        # recount and the correction
+        db.execute(update(SystemCounter).values(value=SystemCounter.value))
+        stored = CounterService.get_counters(db)
+        actual = CounterService.compute(db)
+        drift = {}
+        for name, value in actual.items():
+            if stored.get(name) != value:
+                drift[name] = {"stored": stored.get(name), "actual": value}
+                # As a delta, so a counter created meanwhile is not overwritten
+                CounterService.increment(db, name, value - stored.get(name, 0))
+        db.commit()
+        return drift
+
+    @staticmethod
+    def get_summary(db: Session, days: int = 7) -> Dict[str, object]:
+        """
+        System-wide stats for the admin dashboard from one counters read.
+        """
+        counters = CounterService.get_counters(db)
+        today = datetime.utcnow().date()
+        signups_by_day = {}
+        for offset in range(days):
+            day = today - timedelta(days=offset)
+            signups_by_day[day.isoformat()] = counters.get(signups_key(day), 0)
+        return {
+            "total_users": counters.get(TOTAL_USERS, 0),
+            "active_users": counters.get(ACTIVE_USERS, 0),
+            "total_referrals_made": counters.get(TOTAL_REFERRALS, 0),
+            "signups_today": signups_by_day[today.isoformat()],
+            "signups_by_day": signups_by_day,
+        }
+
+
+def _reconcile_counters():
+    db = SessionLocal()
+    try:
+        CounterService.reconcile(db)
+    finally:
+        db.close()
+
+
+counter_reconciler = PeriodicJob("counter-reconciler", COUNTER_RECONCILE_INTERVAL, _reconcile_counters)
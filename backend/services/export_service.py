@@ -0,0 +1,242 @@
+import csv
+import io
+import os
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+from sqlalchemy import select, union_all, literal, func, and_, true
+from sqlalchemy.orm import Session
+
+from models import User, ReferralStat, ReferralLevelStat, ExportWatermark
+from services.referral_service import MAX_LEVELS
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "10000"))
+
+# updated_at is stamped at flush, so a row can commit after an export that
+# started later has read past it. Incremental exports reach back this many
+# seconds before the watermark; rows in the overlap are exported twice.
+EXPORT_WATERMARK_MARGIN = float(os.getenv("EXPORT_WATERMARK_MARGIN", "300"))
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+# Column name and Parquet type of every dataset, in export order
+EXPORT_DATASETS = {
+    "users": [
+        ("id", "int64"),
+        ("username", "string"),
+        ("email", "string"),
+        ("role", "string"),
+        ("is_active", "bool"),
+        ("referral_code", "string"),
+        ("referred_by_id", "int64"),
+        ("created_by", "int64"),
+        ("created_at", "timestamp"),
+        ("updated_at", "timestamp"),
+    ],
+    "links": [
+        ("user_id", "int64"),
+        ("referred_by_id", "int64"),
+    ],
+    "stats": [
+        ("user_id", "int64"),
+        ("total_directs", "int64"),
+        ("total_team_size", "int64"),
+        ("active_directs", "int64"),
+        ("active_team_size", "int64"),
+        ("subtree_version", "int64"),
+        ("updated_at", "timestamp"),
+    ],
+    "levels": [
+        ("user_id", "int64"),
+        ("level", "int64"),
+        ("count", "int64"),
+        ("active_count", "int64"),
+    ],
+}
+
+
+class _ChunkSink:
+    """Write-only file object that hands out what was written so far."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+class NetworkExport:
+    """
+    One export of a dataset, read in chunks from a server-side cursor and
+    encoded one chunk at a time, so memory stays bounded by the chunk size.
+
+    With `since`, only rows changed since then (less EXPORT_WATERMARK_MARGIN)
+    are exported: users and stats rows by updated_at, and all MAX_LEVELS
+    levels of every user whose stats changed, zeros included, so a level
+    that emptied is exported as 0 rather than left out. started_at, taken
+    before the first read, becomes the next watermark: rows changed while
+    the export runs are exported again next time rather than missed.
+    """
+
+    def __init__(self, dataset: str, fmt: str = "csv", since: Optional[datetime] = None,
+                 chunk_size: int = EXPORT_CHUNK_SIZE):
+        if dataset not in EXPORT_DATASETS:
+            raise ValueError(f"Unknown dataset: {dataset}")
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format: {fmt}")
+        self.dataset = dataset
+        self.fmt = fmt
+        self.since = since
+        self.chunk_size = chunk_size
+        self.started_at = datetime.utcnow()
+        self.rows = 0
+        self.complete = False
+
+    @property
+    def columns(self) -> List[str]:
+        return [name for name, _ in EXPORT_DATASETS[self.dataset]]
+
+    def statement(self):
+        since = self.since
+        if since is not None:
+            since -= timedelta(seconds=EXPORT_WATERMARK_MARGIN)
+        if self.dataset == "users":
+            stmt = select(
+                User.id, User.username, User.email, User.role, User.is_active, User.referral_code,
+                User.referred_by_id, User.created_by, User.created_at, User.updated_at,
+            )
+            if since is not None:
+                stmt = stmt.where(User.updated_at >= since)
+            return stmt.order_by(User.id)
+        if self.dataset == "links":
+            stmt = select(User.id, User.referred_by_id)
+            if since is not None:
+                stmt = stmt.where(User.updated_at >= since)
+            return stmt.order_by(User.id)
+        if self.dataset == "stats":
+            stmt = select(
+                ReferralStat.user_id, ReferralStat.total_directs, ReferralStat.total_team_size,
+                ReferralStat.active_directs, ReferralStat.active_team_size, ReferralStat.subtree_version,
+                ReferralStat.updated_at,
+            )
+            if since is not None:
+                stmt = stmt.where(ReferralStat.updated_at >= since)
+            return stmt.order_by(ReferralStat.user_id)
+        if since is not None:
+            # Every level of every changed user, with zeros where no row is left
+            changed = select(ReferralStat.user_id).where(ReferralStat.updated_at >= since).subquery("changed")
+            levels = union_all(
+                *[select(literal(level).label("level")) for level in range(1, MAX_LEVELS + 1)]
+            ).subquery("levels")
+            return select(
+                changed.c.user_id,
+                levels.c.level,
+                func.coalesce(ReferralLevelStat.count, 0).label("count"),
+                func.coalesce(ReferralLevelStat.active_count, 0).label("active_count"),
+            ).select_from(
+                changed.join(levels, true()).outerjoin(
+                    ReferralLevelStat,
+                    and_(ReferralLevelStat.user_id == changed.c.user_id, ReferralLevelStat.level == levels.c.level),
+                )
+            ).order_by(changed.c.user_id, levels.c.level)
+        stmt = select(
+            ReferralLevelStat.user_id, ReferralLevelStat.level, ReferralLevelStat.count,
+            ReferralLevelStat.active_count,
+        ).where(ReferralLevelStat.count > 0)
+        return stmt.order_by(ReferralLevelStat.user_id, ReferralLevelStat.level)
+
+    def iter_chunks(self, db: Session) -> Iterator[List[tuple]]:
+        result = db.execute(self.statement().execution_options(yield_per=self.chunk_size))
+        for chunk in result.partitions():
+            self.rows += len(chunk)
+            yield chunk
+        self.complete = True
+
+    def iter_bytes(self, db: Session) -> Iterator[bytes]:
+        if self.fmt == "csv":
+            return self._iter_csv(db)
+        return self._iter_parquet(db)
+
+    def _iter_csv(self, db: Session) -> Iterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.columns)
+        for chunk in self.iter_chunks(db):
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        # Header only, for an empty export
+        if buffer.tell():
+            yield buffer.getvalue().encode("utf-8")
+
+    def _iter_parquet(self, db: Session) -> Iterator[bytes]:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {"int64": pa.int64(), "string": pa.string(), "bool": pa.bool_(), "timestamp": pa.timestamp("us")}
+        schema = pa.schema([(name, types[kind]) for name, kind in EXPORT_DATASETS[self.dataset]])
+        sink = _ChunkSink()
+        writer = pq.ParquetWriter(sink, schema)
+        try:
+            # One row group per chunk
+            for chunk in self.iter_chunks(db):
+                columns = list(zip(*chunk))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                    schema=schema,
+                ))
+                yield sink.take()
+        finally:
+            writer.close()
+        yield sink.take()
+
+    def save_watermark(self, db: Session, consumer: str):
+        """Record a complete export as `consumer`'s new watermark. Committed here."""
+        if not self.complete:
+            return
+        ExportService.set_watermark(db, consumer, self.dataset, self.started_at, self.rows)
+
+
+class ExportService:
+    @staticmethod
+    def get_watermark(db: Session, consumer: str, dataset: str) -> Optional[datetime]:
+        return db.scalar(
+            select(ExportWatermark.exported_at).where(
+                ExportWatermark.consumer == consumer,
+                ExportWatermark.dataset == dataset,
+            )
+        )
+
+    @staticmethod
+    def set_watermark(db: Session, consumer: str, dataset: str, exported_at: datetime, rows: int):
+        watermark = db.get(ExportWatermark, (consumer, dataset))
+        if watermark is None:
+            watermark = ExportWatermark(consumer=consumer, dataset=dataset)
+            db.add(watermark)
+        watermark.exported_at = exported_at
+        watermark.rows = rows
+        db.commit()
+
+    @staticmethod
+    def get_watermarks(db: Session) -> List[ExportWatermark]:
+        return db.scalars(select(ExportWatermark).order_by(ExportWatermark.consumer, ExportWatermark.dataset)).all()
@@ -0,0 +1,365 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, or_
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import User, SystemCounter
+from services.counter_service import GRAPH_MOVES
+
+logger = logging.getLogger(__name__)
+
+# Off by default: every process holds its own copy of the forest
+GRAPH_INDEX_ENABLED = os.getenv("GRAPH_INDEX_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Children added since the last load live in a side table; past this many the
+# CSR arrays are rebuilt so lookups stay on the compact path
+GRAPH_INDEX_COMPACT_AFTER = int(os.getenv("GRAPH_INDEX_COMPACT_AFTER", "10000"))
+
+# Ids skipped by a sync may still belong to a transaction that commits later;
+# they are looked for again until they are this many seconds old
+GRAPH_INDEX_GAP_TIMEOUT = float(os.getenv("GRAPH_INDEX_GAP_TIMEOUT", "60"))
+# How far below the highest id load() looks for such ids
+GRAPH_INDEX_GAP_WINDOW = 1000
+
+# Reads check the database for other processes' changes at most this often
+# (seconds); changes made through this process are applied right away
+GRAPH_INDEX_SYNC_INTERVAL = float(os.getenv("GRAPH_INDEX_SYNC_INTERVAL", "1.0"))
+
+NO_USER = -1
+NO_PARENT = 0
+
+
+class GraphIndex:
+    """
+    In-process copy of the referral forest as integer arrays indexed by user id:
+
+    - parent[id]: referrer id, NO_PARENT for roots, NO_USER for unused ids
+    - offsets/children: CSR child lists, children[offsets[id]:offsets[id + 1]]
+      in id order, plus `extra` for children added since the last compaction
+    - team[id]: downline size within max_levels, kept current on every add
+
+    `version` increases with every change. Reads call current() first, which
+    syncs at most every GRAPH_INDEX_SYNC_INTERVAL seconds: users with an id
+    above the highest one loaded are picked up with one indexed range query.
+    When the graph_moves counter shows a subtree was moved meanwhile, the
+    index is rebuilt on a background thread and reads fall back to the
+    database until it is ready again, so a reload never runs on a request
+    (or the event loop).
+
+    The index serves reads only: writes to the closure and stats tables take
+    their uplines from the database, inside their own transaction.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self._lock = threading.RLock()
+        self._loader: Optional[threading.Thread] = None
+        self.synced_at = 0.0
+        self.ready = False
+        self.version = 0
+        self.max_levels = 20
+        self._reset()
+
+    def _reset(self):
+        self.parent = array("q")
+        self.team = array("q")
+        self.offsets = array("q", [0])
+        self.children = array("q")
+        self.extra: Dict[int, List[int]] = {}
+        self.extra_count = 0
+        self.roots: List[int] = []
+        self.max_id = 0
+        self.users = 0
+        self.moves = 0
+        # id -> when a sync first found it missing below max_id
+        self.gaps: Dict[int, float] = {}
+
+    def load(self, db: Session, max_levels: int = 20):
+        """
+        (Re)build the index from users.referred_by_id in O(users x max_levels).
+        """
+        # Read before the users, so a move committed in between reloads again
+        moves = self._moves(db)
+        rows = db.execute(select(User.id, User.referred_by_id).order_by(User.id)).all()
+        with self._lock:
+            self._reset()
+            self.moves = moves
+            self.max_levels = max_levels
+            size = (rows[-1][0] + 1) if rows else 1
+            self.parent = array("q", [NO_USER]) * size
+            for uid, parent_id in rows:
+                self.parent[uid] = parent_id or NO_PARENT
+            # A referrer that no longer exists makes the user a root
+            for uid, _ in rows:
+                p = self.parent[uid]
+                if p != NO_PARENT and (p >= size or self.parent[p] == NO_USER):
+                    self.parent[uid] = NO_PARENT
+            self.max_id = size - 1
+            self.users = len(rows)
+            now = time.monotonic()
+            self.gaps = {
+                uid: now for uid in range(max(1, size - GRAPH_INDEX_GAP_WINDOW), size)
+                if self.parent[uid] == NO_USER
+            }
+            self._compact()
+
+            self.team = array("q", [0]) * size
+            for uid, _ in rows:
+                self._add_to_upline(uid, 1)
+            self.synced_at = time.monotonic()
+            self.ready = True
+            self.version += 1
+
+    def reload(self):
+        """
+        Rebuild with load() on a background thread, with its own session.
+        Until it finishes the index is not ready and reads use the database.
+        """
+        with self._lock:
+            self.ready = False
+            if self._loader is not None and self._loader.is_alive():
+                # That load reads the moves counter first; if it is already
+                # stale, the next sync() notices and reloads again
+                return
+            self._loader = threading.Thread(target=self._reload, name="graph-index-loader", daemon=True)
+            self._loader.start()
+
+    def _reload(self):
+        db = self.session_factory()
+        try:
+            self.load(db, self.max_levels)
+        except Exception:
+            logger.exception("Graph index reload failed")
+        finally:
+            db.close()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a background reload to finish. Returns ready."""
+        loader = self._loader
+        if loader is not None:
+            loader.join(timeout)
+        return self.ready
+
+    def _compact(self):
+        """Rebuild the CSR arrays (and roots) from the parent array."""
+        size = len(self.parent)
+        offsets = array("q", [0]) * (size + 1)
+        roots = []
+        for uid in range(size):
+            p = self.parent[uid]
+            if p > 0:
+                offsets[p + 1] += 1
+            elif p == NO_PARENT:
+                roots.append(uid)
+        for i in range(size):
+            offsets[i + 1] += offsets[i]
+        children = array("q", [0]) * offsets[size]
+        fill = offsets[:-1]
+        # Ids ascend, so every child list comes out sorted
+        for uid in range(size):
+            p = self.parent[uid]
+            if p > 0:
+                children[fill[p]] = uid
+                fill[p] += 1
+        self.offsets = offsets
+        self.children = children
+        self.roots = roots
+        self.extra = {}
+        self.extra_count = 0
+
+    def _add_to_upline(self, uid: int, amount: int):
+        p = self.parent[uid]
+        for _ in range(self.max_levels):
+            if p <= 0:
+                return
+            self.team[p] += amount
+            p = self.parent[p]
+
+    def _add_user(self, user_id: int, referred_by_id: Optional[int]) -> bool:
+        """
+        Record a committed user whose referrer is already indexed (or None).
+        Returns False, changing nothing, when the referrer is unknown.
+        """
+        if self.contains(user_id):
+            return True
+        if referred_by_id and not self.contains(referred_by_id):
+            return False
+        if user_id >= len(self.parent):
+            grow = user_id + 1 - len(self.parent)
+            self.parent.extend(array("q", [NO_USER]) * grow)
+            self.team.extend(array("q", [0]) * grow)
+        parent_id = referred_by_id or NO_PARENT
+        self.parent[user_id] = parent_id
+        if parent_id:
+            self.extra.setdefault(parent_id, []).append(user_id)
+            self.extra_count += 1
+        else:
+            self.roots.append(user_id)
+        self._add_to_upline(user_id, 1)
+        self.max_id = max(self.max_id, user_id)
+        self.users += 1
+        self.version += 1
+        if self.extra_count > GRAPH_INDEX_COMPACT_AFTER:
+            self._compact()
+        return True
+
+    def move_user(self, db: Session, user_id: int, new_parent_id: Optional[int]):
+        """
+        Re-parent a user and their downline after ReferralService.move_subtree
+        committed. Applied in place when that move is the only one since the
+        index last caught up (team sizes adjusted from the subtree's per-level
+        histogram, CSR arrays rebuilt); otherwise the index is reloaded.
+        """
+        if not self.ready:
+            return
+        moves = self._moves(db)
+        with self._lock:
+            current = self.parent[user_id] if self.contains(user_id) else NO_USER
+            if current == NO_USER or current == (new_parent_id or NO_PARENT) or moves != self.moves + 1:
+                self.sync(db, force=True)
+                return
+            histogram = [1] + [0] * (self.max_levels - 1)
+            for _, level in self.descendants(user_id, self.max_levels - 1):
+                histogram[level] += 1
+            for depth, count in enumerate(histogram):
+                for ancestor_id, _ in self.upline(user_id, self.max_levels - depth):
+                    self.team[ancestor_id] -= count
+            self.parent[user_id] = new_parent_id if self.contains(new_parent_id) else NO_PARENT
+            for depth, count in enumerate(histogram):
+                for ancestor_id, _ in self.upline(user_id, self.max_levels - depth):
+                    self.team[ancestor_id] += count
+            self._compact()
+            self.moves = moves
+            self.version += 1
+
+    @staticmethod
+    def _moves(db: Session) -> int:
+        return db.scalar(select(SystemCounter.value).where(SystemCounter.name == GRAPH_MOVES)) or 0
+
+    def current(self, db: Session) -> bool:
+        """Sync if the last one is older than GRAPH_INDEX_SYNC_INTERVAL; True if reads can use the index."""
+        if self.ready:
+            self.sync(db)
+        return self.ready
+
+    def sync(self, db: Session, force: bool = False) -> int:
+        """
+        Catch up with users committed since the last load or sync: new ids
+        above max_id plus ids skipped earlier that may have committed since.
+        Skipped within GRAPH_INDEX_SYNC_INTERVAL of the previous sync unless
+        `force` is set, as after a write through this process. A moved
+        subtree, or a referrer the index does not know, starts a background
+        reload(). Returns how many users were added.
+        """
+        if not self.ready:
+            return 0
+        now = time.monotonic()
+        if not force and now - self.synced_at < GRAPH_INDEX_SYNC_INTERVAL:
+            return 0
+        self.synced_at = now
+        if self._moves(db) != self.moves:
+            self.reload()
+            return 0
+
+        with self._lock:
+            self.gaps = {uid: seen for uid, seen in self.gaps.items() if now - seen < GRAPH_INDEX_GAP_TIMEOUT}
+            gaps = list(self.gaps)
+            max_id = self.max_id
+        wanted = User.id > max_id
+        if gaps:
+            wanted = or_(wanted, User.id.in_(gaps))
+        rows = db.execute(
+            select(User.id, User.referred_by_id).where(wanted).order_by(User.id)
+        ).all()
+        with self._lock:
+            rows = [(uid, parent_id) for uid, parent_id in rows if not self.contains(uid)]
+            if not rows:
+                return 0
+            added = 0
+            for uid, parent_id in rows:
+                if not self._add_user(uid, parent_id):
+                    # Referrer not indexed (or inserted after its child)
+                    self.reload()
+                    return added
+                self.gaps.pop(uid, None)
+                added += 1
+            # Ids skipped on the way up may still be in flight
+            for uid in range(max_id + 1, self.max_id):
+                if not self.contains(uid):
+                    self.gaps.setdefault(uid, now)
+        return len(rows)
+
+    def contains(self, user_id: Optional[int]) -> bool:
+        return user_id is not None and 0 < user_id < len(self.parent) and self.parent[user_id] != NO_USER
+
+    def get_children(self, user_id: int) -> List[int]:
+        with self._lock:
+            found = []
+            if user_id + 1 < len(self.offsets):
+                found = list(self.children[self.offsets[user_id]:self.offsets[user_id + 1]])
+            # Added after the last compaction, so all higher than the CSR ids
+            return found + self.extra.get(user_id, [])
+
+    def descendants(self, root_user_id: Optional[int], max_depth: int) -> List[Tuple[int, int]]:
+        """
+        (id, level) pairs of a downline ordered by (level, id), like
+        ReferralService.tree_statement. With root_user_id None the roots of
+        the forest are level 1.
+        """
+        with self._lock:
+            if root_user_id is None:
+                frontier = sorted(self.roots)
+            else:
+                frontier = self.get_children(root_user_id)
+            found = []
+            level = 1
+            while frontier and level <= max_depth:
+                found.extend((uid, level) for uid in frontier)
+                frontier = sorted(child for uid in frontier for child in self.get_children(uid))
+                level += 1
+            return found
+
+    def upline(self, user_id: int, max_depth: int) -> List[Tuple[int, int]]:
+        """(ancestor_id, depth) pairs, nearest first."""
+        with self._lock:
+            found = []
+            p = self.parent[user_id]
+            while p > 0 and len(found) < max_depth:
+                found.append((p, len(found) + 1))
+                p = self.parent[p]
+            return found
+
+    def is_in_downline(self, ancestor_id: int, user_id: int) -> bool:
+        """Same answer as the closure index: self, or an ancestor within max_levels."""
+        if user_id == ancestor_id:
+            return True
+        return any(a == ancestor_id for a, _ in self.upline(user_id, self.max_levels))
+
+    def team_size(self, user_id: int) -> int:
+        return self.team[user_id]
+
+    def directs(self, user_id: int) -> int:
+        return len(self.get_children(user_id))
+
+    def status(self) -> Dict[str, object]:
+        with self._lock:
+            arrays = (self.parent, self.team, self.offsets, self.children)
+            return {
+                "enabled": GRAPH_INDEX_ENABLED,
+                "ready": self.ready,
+                "reloading": self._loader is not None and self._loader.is_alive(),
+                "version": self.version,
+                "users": self.users,
+                "max_id": self.max_id,
+                "pending_children": self.extra_count,
+                "array_bytes": sum(a.itemsize * len(a) for a in arrays),
+            }
+
+
+graph_index = GraphIndex()
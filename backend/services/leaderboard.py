@@ -0,0 +1,151 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import User, ReferralStat, ReferralLevelStat
+from services.periodic import PeriodicJob
+
+LEADERBOARD_METRICS = ("team_size", "directs", "level", "recent_directs")
+
+# Optional in-memory top-N per leaderboard, refreshed in the background
+LEADERBOARD_SNAPSHOT_ENABLED = os.getenv("LEADERBOARD_SNAPSHOT_ENABLED", "false").lower() in ("1", "true", "yes")
+LEADERBOARD_SNAPSHOT_SIZE = int(os.getenv("LEADERBOARD_SNAPSHOT_SIZE", "1000"))
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv("LEADERBOARD_REFRESH_INTERVAL", "60"))
+
+Cursor = Tuple[int, int]
+
+
+class LeaderboardService:
+    @staticmethod
+    def statement(metric: str, level: Optional[int] = None, active: Optional[bool] = None,
+                  days: int = 7, after: Optional[Cursor] = None):
+        """
+        Leaders ordered by (value, user_id) descending, so every ranking reads
+        an index in order: (total_team_size, user_id), (total_directs, user_id),
+        (level, count, user_id) or, for recent_directs, users.created_at.
+        `after` is the (value, user_id) of the last row already received.
+        """
+        if metric == "team_size":
+            user_id, value = ReferralStat.user_id, ReferralStat.total_team_size
+            stmt = select(user_id.label("user_id"), value.label("value"))
+        elif metric == "directs":
+            user_id, value = ReferralStat.user_id, ReferralStat.total_directs
+            stmt = select(user_id.label("user_id"), value.label("value"))
+        elif metric == "level":
+            user_id, value = ReferralLevelStat.user_id, ReferralLevelStat.count
+            stmt = select(user_id.label("user_id"), value.label("value")).where(ReferralLevelStat.level == level)
+        elif metric == "recent_directs":
+            since = datetime.utcnow() - timedelta(days=days)
+            recent = select(
+                User.referred_by_id.label("user_id"),
+                func.count().label("value"),
+            ).where(
+                User.created_at >= since,
+                User.referred_by_id.isnot(None),
+            ).group_by(User.referred_by_id).subquery()
+            user_id, value = recent.c.user_id, recent.c.value
+            stmt = select(user_id, value)
+        else:
+            raise ValueError(f"Unknown leaderboard metric: {metric}")
+
+        stmt = stmt.add_columns(
+            User.username,
+            User.email,
+            User.referral_code,
+            User.is_active,
+        ).join(User, User.id == user_id)
+
+        if active is not None:
+            stmt = stmt.where(User.is_active == active)
+        if after is not None:
+            after_value, after_id = after
+            stmt = stmt.where(or_(
+                value < after_value,
+                and_(value == after_value, user_id < after_id),
+            ))
+        return stmt.order_by(value.desc(), user_id.desc())
+
+    @staticmethod
+    def top(db: Session, metric: str, limit: int = 100, level: Optional[int] = None,
+            active: Optional[bool] = None, days: int = 7, after: Optional[Cursor] = None) -> List[Dict[str, Any]]:
+        stmt = LeaderboardService.statement(metric, level, active, days, after).limit(limit)
+        return [dict(row) for row in db.execute(stmt).mappings()]
+
+
+class LeaderboardSnapshot:
+    """
+    In-memory top-N of every leaderboard that has been asked for (without an
+    active filter), refreshed by a periodic job.
+
+    Every refresh is a full rebuild of each top-N with the same query the
+    live endpoint runs: rankings over referral_stats read N rows off their
+    index, and recent_directs re-aggregates the signups in its window from
+    the created_at index, so late commits and moved users are picked up.
+    Requests in between are served from memory.
+    """
+
+    def __init__(self, size: int = LEADERBOARD_SNAPSHOT_SIZE):
+        self.size = size
+        self.refreshed_at: Optional[datetime] = None
+        self._rows: Dict[Tuple[str, Optional[int], int], List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, metric: str, limit: int, level: Optional[int] = None,
+            days: int = 7, after: Optional[Cursor] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        The requested page from the snapshot, or None if it reaches past it.
+        A leaderboard seen for the first time is built on the spot.
+        """
+        key = (metric, level if metric == "level" else None, days if metric == "recent_directs" else 0)
+        with self._lock:
+            rows = self._rows.get(key)
+        if rows is None:
+            rows = self._build(db, key)
+            with self._lock:
+                self._rows[key] = rows
+
+        start = 0
+        if after is not None:
+            while start < len(rows) and (rows[start]["value"], rows[start]["user_id"]) >= after:
+                start += 1
+        page = rows[start:start + limit]
+        if len(page) < limit and len(rows) == self.size:
+            # The page continues past the snapshot's last row
+            return None
+        return page
+
+    def refresh(self, db: Session):
+        with self._lock:
+            keys = list(self._rows)
+        for key in keys:
+            rows = self._build(db, key)
+            with self._lock:
+                self._rows[key] = rows
+        self.refreshed_at = datetime.utcnow()
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+    def _build(self, db: Session, key) -> List[Dict[str, Any]]:
+        metric, level, days = key
+        return LeaderboardService.top(db, metric, self.size, level=level, days=days)
+
+
+leaderboard_snapshot = LeaderboardSnapshot()
+
+
+def _refresh_leaderboards():
+    db = SessionLocal()
+    try:
+        leaderboard_snapshot.refresh(db)
+    finally:
+        db.close()
+
+
+leaderboard_refresher = PeriodicJob("leaderboard-refresher", LEADERBOARD_REFRESH_INTERVAL, _refresh_leaderboards)
@@ -0,0 +1,181 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this are logged with their SQL statements (0 = off)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+SLOW_REQUEST_MAX_STATEMENTS = int(os.getenv("SLOW_REQUEST_MAX_STATEMENTS", "200"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram per label set, rendered in Prometheus text format.
+    """
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: Tuple[str, ...], value: float):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), then sum
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._series.items()):
+                labels = _format_labels(self.labels, label_values)
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labels + ("le",), label_values + (le,))} {cumulative}')
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values: Tuple[str, ...], amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+ROUTE_LABELS = ("method", "route")
+
+requests_total = Counter("http_requests_total", "HTTP requests by route and status.", ROUTE_LABELS + ("status",))
+request_seconds = Histogram("http_request_duration_seconds", "Request latency.", ROUTE_LABELS, LATENCY_BUCKETS)
+request_queries = Histogram("http_request_db_queries", "SQL statements per request.", ROUTE_LABELS, QUERY_BUCKETS)
+request_db_seconds = Histogram("http_request_db_seconds", "Time spent in SQL per request.", ROUTE_LABELS, LATENCY_BUCKETS)
+request_bcrypt_seconds = Histogram("http_request_bcrypt_seconds", "Time spent hashing or verifying passwords per request.",
+                                   ROUTE_LABELS, LATENCY_BUCKETS)
+slow_requests_total = Counter("http_slow_requests_total", "Requests over SLOW_REQUEST_MS.", ROUTE_LABELS)
+
+REGISTRY = (requests_total, request_seconds, request_queries, request_db_seconds, request_bcrypt_seconds,
+            slow_requests_total)
+
+
+class RequestStats:
+    """
+    Work done on behalf of one request. Shared by reference through a context
+    variable, so threadpool workers and async sessions add to the same object.
+    """
+
+    __slots__ = ("queries", "db_seconds", "bcrypt_seconds", "statements")
+
+    def __init__(self, capture_statements: bool = False):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+        self.statements: Optional[List[Tuple[float, str]]] = [] if capture_statements else None
+
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def start_request() -> Tuple[RequestStats, contextvars.Token]:
+    stats = RequestStats(capture_statements=SLOW_REQUEST_MS > 0)
+    return stats, _current.set(stats)
+
+
+def end_request(token: contextvars.Token):
+    _current.reset(token)
+
+
+def record_bcrypt(seconds: float):
+    stats = _current.get()
+    if stats is not None:
+        stats.bcrypt_seconds += seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.db_seconds += elapsed
+    if stats.statements is not None and len(stats.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+        stats.statements.append((elapsed, statement))
+
+
+def instrument_engine(bind):
+    """
+    Count and time every statement run on `bind` (a sync Engine; pass
+    async_engine.sync_engine for the async one).
+    """
+    if not event.contains(bind, "before_cursor_execute", _before_cursor_execute):
+        event.listen(bind, "before_cursor_execute", _before_cursor_execute)
+        event.listen(bind, "after_cursor_execute", _after_cursor_execute)
+
+
+def observe_request(method: str, route: str, status: int, seconds: float, stats: RequestStats):
+    labels = (method, route)
+    requests_total.inc(labels + (str(status),))
+    request_seconds.observe(labels, seconds)
+    request_queries.observe(labels, stats.queries)
+    request_db_seconds.observe(labels, stats.db_seconds)
+    if stats.bcrypt_seconds:
+        request_bcrypt_seconds.observe(labels, stats.bcrypt_seconds)
+
+    if SLOW_REQUEST_MS > 0 and seconds * 1000 >= SLOW_REQUEST_MS:
+        slow_requests_total.inc(labels)
+        statements = "\n".join(f"  {elapsed * 1000:8.2f}ms  {' '.join(sql.split())}"
+                               for elapsed, sql in stats.statements or [])
+        logger.warning(
+            "Slow request %s %s: %.1fms, %d queries (%.1fms in SQL), %.1fms bcrypt\n%s",
+            method, route, seconds * 1000, stats.queries, stats.db_seconds * 1000,
+            stats.bcrypt_seconds * 1000, statements,
+        )
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
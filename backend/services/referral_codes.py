@@ -0,0 +1,84 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from sqlalchemy.orm import Session
+
+from models import User
+from services.counter_service import CounterService
+from utils import encode_referral_code
+
+# Keep this secret stable: changing it changes which codes future user ids and
+# sequence numbers map to (existing codes stay valid, but may then collide).
+REFERRAL_CODE_SECRET = os.getenv("REFERRAL_CODE_SECRET", "change-this-referral-code-secret")
+REFERRAL_CODE_CACHE_SIZE = int(os.getenv("REFERRAL_CODE_CACHE_SIZE", "50000"))
+
+SEQUENCE_COUNTER = "referral_code_seq"
+
+_KEY = hashlib.blake2b(REFERRAL_CODE_SECRET.encode(), digest_size=16).digest()
+
+
+class ReferralCodeAllocator:
+    """
+    Codes are a keyed permutation of a number: 2 x user id for a user that is
+    already flushed, or 2 x sequence + 1 for codes needed before the insert
+    (bulk imports). The two halves never collide, and neither needs a shared
+    row on the signup path. Codes from before (random ones, and the sequence
+    mapped directly) can still clash; callers rely on the unique constraint
+    and fall back to allocate().
+    """
+
+    @staticmethod
+    def for_user(user_id: int) -> str:
+        """The code of a flushed user. Computed without touching the database."""
+        return encode_referral_code(2 * user_id, _KEY)
+
+    @staticmethod
+    def allocate(db: Session, count: int = 1) -> List[str]:
+        """
+        Reserve `count` sequence numbers with one atomic counter update and map
+        them to codes. The codes are unique among allocated codes without
+        querying users.
+        """
+        last = CounterService.increment(db, SEQUENCE_COUNTER, count)
+        return [encode_referral_code(2 * seq + 1, _KEY) for seq in range(last - count + 1, last + 1)]
+
+
+class ReferralCodeCache:
+    """
+    LRU cache of referral_code -> user_id. Codes never change once assigned,
+    so entries need no expiry; only hits are cached.
+    """
+
+    def __init__(self, maxsize: int = REFERRAL_CODE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, code: str, user_id: int):
+        with self._lock:
+            self._entries[code] = user_id
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def resolve(self, db: Session, code: str) -> Optional[int]:
+        with self._lock:
+            user_id = self._entries.get(code)
+            if user_id is not None:
+                self._entries.move_to_end(code)
+                return user_id
+
+        user_id = db.query(User.id).filter(User.referral_code == code).scalar()
+        if user_id is not None:
+            self.put(code, user_id)
+        return user_id
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+referral_code_cache = ReferralCodeCache()
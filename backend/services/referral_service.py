@@ -1,14 +1,196 @@
 from sqlalchemy.orm import Session, aliased
-from sqlalchemy import select, literal, func
-from models import User, ReferralStat
-from typing import List, Dict, Any
+from sqlalchemy import select, insert, update, delete, literal, func, and_, or_, exists, case
+from sqlalchemy.dialects import postgresql, sqlite
+from models import User, ReferralStat, ReferralLevelStat, ReferralClosure, StatsOutbox
+from services.graph_index import graph_index
+from services.counter_service import CounterService, GRAPH_MOVES, TOTAL_REFERRALS
+from typing import List, Dict, Any, Tuple, Iterator, Optional
+
+MAX_LEVELS = 20
+
+def count_active():
+    """Aggregate counting the rows whose joined User is active."""
+    return func.count(case((User.is_active == True, 1)))
 
 class ReferralService:
     @staticmethod
-    def get_referral_tree(db: Session, root_user_id: int, max_depth: int = 20) -> List[Dict[str, Any]]:
+    def tree_statement(root_user_id: Optional[int], max_depth: int = 20, after: Optional[Tuple[int, int]] = None):
+        """
+        Build the downline query over the referral_closure index, ordered by
+        (level, id). `after` is a (level, id) keyset cursor: only rows past it
+        are selected.
+        If root_user_id is None, selects the forest below all root users
+        (the roots themselves are level 1).
+        """
+        stmt = select(
+            User.id,
+            User.username,
+            User.email,
+            User.referral_code,
+            User.referred_by_id,
+            User.created_by,
+            User.is_active,
+        ).join(ReferralClosure, ReferralClosure.descendant_id == User.id)
+
+        if root_user_id is None:
+            root = aliased(User)
+            level = ReferralClosure.depth + 1
+            stmt = stmt.join(
+                root, root.id == ReferralClosure.ancestor_id
+            ).where(root.referred_by_id.is_(None), ReferralClosure.depth < max_depth)
+        else:
+            level = ReferralClosure.depth
+            stmt = stmt.where(
+                ReferralClosure.ancestor_id == root_user_id,
+                ReferralClosure.depth.between(1, max_depth),
+            )
+
+        if after is not None:
+            after_level, after_id = after
+            stmt = stmt.where(or_(
+                level > after_level,
+                and_(level == after_level, User.id > after_id),
+            ))
+
+        return stmt.add_columns(level.label('level')).order_by(ReferralClosure.depth, User.id)
+
+    @staticmethod
+    def get_referral_tree(db: Session, root_user_id: int, max_depth: int = 20,
+                          limit: Optional[int] = None, after: Optional[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+        """
+        Fetch the downline tree from the referral_closure index.
+        Returns a flat list of nodes with 'level' attribute; pass limit/after
+        to read it one keyset page at a time.
+        Whole trees come from the in-memory graph index when it is loaded.
+        """
+        if limit is None and after is None and graph_index.current(db):
+            return ReferralService.load_tree_nodes(db, graph_index.descendants(root_user_id, max_depth))
+
+        stmt = ReferralService.tree_statement(root_user_id, max_depth, after)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        result = db.execute(stmt).mappings().all()
+        return [dict(row) for row in result]
+
+    @staticmethod
+    def load_tree_nodes(db: Session, levels: List[Tuple[int, int]], chunk_size: int = 5000) -> List[Dict[str, Any]]:
+        """
+        Tree rows for (id, level) pairs, keeping their order: the node columns
+        of tree_statement, fetched by primary key.
+        """
+        columns = (
+            User.id,
+            User.username,
+            User.email,
+            User.referral_code,
+            User.referred_by_id,
+            User.created_by,
+            User.is_active,
+        )
+        keys = [column.key for column in columns] + ["level"]
+        rows = {}
+        ids = [uid for uid, _ in levels]
+        for i in range(0, len(ids), chunk_size):
+            for row in db.execute(select(*columns).where(User.id.in_(ids[i:i + chunk_size]))):
+                rows[row[0]] = row
+        return [dict(zip(keys, (*rows[uid], level))) for uid, level in levels if uid in rows]
+
+    @staticmethod
+    def iter_referral_tree(db: Session, root_user_id: int, max_depth: int = 20,
+                           after: Optional[Tuple[int, int]] = None, chunk_size: int = 1000) -> Iterator[Dict[str, Any]]:
         """
-        Fetch the downline tree using a recursive CTE.
-        Returns a flat list of nodes with 'level' attribute.
+        Stream the downline tree from a server-side cursor, `chunk_size` rows
+        at a time, without materializing the whole result.
+        """
+        stmt = ReferralService.tree_statement(root_user_id, max_depth, after)
+        result = db.execute(stmt.execution_options(yield_per=chunk_size))
+        for row in result.mappings():
+            yield dict(row)
+
+    @staticmethod
+    def build_nested(nodes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Turn flat (level, id)-ordered tree rows into nested dicts with a
+        'children' list, in one pass. Parents always precede their children in
+        that order; nodes whose parent is not in the list become roots.
+        """
+        by_id = {}
+        roots = []
+        for node in nodes:
+            node = {**node, "children": []}
+            by_id[node["id"]] = node
+            parent = by_id.get(node["referred_by_id"])
+            if parent is not None:
+                parent["children"].append(node)
+            else:
+                roots.append(node)
+        return roots
+
+    @staticmethod
+    def get_children(db: Session, parent_id: Optional[int]) -> List[Dict[str, Any]]:
+        """
+        Direct referrals of a user (or all root users if parent_id is None),
+        with their precomputed team size (total and active) and whether they
+        have referrals of their own.
+        """
+        grandchild = aliased(ReferralClosure)
+        has_children = exists().where(
+            grandchild.ancestor_id == User.id,
+            grandchild.depth == 1,
+        )
+
+        stmt = select(
+            User.id,
+            User.username,
+            User.email,
+            User.role,
+            User.referral_code,
+            User.referred_by_id,
+            User.is_active,
+            func.coalesce(ReferralStat.total_directs, 0).label('total_directs'),
+            func.coalesce(ReferralStat.total_team_size, 0).label('total_team_size'),
+            func.coalesce(ReferralStat.active_directs, 0).label('active_directs'),
+            func.coalesce(ReferralStat.active_team_size, 0).label('active_team_size'),
+            has_children.label('has_children'),
+        ).outerjoin(ReferralStat, ReferralStat.user_id == User.id)
+
+        if parent_id is None:
+            stmt = stmt.where(User.referred_by_id.is_(None))
+        else:
+            stmt = stmt.join(
+                ReferralClosure, ReferralClosure.descendant_id == User.id
+            ).where(ReferralClosure.ancestor_id == parent_id, ReferralClosure.depth == 1)
+
+        result = db.execute(stmt.order_by(User.id)).mappings().all()
+        children = [{**row, "has_children": bool(row["has_children"])} for row in result]
+
+        # The graph index counts are live, while stats rows may still be queued
+        if graph_index.current(db):
+            for child in children:
+                if graph_index.contains(child["id"]):
+                    child["total_directs"] = graph_index.directs(child["id"])
+                    child["total_team_size"] = graph_index.team_size(child["id"])
+                    child["has_children"] = child["total_directs"] > 0
+        return children
+
+    @staticmethod
+    def is_in_downline(db: Session, ancestor_id: int, user_id: int) -> bool:
+        """True if user_id is ancestor_id itself or somewhere in its downline."""
+        if graph_index.current(db) and graph_index.contains(ancestor_id) and graph_index.contains(user_id):
+            return graph_index.is_in_downline(ancestor_id, user_id)
+        return db.query(
+            exists().where(
+                ReferralClosure.ancestor_id == ancestor_id,
+                ReferralClosure.descendant_id == user_id,
+            )
+        ).scalar()
+
+    @staticmethod
+    def get_referral_tree_recursive(db: Session, root_user_id: int, max_depth: int = 20) -> List[Dict[str, Any]]:
+        """
+        Fetch the downline tree using a recursive CTE over users.referred_by_id.
+        Slower than get_referral_tree but independent of the closure index,
+        so it is used to verify stored data.
         """
         # Base case: direct referrals
         stmt = select(
@@ -53,57 +235,888 @@ class ReferralService:
         return [dict(row) for row in result]
 
     @staticmethod
-    def update_stats(db: Session, user_id: int):
+    def get_upline(db: Session, user_id: int, max_depth: int = 20) -> List[Tuple[int, int]]:
+        """
+        Fetch the ancestors of a user with one upward recursive CTE.
+        Returns (ancestor_id, depth) pairs, nearest first (the referrer is depth 1).
+        Always read in the caller's transaction, never from the graph index,
+        because the stats and closure writes take their uplines from here.
+        """
+        upline = select(
+            User.referred_by_id.label('id'),
+            literal(1).label('depth')
+        ).where(
+            User.id == user_id,
+            User.referred_by_id.isnot(None)
+        ).cte(name="upline", recursive=True)
+
+        child = aliased(User)
+
+        # Recursive step: the referrer of the previous ancestor
+        upline = upline.union_all(
+            select(
+                child.referred_by_id,
+                upline.c.depth + 1
+            ).where(child.id == upline.c.id)
+             .where(child.referred_by_id.isnot(None))
+             .where(upline.c.depth < max_depth)
+        )
+
+        # Join back to users so a dangling referred_by_id ends the chain
+        stmt = select(upline.c.id, upline.c.depth).join(
+            User, User.id == upline.c.id
+        ).order_by(upline.c.depth)
+        return [(row.id, row.depth) for row in db.execute(stmt)]
+
+    @staticmethod
+    def get_upline_nodes(db: Session, user_id: int, max_depth: int = 20) -> List[Dict[str, Any]]:
+        """
+        The sponsors of a user, nearest first, as tree rows whose 'level' is
+        the distance up. For reads only: ancestors come from the graph index
+        when it is current, otherwise from get_upline.
+        """
+        if graph_index.current(db) and graph_index.contains(user_id):
+            upline = graph_index.upline(user_id, max_depth)
+        else:
+            upline = ReferralService.get_upline(db, user_id, max_depth)
+        return ReferralService.load_tree_nodes(db, upline)
+
+    @staticmethod
+    def update_stats(db: Session, user_id: int, commit: bool = True):
         """
         Recalculate and update stats for a specific user.
-        This is expensive and should be backgrounded in production.
+        Counts the downline (and its active members) per level with one
+        aggregate over the closure index. Queued stats_outbox rows of the user
+        are dropped first: the recompute already includes them.
         """
-        tree = ReferralService.get_referral_tree(db, user_id, max_depth=20)
-        
-        total_directs = sum(1 for node in tree if node['level'] == 1)
-        total_team = len(tree)
-        level_counts = {}
-        for node in tree:
-            lvl = str(node['level'])
-            level_counts[lvl] = level_counts.get(lvl, 0) + 1
+        db.execute(delete(StatsOutbox).where(StatsOutbox.user_id == user_id))
+        rows = db.query(ReferralClosure.depth, func.count(), count_active()).join(
+            User, User.id == ReferralClosure.descendant_id
+        ).filter(
+            ReferralClosure.ancestor_id == user_id,
+            ReferralClosure.depth.between(1, MAX_LEVELS),
+        ).group_by(ReferralClosure.depth).all()
+
+        level_counts = {str(depth): count for depth, count, _ in rows}
+        active_counts = {str(depth): active for depth, _, active in rows if active}
+        values = (
+            level_counts.get("1", 0),
+            sum(level_counts.values()),
+            active_counts.get("1", 0),
+            sum(active_counts.values()),
+        )
             
         stat = db.query(ReferralStat).filter(ReferralStat.user_id == user_id).first()
+        stored = ReferralService.get_level_counts(db, user_id, active=False), ReferralService.get_level_counts(db, user_id, active=True)
         if not stat:
             stat = ReferralStat(user_id=user_id)
             db.add(stat)
+        elif (stat.total_directs, stat.total_team_size, stat.active_directs, stat.active_team_size) != values \
+                or stored != (level_counts, active_counts):
+            stat.subtree_version = func.coalesce(ReferralStat.subtree_version, 0) + 1
             
-        stat.total_directs = total_directs
-        stat.total_team_size = total_team
-        stat.level_breakdown = level_counts
+        stat.total_directs, stat.total_team_size, stat.active_directs, stat.active_team_size = values
+        if stored != (level_counts, active_counts):
+            ReferralService.write_level_counts(db, {user_id: level_counts}, {user_id: active_counts})
         
-        db.commit()
+        if commit:
+            db.commit()
+        else:
+            db.flush()
+            db.expire(stat, ["levels"])
 
     @staticmethod
-    def propagate_stats_update(db: Session, new_user_id: int):
+    def get_level_counts(db: Session, user_id: int, active: bool = False) -> Dict[str, int]:
         """
-        When a new user is added, update stats for all 20 uplines.
+        Stored per-level counts of a user, shaped like level_breakdown
+        (active=True: like active_level_breakdown).
         """
-        current_id = new_user_id
-        # We need to traverse UP the chain
-        # Ideally, we do this iteratively
-        user = db.query(User).filter(User.id == current_id).first()
-        
-        if not user or not user.referred_by_id:
+        column = ReferralLevelStat.active_count if active else ReferralLevelStat.count
+        rows = db.execute(
+            select(ReferralLevelStat.level, column).where(
+                ReferralLevelStat.user_id == user_id,
+                column > 0,
+            )
+        )
+        return {str(level): count for level, count in rows}
+
+    @staticmethod
+    def write_level_counts(db: Session, level_counts: Dict[int, Dict[str, int]],
+                           active_counts: Dict[int, Dict[str, int]], chunk_size: int = 500):
+        """
+        Replace the referral_level_stats rows of each user in `level_counts`
+        ({user_id: {"1": n, ...}}, with the active members of each level in
+        `active_counts`, same shape) with bulk statements. Not committed here.
+        """
+        user_ids = list(level_counts)
+        for i in range(0, len(user_ids), chunk_size):
+            db.execute(delete(ReferralLevelStat).where(ReferralLevelStat.user_id.in_(user_ids[i:i + chunk_size])))
+        rows = [
+            {
+                "user_id": uid,
+                "level": int(level),
+                "count": count,
+                "active_count": active_counts.get(uid, {}).get(level, 0),
+            }
+            for uid, counts in level_counts.items()
+            for level, count in counts.items()
+            if count
+        ]
+        for i in range(0, len(rows), chunk_size):
+            db.execute(insert(ReferralLevelStat), rows[i:i + chunk_size])
+
+    @staticmethod
+    def increment_level_counts(db: Session, increments: List[Tuple[int, int, int, int]]):
+        """
+        Atomically add (count, active_count) deltas to single (user_id, level)
+        rows, given as (user_id, level, delta, active_delta), creating missing
+        rows: one INSERT ... ON CONFLICT DO UPDATE for all of them. Rows are
+        touched in (user_id, level) order. Not committed here.
+        """
+        if not increments:
             return
+        dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+        stmt = dialect.insert(ReferralLevelStat)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ReferralLevelStat.user_id, ReferralLevelStat.level],
+            set_={
+                "count": ReferralLevelStat.count + stmt.excluded.count,
+                "active_count": ReferralLevelStat.active_count + stmt.excluded.active_count,
+            },
+        )
+        db.execute(stmt, [
+            {"user_id": uid, "level": level, "count": delta, "active_count": active_delta}
+            for uid, level, delta, active_delta in sorted(increments)
+        ])
+
+    @staticmethod
+    def index_user(db: Session, user_id: int, referred_by_id: int = None):
+        """
+        Add a newly created user to the closure index: a self row plus one row
+        for each of the referrer's ancestors within MAX_LEVELS.
+        """
+        db.add(ReferralClosure(ancestor_id=user_id, descendant_id=user_id, depth=0))
+        if referred_by_id:
+            db.execute(
+                insert(ReferralClosure).from_select(
+                    ["ancestor_id", "descendant_id", "depth"],
+                    select(
+                        ReferralClosure.ancestor_id,
+                        literal(user_id),
+                        ReferralClosure.depth + 1,
+                    ).where(
+                        ReferralClosure.descendant_id == referred_by_id,
+                        ReferralClosure.depth < MAX_LEVELS,
+                    ),
+                )
+            )
+        db.flush()
+
+    @staticmethod
+    def rebuild_closure(db: Session) -> int:
+        """
+        Rebuild the whole closure index from users.referred_by_id, one
+        INSERT ... SELECT per level. Returns the number of rows written.
+        """
+        db.execute(delete(ReferralClosure))
+        result = db.execute(
+            insert(ReferralClosure).from_select(
+                ["ancestor_id", "descendant_id", "depth"],
+                select(User.id, User.id, literal(0)),
+            )
+        )
+        total = result.rowcount
 
-        uplines = []
-        curr = user
-        for _ in range(20):
-            if not curr.referred_by_id:
+        for depth in range(MAX_LEVELS):
+            result = db.execute(
+                insert(ReferralClosure).from_select(
+                    ["ancestor_id", "descendant_id", "depth"],
+                    select(
+                        ReferralClosure.ancestor_id,
+                        User.id,
+                        literal(depth + 1),
+                    ).join(
+                        User, User.referred_by_id == ReferralClosure.descendant_id
+                    ).where(ReferralClosure.depth == depth),
+                )
+            )
+            if not result.rowcount:
                 break
-            # Fetch parent
-            parent = db.query(User).filter(User.id == curr.referred_by_id).first()
-            if parent:
-                uplines.append(parent.id)
-                curr = parent
+            total += result.rowcount
+
+        db.commit()
+        return total
+
+    @staticmethod
+    def ensure_closure(db: Session) -> bool:
+        """
+        Backfill the closure index if some users are missing from it
+        (e.g. a database created before the index existed).
+        Returns True if a rebuild was needed.
+        """
+        indexed = db.query(ReferralClosure).filter(ReferralClosure.depth == 0).count()
+        if indexed == db.query(User).count():
+            return False
+        ReferralService.rebuild_closure(db)
+        return True
+
+    @staticmethod
+    def ensure_stats_rows(db: Session) -> int:
+        """
+        Create referral_stats rows for users that have none (e.g. accounts
+        created before every user got one). Returns how many were created.
+        """
+        missing = [
+            uid for (uid,) in db.query(User.id).outerjoin(
+                ReferralStat, ReferralStat.user_id == User.id
+            ).filter(ReferralStat.id.is_(None))
+        ]
+        for uid in missing:
+            ReferralService.update_stats(db, uid, commit=False)
+        db.commit()
+        return len(missing)
+
+    @staticmethod
+    def ensure_level_stats(db: Session) -> bool:
+        """
+        Backfill referral_level_stats from the closure index for databases
+        whose per-level counts predate the table (they lived in a JSON column).
+        Returns True if a backfill was needed.
+        """
+        if db.query(ReferralLevelStat).first() is not None:
+            return False
+        if db.query(ReferralStat).filter(ReferralStat.total_team_size > 0).first() is None:
+            return False
+        db.execute(
+            insert(ReferralLevelStat).from_select(
+                ["user_id", "level", "count", "active_count"],
+                select(
+                    ReferralClosure.ancestor_id,
+                    ReferralClosure.depth,
+                    func.count(),
+                    count_active(),
+                ).join(
+                    User, User.id == ReferralClosure.descendant_id
+                ).where(
+                    ReferralClosure.depth.between(1, MAX_LEVELS)
+                ).group_by(ReferralClosure.ancestor_id, ReferralClosure.depth),
+            )
+        )
+        db.commit()
+        return True
+
+    @staticmethod
+    def ensure_active_stats(db: Session) -> bool:
+        """
+        Fill the active counts of databases created before they were tracked
+        (the columns were added empty) with one rebuild_all_stats pass.
+        Returns True if a backfill was needed.
+        """
+        missing = db.query(ReferralStat).filter(
+            or_(ReferralStat.active_directs.is_(None), ReferralStat.active_team_size.is_(None))
+        ).first() or db.query(ReferralLevelStat).filter(ReferralLevelStat.active_count.is_(None)).first()
+        if missing is None:
+            return False
+        ReferralService.rebuild_all_stats(db)
+        return True
+
+    @staticmethod
+    def rebuild_all_stats(db: Session, dry_run: bool = False, batch_size: int = 1000,
+                          sample_size: int = 20) -> Dict[str, Any]:
+        """
+        Recompute every referral_stats row from users.referred_by_id in one
+        bottom-up pass: each user's per-level counts are the shifted sum of its
+        children's, so the whole forest costs O(users x MAX_LEVELS) instead of
+        one downline query per user.
+
+        Only drifted or missing rows are written. With dry_run=True nothing is
+        written and the report lists what would change. Users that sit in a
+        referral cycle cannot be reached from a root and are reported instead.
+        Registrations committed while the pass runs may be overwritten; the
+        next rebuild (or verify_stats with repair) picks them up.
+        """
+        parent_of, active_of = {}, {}
+        for uid, parent_id, is_active in db.execute(select(User.id, User.referred_by_id, User.is_active)):
+            parent_of[uid] = parent_id
+            active_of[uid] = bool(is_active)
+        children: Dict[Optional[int], List[int]] = {}
+        for uid, parent_id in parent_of.items():
+            # A referrer that no longer exists makes the user a root
+            children.setdefault(parent_id if parent_id in parent_of else None, []).append(uid)
+
+        # Parent-first order, walked backwards so children finish before parents
+        order = list(children.get(None, []))
+        for uid in order:
+            order.extend(children.get(uid, ()))
+
+        # Empty active counts (None) of databases that predate them count as drift
+        stored_levels: Dict[int, Dict[str, int]] = {}
+        stored_active: Dict[int, Dict[str, Optional[int]]] = {}
+        for user_id, level, count, active in db.execute(select(
+            ReferralLevelStat.user_id, ReferralLevelStat.level, ReferralLevelStat.count,
+            ReferralLevelStat.active_count,
+        ).where(ReferralLevelStat.count > 0)):
+            stored_levels.setdefault(user_id, {})[str(level)] = count
+            if active != 0:
+                stored_active.setdefault(user_id, {})[str(level)] = active
+        stored = {
+            user_id: (stat_id, directs or 0, team or 0, active_directs, active_team,
+                      stored_levels.get(user_id, {}), stored_active.get(user_id, {}))
+            for stat_id, user_id, directs, team, active_directs, active_team in db.execute(select(
+                ReferralStat.id, ReferralStat.user_id, ReferralStat.total_directs,
+                ReferralStat.total_team_size, ReferralStat.active_directs, ReferralStat.active_team_size,
+            ))
+        }
+
+        # Per-level counts of every member and of active members, side by side
+        pending: Dict[int, Tuple[List[int], List[int]]] = {}
+        updates, inserts, sample, changed, created = [], [], [], [], []
+        level_writes: Dict[int, Dict[str, int]] = {}
+        active_writes: Dict[int, Dict[str, int]] = {}
+        drifted = missing = 0
+        for uid in reversed(order):
+            counts, active = pending.pop(uid, None) or ([0] * MAX_LEVELS, [0] * MAX_LEVELS)
+            parent_id = parent_of[uid]
+            if parent_id in parent_of:
+                parent_counts, parent_active = pending.setdefault(parent_id, ([0] * MAX_LEVELS, [0] * MAX_LEVELS))
+                parent_counts[0] += 1
+                parent_active[0] += active_of[uid]
+                for level in range(MAX_LEVELS - 1):
+                    parent_counts[level + 1] += counts[level]
+                    parent_active[level + 1] += active[level]
+
+            level_counts = {str(level + 1): count for level, count in enumerate(counts) if count}
+            active_counts = {str(level + 1): count for level, count in enumerate(active) if count}
+            values = {
+                "total_directs": counts[0],
+                "total_team_size": sum(counts),
+                "active_directs": active[0],
+                "active_team_size": sum(active),
+            }
+            current = stored.get(uid)
+            if current is None:
+                missing += 1
+                inserts.append({"user_id": uid, **values})
+                created.append(uid)
+                level_writes[uid] = level_counts
+                active_writes[uid] = active_counts
+            elif current[1:] != (*values.values(), level_counts, active_counts):
+                drifted += 1
+                changed.append(uid)
+                updates.append({"id": current[0], **values})
+                level_writes[uid] = level_counts
+                active_writes[uid] = active_counts
+                if len(sample) < sample_size:
+                    sample.append({
+                        "user_id": uid,
+                        "stored": {
+                            "total_directs": current[1],
+                            "total_team_size": current[2],
+                            "active_directs": current[3],
+                            "active_team_size": current[4],
+                            "level_breakdown": current[5],
+                            "active_level_breakdown": current[6],
+                        },
+                        "expected": {**values, "level_breakdown": level_counts, "active_level_breakdown": active_counts},
+                    })
+
+            if not dry_run and len(updates) >= batch_size:
+                db.execute(update(ReferralStat), updates)
+                updates = []
+            if not dry_run and len(inserts) >= batch_size:
+                db.execute(insert(ReferralStat), inserts)
+                inserts = []
+            if not dry_run and len(level_writes) >= batch_size:
+                ReferralService.write_level_counts(db, level_writes, active_writes)
+                level_writes, active_writes = {}, {}
+
+        if not dry_run:
+            if updates:
+                db.execute(update(ReferralStat), updates)
+            if inserts:
+                db.execute(insert(ReferralStat), inserts)
+            if level_writes:
+                ReferralService.write_level_counts(db, level_writes, active_writes)
+            ReferralService.bump_subtree_versions(db, changed)
+            # Rewritten rows already include anything still queued for them
+            written = changed + created
+            for i in range(0, len(written), batch_size):
+                db.execute(delete(StatsOutbox).where(StatsOutbox.user_id.in_(written[i:i + batch_size])))
+            db.commit()
+
+        return {
+            "dry_run": dry_run,
+            "users": len(parent_of),
+            "drifted": drifted,
+            "missing": missing,
+            "written": 0 if dry_run else drifted + missing,
+            "unreachable": sorted(set(parent_of) - set(order)),
+            "sample": sample,
+        }
+
+    @staticmethod
+    def verify_stats(db: Session, user_id: int, repair: bool = False) -> Dict[str, Any]:
+        """
+        Compare the stored stats of a user with a full recompute of the downline.
+        Returns the stored and expected values; with repair=True a drifted row
+        is overwritten using update_stats.
+        """
+        tree = ReferralService.get_referral_tree_recursive(db, user_id, max_depth=MAX_LEVELS)
+        level_counts = {}
+        active_counts = {}
+        for node in tree:
+            lvl = str(node['level'])
+            level_counts[lvl] = level_counts.get(lvl, 0) + 1
+            if node['is_active']:
+                active_counts[lvl] = active_counts.get(lvl, 0) + 1
+        expected = {
+            "total_directs": level_counts.get("1", 0),
+            "total_team_size": len(tree),
+            "active_directs": active_counts.get("1", 0),
+            "active_team_size": sum(active_counts.values()),
+            "level_breakdown": level_counts,
+            "active_level_breakdown": active_counts,
+        }
+
+        stat = db.query(ReferralStat).filter(ReferralStat.user_id == user_id).first()
+        stored = None
+        if stat:
+            stored = {
+                "total_directs": stat.total_directs or 0,
+                "total_team_size": stat.total_team_size or 0,
+                "active_directs": stat.active_directs,
+                "active_team_size": stat.active_team_size,
+                "level_breakdown": stat.level_breakdown or {},
+                "active_level_breakdown": stat.active_level_breakdown or {},
+            }
+
+        drifted = stored != expected
+        if drifted and repair:
+            ReferralService.update_stats(db, user_id)
+
+        return {
+            "user_id": user_id,
+            "stored": stored,
+            "expected": expected,
+            "drifted": drifted,
+            "repaired": drifted and repair,
+        }
+
+    @staticmethod
+    def bump_subtree_versions(db: Session, user_ids: List[int], chunk_size: int = 500):
+        """
+        Mark the subtrees of these users as changed, e.g. after a member's
+        is_active flipped or their stats were rewritten in bulk. Cached tree
+        and stats responses of those users stop matching. Not committed here.
+        """
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), chunk_size):
+            db.execute(
+                update(ReferralStat)
+                .where(ReferralStat.user_id.in_(user_ids[i:i + chunk_size]))
+                .values(subtree_version=func.coalesce(ReferralStat.subtree_version, 0) + 1)
+                .execution_options(synchronize_session=False)
+            )
+
+    @staticmethod
+    def increment_upline_stats(db: Session, upline: List[Tuple[int, int]], active: bool = True):
+        """
+        Account for one new member below each upline without touching the downline.
+        `upline` holds (ancestor_id, depth) pairs as returned by get_upline; the
+        member lands on level `depth` of that ancestor and, if `active`, in its
+        active counts too. Counters are bumped with
+        SQL-side increments, including the one referral_level_stats row of that
+        level; the stats rows are locked first, in user_id order, so concurrent
+        signups cannot deadlock. Nothing is committed here.
+        """
+        if not upline:
+            return
+
+        user_ids = sorted(uid for uid, _ in upline)
+        present = set(db.scalars(
+            select(ReferralStat.user_id).where(
+                ReferralStat.user_id.in_(user_ids)
+            ).order_by(ReferralStat.user_id).with_for_update()
+        ))
+
+        if present:
+            db.execute(
+                update(ReferralStat)
+                .where(ReferralStat.user_id.in_(present))
+                .values(
+                    total_team_size=ReferralStat.total_team_size + 1,
+                    active_team_size=ReferralStat.active_team_size + int(active),
+                    subtree_version=func.coalesce(ReferralStat.subtree_version, 0) + 1,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            directs = [uid for uid, level in upline if level == 1 and uid in present]
+            if directs:
+                db.execute(
+                    update(ReferralStat)
+                    .where(ReferralStat.user_id.in_(directs))
+                    .values(
+                        total_directs=ReferralStat.total_directs + 1,
+                        active_directs=ReferralStat.active_directs + int(active),
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+            ReferralService.increment_level_counts(
+                db, [(uid, level, 1, int(active)) for uid, level in upline if uid in present]
+            )
+
+        for uid, _ in upline:
+            if uid not in present:
+                # No row yet (data predating ensure_stats_rows): build it from
+                # scratch, which already includes the new member.
+                ReferralService.update_stats(db, uid, commit=False)
+
+        db.flush()
+
+    @staticmethod
+    def apply_stats_deltas(db: Session, deltas: Dict[int, Tuple[int, int, int, int]]):
+        """
+        Add (total_team_size, active_team_size, total_directs, active_directs)
+        deltas to referral_stats rows and bump their subtree_version, one
+        UPDATE per distinct delta. Not committed here.
+        """
+        by_delta: Dict[Tuple[int, int, int, int], List[int]] = {}
+        for uid, delta in deltas.items():
+            by_delta.setdefault(tuple(delta), []).append(uid)
+        for (team, active_team, directs, active_directs), uids in by_delta.items():
+            db.execute(
+                update(ReferralStat)
+                .where(ReferralStat.user_id.in_(uids))
+                .values(
+                    total_team_size=ReferralStat.total_team_size + team,
+                    active_team_size=ReferralStat.active_team_size + active_team,
+                    total_directs=ReferralStat.total_directs + directs,
+                    active_directs=ReferralStat.active_directs + active_directs,
+                    subtree_version=func.coalesce(ReferralStat.subtree_version, 0) + 1,
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+    @staticmethod
+    def set_active(db: Session, user_ids: List[int], is_active: bool, chunk_size: int = 500) -> List[int]:
+        """
+        Activate or deactivate users and adjust the active counts of their
+        uplines in one batched pass: the ancestors of all flipped users come
+        from the closure index a chunk at a time, their deltas are summed per
+        (ancestor, level), and then applied with one UPDATE per distinct delta
+        and one level upsert. The super admin and users already in the target
+        state are left alone. Returns the ids that changed; not committed here.
+        """
+        user_ids = sorted(set(user_ids))
+        changed = []
+        for i in range(0, len(user_ids), chunk_size):
+            changed.extend(db.scalars(
+                select(User.id).where(
+                    User.id.in_(user_ids[i:i + chunk_size]),
+                    User.is_active.isnot(is_active),
+                    User.role != "super_admin",
+                ).order_by(User.id)
+            ))
+        if not changed:
+            return []
+
+        sign = 1 if is_active else -1
+        level_deltas: Dict[Tuple[int, int], int] = {}
+        for i in range(0, len(changed), chunk_size):
+            for ancestor_id, depth, count in db.execute(
+                select(ReferralClosure.ancestor_id, ReferralClosure.depth, func.count()).where(
+                    ReferralClosure.descendant_id.in_(changed[i:i + chunk_size]),
+                    ReferralClosure.depth.between(1, MAX_LEVELS),
+                ).group_by(ReferralClosure.ancestor_id, ReferralClosure.depth)
+            ):
+                key = (ancestor_id, depth)
+                level_deltas[key] = level_deltas.get(key, 0) + sign * count
+
+        team_deltas: Dict[int, int] = {}
+        for (ancestor_id, _), delta in level_deltas.items():
+            team_deltas[ancestor_id] = team_deltas.get(ancestor_id, 0) + delta
+        ancestor_ids = sorted(team_deltas)
+        present = set()
+        for i in range(0, len(ancestor_ids), chunk_size):
+            present.update(db.scalars(
+                select(ReferralStat.user_id).where(
+                    ReferralStat.user_id.in_(ancestor_ids[i:i + chunk_size])
+                ).order_by(ReferralStat.user_id).with_for_update()
+            ))
+
+        for i in range(0, len(changed), chunk_size):
+            db.execute(
+                update(User)
+                .where(User.id.in_(changed[i:i + chunk_size]))
+                .values(is_active=is_active)
+                .execution_options(synchronize_session=False)
+            )
+        ReferralService.apply_stats_deltas(db, {
+            uid: (0, team_deltas[uid], 0, level_deltas.get((uid, 1), 0))
+            for uid in ancestor_ids if uid in present
+        })
+        ReferralService.increment_level_counts(db, [
+            (uid, level, 0, delta) for (uid, level), delta in level_deltas.items() if uid in present
+        ])
+        for uid in ancestor_ids:
+            if uid not in present:
+                ReferralService.update_stats(db, uid, commit=False)
+        db.flush()
+        return changed
+
+    @staticmethod
+    def subtree_histogram(db: Session, user_id: int) -> Tuple[List[int], List[int]]:
+        """
+        Members, and active members, of a user's subtree per depth, the user
+        itself at depth 0, up to the depth that can still land within
+        MAX_LEVELS of an ancestor.
+        """
+        histogram = [0] * MAX_LEVELS
+        active = [0] * MAX_LEVELS
+        for depth, count, active_count in db.execute(
+            select(ReferralClosure.depth, func.count(), count_active()).join(
+                User, User.id == ReferralClosure.descendant_id
+            ).where(
+                ReferralClosure.ancestor_id == user_id,
+                ReferralClosure.depth < MAX_LEVELS,
+            ).group_by(ReferralClosure.depth)
+        ):
+            histogram[depth] = count
+            active[depth] = active_count
+        return histogram, active
+
+    @staticmethod
+    def would_create_cycle(db: Session, user_id: int, new_referrer_id: Optional[int]) -> bool:
+        """
+        True if new_referrer_id is the user or sits anywhere in their downline,
+        however deep: the referrer's chain is walked MAX_LEVELS at a time.
+        """
+        if new_referrer_id == user_id:
+            return True
+        seen = set()
+        current = new_referrer_id
+        while current is not None:
+            upline = ReferralService.get_upline(db, current, MAX_LEVELS)
+            for ancestor_id, _ in upline:
+                if ancestor_id == user_id:
+                    return True
+                if ancestor_id in seen:
+                    # An existing cycle above the new referrer, not through the user
+                    return False
+                seen.add(ancestor_id)
+            current = upline[-1][0] if len(upline) == MAX_LEVELS else None
+        return False
+
+    @staticmethod
+    def move_subtree(db: Session, user_id: int, new_referrer_id: Optional[int]) -> Dict[str, Any]:
+        """
+        Re-parent a user, with their whole downline, under new_referrer_id
+        (None makes them a root).
+
+        Stats are adjusted with deltas instead of recomputed: a subtree member
+        at depth d below the user sits on level k + d of the ancestor k levels
+        above the user, so the subtree's own per-depth histogram gives every
+        level bucket and team size change of the old and new ancestor chains,
+        O(MAX_LEVELS^2) increments in all. The closure index only changes for
+        (outside ancestor, subtree member) pairs. Committed here.
+        """
+        user = db.get(User, user_id)
+        if user is None:
+            raise ValueError("User not found")
+        old_referrer_id = user.referred_by_id
+        if new_referrer_id == old_referrer_id:
+            return {"user_id": user_id, "old_referrer_id": old_referrer_id,
+                    "new_referrer_id": new_referrer_id, "subtree_size": 0, "ancestors_updated": 0}
+        if new_referrer_id is not None and db.get(User, new_referrer_id) is None:
+            raise ValueError("New referrer not found")
+        if ReferralService.would_create_cycle(db, user_id, new_referrer_id):
+            raise ValueError("New referrer is in the user's downline")
+
+        histogram, active_histogram = ReferralService.subtree_histogram(db, user_id)
+        old_upline = ReferralService.get_upline(db, user_id, MAX_LEVELS)
+        new_upline = []
+        if new_referrer_id is not None:
+            new_upline = [(new_referrer_id, 1)] + [
+                (uid, depth + 1) for uid, depth in ReferralService.get_upline(db, new_referrer_id, MAX_LEVELS - 1)
+            ]
+
+        # (ancestor, level) -> [members, active members] deltas of both
+        # chains; an ancestor on both nets out
+        level_deltas: Dict[Tuple[int, int], List[int]] = {}
+        for upline, sign in ((old_upline, -1), (new_upline, 1)):
+            for ancestor_id, k in upline:
+                for d in range(MAX_LEVELS - k + 1):
+                    if histogram[d]:
+                        delta = level_deltas.setdefault((ancestor_id, k + d), [0, 0])
+                        delta[0] += sign * histogram[d]
+                        delta[1] += sign * active_histogram[d]
+        team_deltas: Dict[int, List[int]] = {}
+        for (ancestor_id, _), (delta, active_delta) in level_deltas.items():
+            team_delta = team_deltas.setdefault(ancestor_id, [0, 0])
+            team_delta[0] += delta
+            team_delta[1] += active_delta
+        directs_deltas: Dict[int, List[int]] = {}
+        if old_referrer_id is not None:
+            directs_deltas[old_referrer_id] = [-1, -int(bool(user.is_active))]
+        if new_referrer_id is not None:
+            directs_delta = directs_deltas.setdefault(new_referrer_id, [0, 0])
+            directs_delta[0] += 1
+            directs_delta[1] += int(bool(user.is_active))
+
+        ancestor_ids = sorted({uid for uid, _ in old_upline} | {uid for uid, _ in new_upline})
+        present = set(db.scalars(
+            select(ReferralStat.user_id).where(
+                ReferralStat.user_id.in_(ancestor_ids)
+            ).order_by(ReferralStat.user_id).with_for_update()
+        ))
+
+        # Closure: drop the old (outside ancestor, member) rows, add the new ones
+        members = select(ReferralClosure.descendant_id).where(ReferralClosure.ancestor_id == user_id)
+        old_ids = [uid for uid, _ in old_upline]
+        if old_ids:
+            db.execute(
+                delete(ReferralClosure).where(
+                    ReferralClosure.ancestor_id.in_(old_ids),
+                    ReferralClosure.descendant_id.in_(members.scalar_subquery()),
+                ).execution_options(synchronize_session=False)
+            )
+        for ancestor_id, k in new_upline:
+            db.execute(
+                insert(ReferralClosure).from_select(
+                    ["ancestor_id", "descendant_id", "depth"],
+                    select(
+                        literal(ancestor_id),
+                        ReferralClosure.descendant_id,
+                        ReferralClosure.depth + k,
+                    ).where(
+                        ReferralClosure.ancestor_id == user_id,
+                        ReferralClosure.depth <= MAX_LEVELS - k,
+                    ),
+                )
+            )
+
+        user.referred_by_id = new_referrer_id
+        CounterService.increment(db, GRAPH_MOVES)
+        # A root that gets a referrer is a new referral, and the other way round
+        CounterService.increment(
+            db, TOTAL_REFERRALS, (new_referrer_id is not None) - (old_referrer_id is not None)
+        )
+
+        ReferralService.apply_stats_deltas(db, {
+            uid: (*team_deltas.get(uid, (0, 0)), *directs_deltas.get(uid, (0, 0)))
+            for uid in ancestor_ids if uid in present
+        })
+        ReferralService.increment_level_counts(db, [
+            (uid, level, delta, active_delta)
+            for (uid, level), (delta, active_delta) in level_deltas.items()
+            if (delta or active_delta) and uid in present
+        ])
+        db.execute(
+            delete(ReferralLevelStat).where(
+                ReferralLevelStat.user_id.in_(ancestor_ids),
+                ReferralLevelStat.count == 0,
+                # Until queued signups are applied a level can have no
+                # members stored but still an active count owed to it
+                ReferralLevelStat.active_count == 0,
+            )
+        )
+        for uid in ancestor_ids:
+            if uid not in present:
+                ReferralService.update_stats(db, uid, commit=False)
+
+        db.commit()
+        return {
+            "user_id": user_id,
+            "old_referrer_id": old_referrer_id,
+            "new_referrer_id": new_referrer_id,
+            # Members within MAX_LEVELS - 1 of the user, the ones any ancestor counts
+            "subtree_size": sum(histogram),
+            "ancestors_updated": len(ancestor_ids),
+        }
+
+    @staticmethod
+    def enqueue_stats_refresh(db: Session, user_ids: List[int]):
+        """
+        Queue users for a full stats refresh by the background stats worker.
+        Their subtree_version is bumped right away so cached trees and stats
+        stop matching before the worker catches up. Rows are added to the
+        caller's transaction and are not committed here.
+        """
+        if user_ids:
+            db.execute(insert(StatsOutbox), [{"user_id": uid} for uid in user_ids])
+            ReferralService.bump_subtree_versions(db, sorted(user_ids))
+
+    @staticmethod
+    def enqueue_upline_increments(db: Session, upline: List[Tuple[int, int]]):
+        """
+        Queue the increments increment_upline_stats would apply for one new
+        active member, as (ancestor_id, level) outbox rows for the stats
+        worker to sum up. subtree_version is bumped right away, as in
+        enqueue_stats_refresh. Not committed here.
+        """
+        if upline:
+            db.execute(insert(StatsOutbox), [{"user_id": uid, "level": level} for uid, level in upline])
+            ReferralService.bump_subtree_versions(db, sorted(uid for uid, _ in upline))
+
+    @staticmethod
+    def apply_queued_stats(db: Session, queued: List[Tuple[int, Optional[int]]]):
+        """
+        Apply drained (user_id, level) outbox rows: the members queued per
+        (user, level) are added with one UPDATE per distinct delta and one
+        level upsert, so a burst under one leader costs one write per
+        ancestor. Users with a full refresh queued (level NULL) or without a
+        stats row are recomputed instead. Not committed here.
+        """
+        level_deltas: Dict[Tuple[int, int], int] = {}
+        refresh = set()
+        for uid, level in queued:
+            if level is None:
+                refresh.add(uid)
             else:
-                break
+                level_deltas[(uid, level)] = level_deltas.get((uid, level), 0) + 1
+
+        team_deltas: Dict[int, int] = {}
+        for (uid, _), delta in level_deltas.items():
+            if uid not in refresh:
+                team_deltas[uid] = team_deltas.get(uid, 0) + delta
+        present = set()
+        if team_deltas:
+            present.update(db.scalars(
+                select(ReferralStat.user_id).where(
+                    ReferralStat.user_id.in_(sorted(team_deltas))
+                ).order_by(ReferralStat.user_id).with_for_update()
+            ))
+
+        ReferralService.apply_stats_deltas(db, {
+            uid: (delta, delta, level_deltas.get((uid, 1), 0), level_deltas.get((uid, 1), 0))
+            for uid, delta in team_deltas.items() if uid in present
+        })
+        ReferralService.increment_level_counts(db, [
+            (uid, level, delta, delta) for (uid, level), delta in level_deltas.items() if uid in present
+        ])
+        for uid in sorted(refresh | (set(team_deltas) - present)):
+            ReferralService.update_stats(db, uid, commit=False)
+        db.flush()
+
+    @staticmethod
+    def propagate_stats_update(db: Session, new_user_id: int, incremental: bool = True, defer: bool = False):
+        """
+        When a new user is added, update stats for all 20 uplines.
+        By default each upline only gets the increments for the level the new user
+        lands on. incremental=False recomputes every upline from its full downline,
+        and defer=True only queues those increments for the stats worker.
+        """
+        # All ancestors in one statement instead of one query per level
+        upline = ReferralService.get_upline(db, new_user_id, MAX_LEVELS)
         
+        if defer:
+            ReferralService.enqueue_upline_increments(db, upline)
+            return
+
+        if incremental:
+            ReferralService.increment_upline_stats(db, upline)
+            return
+
         # Update stats for all found uplines
-        for uid in uplines:
+        for uid, _ in upline:
             ReferralService.update_stats(db, uid)
@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, func
+
+from database import SessionLocal
+from models import StatsOutbox
+from services.referral_service import ReferralService
+
+logger = logging.getLogger(__name__)
+
+# "deferred": registration only queues the upline increments and the worker applies them.
+# "inline": registration applies incremental updates before responding.
+STATS_PROPAGATION = os.getenv("STATS_PROPAGATION", "deferred")
+STATS_WORKER_INTERVAL = float(os.getenv("STATS_WORKER_INTERVAL", "1.0"))
+STATS_WORKER_BATCH_SIZE = int(os.getenv("STATS_WORKER_BATCH_SIZE", "500"))
+# Users refreshed per write transaction: on SQLite a batch holds the single
+# write lock, which signups queue behind, until it commits
+STATS_WORKER_COMMIT_SIZE = int(os.getenv("STATS_WORKER_COMMIT_SIZE", "50"))
+
+
+class StatsWorker:
+    """
+    In-process worker draining the stats_outbox table.
+
+    Every pass takes up to `batch_size` distinct users, deletes their queued
+    rows and applies them summed per (user, level): however many signups
+    queued the same upline in the meantime, it gets one update. Rows asking
+    for a full refresh are recomputed from the closure index instead.
+    """
+
+    def __init__(self, session_factory=SessionLocal, interval: float = STATS_WORKER_INTERVAL,
+                 batch_size: int = STATS_WORKER_BATCH_SIZE, commit_size: int = STATS_WORKER_COMMIT_SIZE):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        # Counters exposed through status()
+        self.batches = 0
+        self.rows_processed = 0
+        self.users_refreshed = 0
+        self.last_batch_at: Optional[datetime] = None
+        self.last_batch_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stats-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.drain()
+            except Exception as exc:
+                self.last_error = repr(exc)
+                logger.exception("Stats worker pass failed")
+
+    def run_once(self) -> int:
+        """
+        Process one batch. Returns the number of users refreshed (0 when idle).
+        """
+        with self._lock:
+            db = self.session_factory()
+            try:
+                started = time.perf_counter()
+                user_ids = [
+                    uid for (uid,) in db.query(StatsOutbox.user_id)
+                    .distinct()
+                    .order_by(StatsOutbox.user_id)
+                    .limit(self.batch_size)
+                ]
+                if not user_ids:
+                    return 0
+
+                # Each group's rows are deleted and applied in one transaction;
+                # rows queued later trigger another pass
+                rows_processed = 0
+                for start in range(0, len(user_ids), self.commit_size):
+                    group = user_ids[start:start + self.commit_size]
+                    queued = db.execute(
+                        delete(StatsOutbox)
+                        .where(StatsOutbox.user_id.in_(group))
+                        .returning(StatsOutbox.user_id, StatsOutbox.level)
+                    ).all()
+                    ReferralService.apply_queued_stats(db, queued)
+                    db.commit()
+                    rows_processed += len(queued)
+
+                self.batches += 1
+                self.rows_processed += rows_processed
+                self.users_refreshed += len(user_ids)
+                self.last_batch_at = datetime.utcnow()
+                self.last_batch_seconds = time.perf_counter() - started
+                self.last_error = None
+                return len(user_ids)
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def drain(self) -> int:
+        """
+        Process batches until the outbox is empty. Returns users refreshed.
+        """
+        total = 0
+        while True:
+            refreshed = self.run_once()
+            if not refreshed:
+                return total
+            total += refreshed
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Queue depth and lag, plus counters from the worker's previous passes.
+        """
+        db = self.session_factory()
+        try:
+            pending_rows, pending_users, oldest = db.query(
+                func.count(StatsOutbox.id),
+                func.count(func.distinct(StatsOutbox.user_id)),
+                func.min(StatsOutbox.enqueued_at),
+            ).one()
+        finally:
+            db.close()
+
+        lag_seconds = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+        return {
+            "mode": STATS_PROPAGATION,
+            "running": self.running,
+            "pending_rows": pending_rows,
+            "pending_users": pending_users,
+            "oldest_enqueued_at": oldest,
+            "lag_seconds": lag_seconds,
+            "batches": self.batches,
+            "rows_processed": self.rows_processed,
+            "users_refreshed": self.users_refreshed,
+            "last_batch_at": self.last_batch_at,
+            "last_batch_seconds": self.last_batch_seconds,
+            "last_error": self.last_error,
+        }
+
+
+stats_worker = StatsWorker()
@@ -0,0 +1,87 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Registers many users in parallel against a throwaway database, then checks
+# that every referral_stats row and system counter matches a full recount.
+
+def run_stress(registrations, threads, mode):
+    # Configure before the app is imported: the database lives in the cwd
+    os.environ["STATS_PROPAGATION"] = mode
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+    workdir = tempfile.mkdtemp(prefix="stress_register_")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from fastapi.testclient import TestClient
+    import main, models
+    from database import SessionLocal
+    from services.referral_service import ReferralService
+    from services.counter_service import CounterService
+    from services.stats_worker import stats_worker
+
+    print(f"🚀 {registrations} registrations on {threads} threads ({mode} stats) in {workdir}")
+
+    with TestClient(main.app) as client:
+        codes = ["SUPERADMIN"]
+        failures = []
+
+        def register(i):
+            # Pick from the codes seen so far, so uplines overlap heavily
+            payload = {
+                "email": f"stress{i}@example.com",
+                "username": f"stress_{i}",
+                "password": "password123",
+                "referral_code": random.choice(codes),
+            }
+            response = client.post("/api/auth/register", json=payload)
+            if response.status_code == 200:
+                codes.append(response.json()["referral_code"])
+            else:
+                failures.append((i, response.status_code, response.text))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(register, range(registrations)))
+        elapsed = time.perf_counter() - started
+        print(f"✅ {registrations - len(failures)} registered in {elapsed:.1f}s "
+              f"({registrations / elapsed:.0f}/s), {len(failures)} failed")
+        for failure in failures[:10]:
+            print(f"❌ Registration {failure[0]}: {failure[1]} {failure[2]}")
+
+        if mode == "deferred":
+            stats_worker.drain()
+
+        db = SessionLocal()
+        try:
+            drifted = []
+            for (user_id,) in db.query(models.User.id):
+                result = ReferralService.verify_stats(db, user_id)
+                if result["drifted"]:
+                    drifted.append(result)
+            counter_drift = CounterService.reconcile(db)
+            users = db.query(models.User).count()
+        finally:
+            db.close()
+
+    print(f"Users: {users}, drifted stats rows: {len(drifted)}, drifted counters: {len(counter_drift)}")
+    for result in drifted[:5]:
+        print(f"❌ User {result['user_id']}: stored {result['stored']} expected {result['expected']}")
+    for name, values in counter_drift.items():
+        print(f"❌ Counter {name}: {values}")
+
+    ok = not failures and not drifted and not counter_drift and users == registrations + 1
+    print("✅ Consistent" if ok else "❌ Inconsistent")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel registration stress test.")
+    parser.add_argument("-n", "--registrations", type=int, default=200)
+    parser.add_argument("-t", "--threads", type=int, default=16)
+    parser.add_argument("--mode", choices=["inline", "deferred"], default="inline")
+    args = parser.parse_args()
+    sys.exit(0 if run_stress(args.registrations, args.threads, args.mode) else 1)
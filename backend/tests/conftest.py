@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+
+# Point the app at a throwaway database before anything imports database.py
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="mlm_tests_"), "test.db")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import models
+from database import Base, SessionLocal, engine
+from services.counter_service import CounterService
+from services.referral_service import ReferralService
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def add_user(db):
+    """Register a user the way the signup endpoint does, with inline stats."""
+    created = []
+
+    def add(referrer_id=None, is_active=True):
+        n = len(created) + 1
+        user = models.User(
+            email=f"user{n}@example.com",
+            username=f"user{n}",
+            hashed_password="x",
+            role="user",
+            is_active=is_active,
+            permissions={},
+            referral_code=f"CODE{n:04d}",
+            referred_by_id=referrer_id,
+        )
+        db.add(user)
+        db.flush()
+        ReferralService.index_user(db, user.id, referrer_id)
+        db.add(models.ReferralStat(user_id=user.id, total_directs=0, total_team_size=0))
+        if referrer_id:
+            ReferralService.increment_upline_stats(
+                db, ReferralService.get_upline(db, user.id, 20), active=is_active
+            )
+        CounterService.record_users_created(db, active=int(is_active), referred=1 if referrer_id else 0)
+        db.commit()
+        created.append(user.id)
+        return user.id
+
+    return add
+
+
+@pytest.fixture
+def client(db):
+    """The app on the test database, with its in-process caches emptied."""
+    from fastapi.testclient import TestClient
+
+    import auth
+    import main
+    from services.leaderboard import leaderboard_snapshot
+    from services.referral_codes import referral_code_cache
+    from services.response_cache import response_cache
+
+    for cache in (auth.principal_cache, leaderboard_snapshot, referral_code_cache, response_cache):
+        cache.clear()
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def admin_headers(client):
+    response = client.post("/api/auth/login", json={"email": "superadmin@example.com", "password": "superadmin123"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
@@ -0,0 +1,42 @@
+import auth
+import models
+
+
+def register_and_login(client):
+    response = client.post("/api/auth/register", json={
+        "email": "member@example.com", "username": "member", "password": "password123",
+    })
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+    token = client.post("/api/auth/login", json={"email": "member@example.com", "password": "password123"}).json()["access_token"]
+    return user_id, {"Authorization": f"Bearer {token}"}
+
+
+def test_admin_changes_reach_a_cached_principal(client, admin_headers):
+    user_id, headers = register_and_login(client)
+    assert client.get("/api/auth/me", headers=headers).json()["role"] == "user"
+    assert auth.principal_cache.get(user_id) is not None
+
+    response = client.patch(f"/api/admin/users/{user_id}", json={"role": "admin"}, headers=admin_headers)
+    assert response.status_code == 200
+    assert client.get("/api/auth/me", headers=headers).json()["role"] == "admin"
+
+    response = client.post("/api/admin/users/activation", json={"user_ids": [user_id], "is_active": False},
+                           headers=admin_headers)
+    assert response.json()["changed"] == 1
+    assert client.get("/api/auth/me", headers=headers).json()["is_active"] is False
+
+
+def test_principal_loaded_before_an_invalidation_is_not_cached(client, db):
+    user_id, _ = register_and_login(client)
+    user = db.get(models.User, user_id)
+
+    # A request reads the user, then an admin commits a change and invalidates
+    generation = auth.principal_cache.generation
+    stale = auth.Principal(user)
+    auth.principal_cache.invalidate(user_id)
+    auth.principal_cache.put(stale, generation)
+    assert auth.principal_cache.get(user_id) is None
+
+    auth.principal_cache.put(stale, auth.principal_cache.generation)
+    assert auth.principal_cache.get(user_id) is stale
@@ -0,0 +1,40 @@
+import json
+
+import models
+from services.bulk_import import BulkImportService
+
+
+def import_text(db, data, fmt):
+    return BulkImportService.import_users(db, BulkImportService.parse_rows(data, fmt), hash_workers=1)
+
+
+def test_blank_is_active_imports_active(db):
+    data = "email,username,hashed_password,is_active\n" \
+           "a@example.com,a,x,\n" \
+           "b@example.com,b,x,no\n" \
+           "c@example.com,c,x,TRUE\n"
+    report = import_text(db, data, "csv")
+
+    assert report["created"] == 3
+    active = dict(db.query(models.User.username, models.User.is_active))
+    assert active == {"a": True, "b": False, "c": True}
+
+
+def test_wrongly_typed_jsonl_fields_are_row_errors(db):
+    rows = [
+        {"email": "ok@example.com", "username": "ok", "hashed_password": "x"},
+        {"email": 5, "username": "num", "hashed_password": "x"},
+        {"email": "p@example.com", "username": "p", "password": 12345678},
+        {"email": "r@example.com", "username": "r", "hashed_password": "x", "referrer_code": None},
+        {"email": "s@example.com", "username": "s", "hashed_password": "x", "is_active": "maybe"},
+        ["not", "an", "object"],
+    ]
+    report = import_text(db, "\n".join(json.dumps(row) for row in rows), "jsonl")
+
+    assert report["created"] == 2
+    assert {error["row"]: error["error"] for error in report["errors"]} == {
+        2: "email must be text",
+        3: "password must be text",
+        5: "is_active must be true or false",
+        6: "Row must be an object",
+    }
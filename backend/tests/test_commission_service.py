@@ -0,0 +1,32 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from services.commission_service import CommissionService
+
+
+def test_distribute_reports_bad_rows_and_totals_only_used_ones(db, add_user):
+    top = add_user()
+    trader = add_user(top)
+
+    user_ids = np.array([trader, 9999, trader, trader, trader], dtype=np.int64)
+    volumes = np.array([100.0, 50.0, -5.0, np.nan, 20.0])
+    report = CommissionService.distribute(db, date(2026, 1, 2), user_ids, volumes)
+
+    assert report["traders"] == 1
+    assert report["total_volume"] == 120.0
+    assert report["total_paid"] == 120.0 * 5.5 / 100
+    assert report["rejected"] == 3
+    assert [(r["row"], r["error"]) for r in report["rejected_rows"]] == [
+        (2, "Unknown user 9999"),
+        (3, "Volume must be a non-negative number, got -5.0"),
+        (4, "Volume must be a non-negative number, got nan"),
+    ]
+
+
+def test_parse_trades_names_the_bad_line():
+    with pytest.raises(ValueError, match="Line 3: .*'abc'"):
+        CommissionService.parse_trades(b"user_id,volume\n1,10\n2,abc\n", "csv")
+    with pytest.raises(ValueError, match="Missing column"):
+        CommissionService.parse_trades(b"user_id,amount\n1,10\n", "csv")
@@ -0,0 +1,45 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+from services.counter_service import CounterService
+from services.referral_service import ReferralService
+from services.stats_worker import stats_worker
+
+
+@pytest.fixture(params=["inline", "deferred"])
+def stats_mode(request, monkeypatch):
+    # Read by the startup hook that starts the worker, so set before the client
+    monkeypatch.setattr(main, "STATS_PROPAGATION", request.param)
+    return request.param
+
+
+def test_parallel_signups_leave_no_stats_drift(stats_mode, client, db):
+    rng = random.Random(7)
+    codes = ["SUPERADMIN"]
+    failures = []
+
+    def register(i):
+        # Referrers come from the codes handed out so far, so uplines overlap
+        response = client.post("/api/auth/register", json={
+            "email": f"parallel{i}@example.com",
+            "username": f"parallel_{i}",
+            "password": "password123",
+            "referral_code": rng.choice(codes),
+        })
+        if response.status_code == 200:
+            codes.append(response.json()["referral_code"])
+        else:
+            failures.append((i, response.status_code, response.text))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(register, range(60)))
+    stats_worker.drain()
+
+    assert failures == []
+    report = ReferralService.rebuild_all_stats(db, dry_run=True)
+    assert report["users"] == 61
+    assert report["drifted"] == 0 and report["missing"] == 0, report["sample"]
+    assert CounterService.reconcile(db) == {}
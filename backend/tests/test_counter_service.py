@@ -0,0 +1,41 @@
+import threading
+
+from database import SessionLocal
+from services.counter_service import CounterService, TOTAL_USERS
+
+
+def test_reconcile_keeps_increments_committed_during_the_recount(db, add_user, monkeypatch):
+    add_user()
+    add_user()
+    db.commit()
+    CounterService.increment(db, TOTAL_USERS, 5)
+    db.commit()
+
+    compute = CounterService.compute
+    started = threading.Event()
+
+    def increment_elsewhere():
+        other = SessionLocal()
+        try:
+            started.set()
+            CounterService.increment(other, TOTAL_USERS)
+            other.commit()
+        finally:
+            other.close()
+
+    worker = threading.Thread(target=increment_elsewhere)
+
+    def compute_with_signup(session):
+        counters = compute(session)
+        # A signup increments while the recount's result is being applied
+        worker.start()
+        started.wait()
+        return counters
+
+    monkeypatch.setattr(CounterService, "compute", staticmethod(compute_with_signup))
+    drift = CounterService.reconcile(db)
+    worker.join()
+
+    assert drift[TOTAL_USERS] == {"stored": 7, "actual": 2}
+    db.expire_all()
+    assert CounterService.get_counters(db)[TOTAL_USERS] == 3
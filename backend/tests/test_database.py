@@ -0,0 +1,19 @@
+import pytest
+
+from database import async_connect_args, async_url
+
+
+def test_async_url_translates_libpq_parameters():
+    url = "postgresql://app:secret@db:5432/mlm?sslmode=require&connect_timeout=5&application_name=api"
+    assert async_url(url) == "postgresql+asyncpg://app:secret@db:5432/mlm?ssl=require"
+    assert async_connect_args(url) == {"timeout": 5.0, "server_settings": {"application_name": "api"}}
+
+
+def test_async_url_refuses_parameters_asyncpg_lacks():
+    with pytest.raises(ValueError, match="sslrootcert"):
+        async_url("postgresql://app@db/mlm?sslmode=verify-full&sslrootcert=/etc/ca.pem")
+
+
+def test_async_url_for_sqlite():
+    assert async_url("sqlite:///./app.db") == "sqlite+aiosqlite:///./app.db"
+    assert async_connect_args("sqlite:///./app.db") == {}
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+from services.export_service import NetworkExport
+from services.referral_service import ReferralService, MAX_LEVELS
+
+
+def export_rows(db, dataset, since=None):
+    return [row for chunk in NetworkExport(dataset, since=since).iter_chunks(db) for row in chunk]
+
+
+def test_incremental_levels_export_emptied_levels_as_zero(db, add_user):
+    top = add_user()
+    middle = add_user(top)
+    bottom = add_user(middle)
+    since = datetime.utcnow()
+
+    ReferralService.move_subtree(db, bottom, None)
+
+    rows = export_rows(db, "levels", since)
+    levels_of_top = [(level, count) for user_id, level, count, _ in rows if user_id == top]
+    assert len(levels_of_top) == MAX_LEVELS
+    assert levels_of_top[:2] == [(1, 1), (2, 0)]
+    # The full export keeps only non-empty levels
+    assert (top, 2) not in {(user_id, level) for user_id, level, _, _ in export_rows(db, "levels")}
+
+
+def test_incremental_export_reaches_back_by_the_margin(db, add_user, monkeypatch):
+    add_user()
+    later = datetime.utcnow() + timedelta(seconds=60)
+
+    monkeypatch.setattr("services.export_service.EXPORT_WATERMARK_MARGIN", 0)
+    assert export_rows(db, "users", later) == []
+    # A row stamped before the watermark but committed after it is not lost
+    monkeypatch.setattr("services.export_service.EXPORT_WATERMARK_MARGIN", 300)
+    assert len(export_rows(db, "users", later)) == 1
@@ -0,0 +1,73 @@
+import random
+
+from sqlalchemy import select
+
+import models
+from services import referral_service
+from services.graph_index import GraphIndex
+from services.referral_service import ReferralService, MAX_LEVELS
+
+
+def assert_matches_closure(db, index):
+    """Downlines, team sizes and uplines of every user agree with the database."""
+    db.expire_all()
+    downlines = {}
+    for ancestor_id, descendant_id, depth in db.execute(select(
+        models.ReferralClosure.ancestor_id, models.ReferralClosure.descendant_id, models.ReferralClosure.depth
+    ).where(models.ReferralClosure.depth.between(1, MAX_LEVELS))):
+        downlines.setdefault(ancestor_id, set()).add((descendant_id, depth))
+    for user_id in db.scalars(select(models.User.id)):
+        assert set(index.descendants(user_id, MAX_LEVELS)) == downlines.get(user_id, set())
+        assert index.team_size(user_id) == len(downlines.get(user_id, ()))
+        assert index.upline(user_id, MAX_LEVELS) == ReferralService.get_upline(db, user_id, MAX_LEVELS)
+
+
+def test_index_follows_signups_and_moves(db, add_user, monkeypatch):
+    rng = random.Random(9)
+    ids = [add_user()]
+    for _ in range(40):
+        ids.append(add_user(rng.choice(ids)))
+    # Deeper than MAX_LEVELS, so team sizes stop counting at the window
+    for _ in range(MAX_LEVELS + 3):
+        ids.append(add_user(ids[-1]))
+
+    index = GraphIndex()
+    index.load(db, MAX_LEVELS)
+    assert_matches_closure(db, index)
+
+    for _ in range(20):
+        ids.append(add_user(rng.choice(ids)))
+    assert index.sync(db, force=True) == 20
+    assert_matches_closure(db, index)
+
+    def move(user_id, new_referrer_id):
+        try:
+            ReferralService.move_subtree(db, user_id, new_referrer_id)
+            return True
+        except ValueError:
+            db.rollback()
+            return False
+
+    # The only move since the index caught up: applied in place
+    while True:
+        user_id, new_referrer_id = rng.choice(ids), rng.choice(ids)
+        if move(user_id, new_referrer_id):
+            break
+    index.move_user(db, user_id, new_referrer_id)
+    assert index.ready and not index.status()["reloading"]
+    assert_matches_closure(db, index)
+
+    # Moves the index missed: rebuilt in the background, reads fall back meanwhile
+    assert move(ids[5], None)
+    assert move(ids[-1], ids[0])
+    index.sync(db, force=True)
+    assert index.wait_ready(10)
+    assert_matches_closure(db, index)
+
+    # Read paths served from the index give the database's answers
+    monkeypatch.setattr(referral_service, "graph_index", index)
+    for user_id in rng.sample(ids, 10):
+        stmt = ReferralService.tree_statement(user_id, MAX_LEVELS)
+        assert ReferralService.get_referral_tree(db, user_id) == [dict(row) for row in db.execute(stmt).mappings()]
+        upline = ReferralService.get_upline(db, user_id, MAX_LEVELS)
+        assert [(node["id"], node["level"]) for node in ReferralService.get_upline_nodes(db, user_id)] == upline
@@ -0,0 +1,93 @@
+import random
+
+import pytest
+from sqlalchemy import select
+
+import models
+from services.counter_service import CounterService, TOTAL_REFERRALS
+from services.referral_service import ReferralService, MAX_LEVELS
+
+
+def closure_rows(db):
+    return set(db.execute(select(
+        models.ReferralClosure.ancestor_id, models.ReferralClosure.descendant_id, models.ReferralClosure.depth
+    )).all())
+
+
+def assert_consistent(db):
+    """Deltas applied by moves must equal a full recomputation."""
+    db.expire_all()
+    report = ReferralService.rebuild_all_stats(db, dry_run=True)
+    assert report["drifted"] == 0, report
+    moved = closure_rows(db)
+    ReferralService.rebuild_closure(db)
+    db.commit()
+    assert closure_rows(db) == moved
+    counters = CounterService.get_counters(db)
+    assert counters.get(TOTAL_REFERRALS, 0) == CounterService.compute(db)[TOTAL_REFERRALS]
+
+
+def test_random_moves_match_rebuild(db, add_user):
+    rng = random.Random(3)
+    ids = [add_user()]
+    for i in range(60):
+        ids.append(add_user(rng.choice(ids), is_active=i % 4 != 0))
+
+    moved = 0
+    for _ in range(40):
+        user_id = rng.choice(ids)
+        target = rng.choice(ids + [None])
+        try:
+            ReferralService.move_subtree(db, user_id, target)
+            moved += 1
+        except ValueError:
+            db.rollback()
+    assert moved
+    assert_consistent(db)
+
+
+def test_move_to_and_from_root_updates_total_referrals(db, add_user):
+    root = add_user()
+    child = add_user(root)
+    add_user(child)
+    other_root = add_user()
+    assert CounterService.get_counters(db)[TOTAL_REFERRALS] == 2
+
+    ReferralService.move_subtree(db, child, None)
+    assert CounterService.get_counters(db)[TOTAL_REFERRALS] == 1
+    assert_consistent(db)
+
+    ReferralService.move_subtree(db, other_root, child)
+    assert CounterService.get_counters(db)[TOTAL_REFERRALS] == 2
+    assert_consistent(db)
+
+    # Between two referrers the count stays
+    ReferralService.move_subtree(db, other_root, root)
+    assert CounterService.get_counters(db)[TOTAL_REFERRALS] == 2
+    assert_consistent(db)
+
+
+def test_deep_chain_move(db, add_user):
+    chain = [add_user()]
+    for _ in range(MAX_LEVELS + 10):
+        chain.append(add_user(chain[-1]))
+    side = add_user()
+
+    # Levels beyond MAX_LEVELS fall in and out of the ancestors' windows
+    ReferralService.move_subtree(db, chain[5], side)
+    assert_consistent(db)
+    ReferralService.move_subtree(db, chain[5], chain[2])
+    assert_consistent(db)
+
+
+def test_move_into_own_downline_is_refused(db, add_user):
+    chain = [add_user()]
+    for _ in range(MAX_LEVELS + 5):
+        chain.append(add_user(chain[-1]))
+
+    with pytest.raises(ValueError, match="downline"):
+        ReferralService.move_subtree(db, chain[1], chain[-1])
+    with pytest.raises(ValueError, match="downline"):
+        ReferralService.move_subtree(db, chain[1], chain[1])
+    with pytest.raises(ValueError, match="not found"):
+        ReferralService.move_subtree(db, chain[1], 10_000)
@@ -0,0 +1,69 @@
+import random
+
+from services.referral_service import ReferralService
+
+
+def walk(client, url, headers, cursor_param):
+    """Every row of a keyset-paged endpoint, following X-Next-Cursor."""
+    rows, cursor = [], None
+    while True:
+        response = client.get(url + (f"&{cursor_param}={cursor}" if cursor else ""), headers=headers)
+        assert response.status_code == 200
+        rows.extend(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return rows
+
+
+def add_forest(add_user, size=40):
+    rng = random.Random(5)
+    ids = [add_user(), add_user()]
+    for _ in range(size):
+        ids.append(add_user(rng.choice(ids)))
+    return ids
+
+
+def flatten(nodes):
+    for node in nodes:
+        yield node
+        yield from flatten(node["children"])
+
+
+def test_users_pages_cover_every_row_once(client, admin_headers, add_user):
+    ids = add_forest(add_user)
+    everyone = client.get("/api/users", headers=admin_headers).json()
+    assert len(everyone) == len(ids) + 1
+
+    for limit in (1, 7, len(everyone)):
+        paged = walk(client, f"/api/users?limit={limit}", admin_headers, "after_id")
+        assert [user["id"] for user in paged] == [user["id"] for user in everyone]
+
+
+def test_admin_tree_pages_cover_every_row_once(client, admin_headers, add_user):
+    ids = add_forest(add_user)
+    forest = client.get("/api/referral/admin/tree?depth=20", headers=admin_headers).json()
+    assert {node["id"] for node in forest} == set(ids) | {1}
+
+    for limit in (1, 7, len(forest)):
+        paged = walk(client, f"/api/referral/admin/tree?depth=20&limit={limit}", admin_headers, "cursor")
+        assert [(node["level"], node["id"]) for node in paged] == [(node["level"], node["id"]) for node in forest]
+
+
+def test_nested_tree_keeps_every_node_under_its_referrer(client, admin_headers, add_user):
+    ids = add_forest(add_user)
+    root = ids[0]
+    flat = client.get(f"/api/referral/admin/tree?user_id={root}&depth=20", headers=admin_headers).json()
+    nested = client.get(f"/api/referral/admin/tree?user_id={root}&depth=20&nested=true", headers=admin_headers).json()
+
+    nodes = list(flatten(nested))
+    assert sorted(node["id"] for node in nodes) == sorted(node["id"] for node in flat)
+    assert all(node["referred_by_id"] == root for node in nested)
+    for node in nodes:
+        assert all(child["referred_by_id"] == node["id"] for child in node["children"])
+
+    # A page whose parents are on an earlier page: those nodes become roots
+    page = flat[len(flat) // 2:]
+    nested_page = ReferralService.build_nested(page)
+    assert sorted(node["id"] for node in flatten(nested_page)) == sorted(node["id"] for node in page)
+    page_ids = {node["id"] for node in page}
+    assert all(node["referred_by_id"] not in page_ids for node in nested_page)
@@ -0,0 +1,25 @@
+from passlib.context import CryptContext
+
+import models
+from services import password_service
+
+
+def test_login_rehashes_a_password_made_with_other_rounds(client, db):
+    other_rounds = password_service.BCRYPT_ROUNDS + 1
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=other_rounds).hash("password123")
+    db.add(models.User(email="member@example.com", username="member", hashed_password=old_hash,
+                       role="user", is_active=True, permissions={}, referral_code="MEMBER"))
+    db.commit()
+
+    def login():
+        response = client.post("/api/auth/login", json={"email": "member@example.com", "password": "password123"})
+        assert response.status_code == 200
+        db.expire_all()
+        return db.query(models.User).filter_by(email="member@example.com").one().hashed_password
+
+    new_hash = login()
+    assert new_hash != old_hash
+    assert new_hash.startswith(f"$2b${password_service.BCRYPT_ROUNDS:02d}$")
+    assert password_service.verify_password("password123", new_hash)
+    # Already at the configured cost: left alone
+    assert login() == new_hash
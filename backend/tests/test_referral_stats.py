@@ -0,0 +1,80 @@
+import random
+
+import models
+from services.referral_service import ReferralService, MAX_LEVELS
+
+
+def assert_no_drift(db):
+    db.expire_all()
+    report = ReferralService.rebuild_all_stats(db, dry_run=True)
+    assert report["drifted"] == 0 and report["missing"] == 0, report["sample"]
+    return report
+
+
+def test_incremental_propagation_matches_rebuild(db, add_user):
+    rng = random.Random(11)
+    ids = [add_user()]
+    for i in range(150):
+        ids.append(add_user(rng.choice(ids), is_active=i % 5 != 0))
+    # Past MAX_LEVELS the deepest members drop out of the top ancestors' levels
+    tail = ids[-1]
+    for _ in range(MAX_LEVELS + 5):
+        tail = add_user(tail)
+
+    report = assert_no_drift(db)
+    assert report["users"] == len(ids) + MAX_LEVELS + 5
+    assert ReferralService.verify_stats(db, ids[0])["stored"]["total_team_size"] > 0
+
+
+def test_bulk_activation_matches_rebuild(db, add_user):
+    rng = random.Random(13)
+    ids = [add_user()]
+    for _ in range(80):
+        ids.append(add_user(rng.choice(ids)))
+
+    deactivated = ReferralService.set_active(db, rng.sample(ids, 30), False)
+    db.commit()
+    assert len(deactivated) == 30
+    assert_no_drift(db)
+    root = ReferralService.verify_stats(db, ids[0])["stored"]
+    assert root["active_team_size"] < root["total_team_size"]
+
+    # Users already active are left alone
+    reactivated = ReferralService.set_active(db, rng.sample(ids, 40), True)
+    db.commit()
+    assert set(reactivated) <= set(deactivated)
+    assert_no_drift(db)
+
+    assert ReferralService.set_active(db, deactivated, True) == sorted(set(deactivated) - set(reactivated))
+    db.commit()
+    assert_no_drift(db)
+    root = ReferralService.verify_stats(db, ids[0])["stored"]
+    assert root["active_team_size"] == root["total_team_size"]
+    assert root["active_level_breakdown"] == root["level_breakdown"]
+
+
+def test_dry_run_reports_drift_without_writing(db, add_user):
+    root = add_user()
+    child = add_user(root)
+    add_user(child)
+    add_user(root)
+
+    stat = db.query(models.ReferralStat).filter_by(user_id=root).one()
+    stat.total_team_size = 99
+    db.query(models.ReferralLevelStat).filter_by(user_id=child, level=1).delete()
+    db.commit()
+
+    report = ReferralService.rebuild_all_stats(db, dry_run=True)
+    assert report["drifted"] == 2 and report["written"] == 0
+    by_user = {row["user_id"]: row for row in report["sample"]}
+    assert by_user[root]["stored"]["total_team_size"] == 99
+    assert by_user[root]["expected"]["total_team_size"] == 3
+    assert by_user[child]["stored"]["level_breakdown"] == {}
+    assert by_user[child]["expected"]["level_breakdown"] == {"1": 1}
+
+    db.expire_all()
+    assert db.query(models.ReferralStat).filter_by(user_id=root).one().total_team_size == 99
+    assert ReferralService.get_level_counts(db, child) == {}
+
+    assert ReferralService.rebuild_all_stats(db)["written"] == 2
+    assert_no_drift(db)
@@ -1,3 +1,4 @@
+import hashlib
 import secrets
 import string
 
@@ -5,3 +6,34 @@ def generate_referral_code(length=8):
     """Generate a secure random alphanumeric referral code."""
     alphabet = string.ascii_uppercase + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
+
+# Alphabet for sequence-derived codes: Crockford base32, no I/L/O/U
+CODE_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+CODE_LENGTH = 8
+_HALF_BITS = CODE_LENGTH * 5 // 2  # 8 base32 chars = 40 bits = two 20-bit halves
+_HALF_MASK = (1 << _HALF_BITS) - 1
+
+def _feistel_round(value, round_index, key):
+    digest = hashlib.blake2b(
+        value.to_bytes(4, "big") + bytes([round_index]), key=key, digest_size=4
+    ).digest()
+    return int.from_bytes(digest, "big") & _HALF_MASK
+
+def encode_referral_code(sequence, key, rounds=4):
+    """
+    Map a sequence number to a referral code with a keyed Feistel permutation
+    over 40 bits. Distinct sequence numbers always give distinct codes, and
+    consecutive numbers give unrelated-looking codes.
+    """
+    if not 0 <= sequence < (1 << (2 * _HALF_BITS)):
+        raise ValueError("Referral code sequence out of range")
+    left, right = sequence >> _HALF_BITS, sequence & _HALF_MASK
+    for i in range(rounds):
+        left, right = right, left ^ _feistel_round(right, i, key)
+    value = (left << _HALF_BITS) | right
+
+    chars = []
+    for _ in range(CODE_LENGTH):
+        value, digit = divmod(value, 32)
+        chars.append(CODE_ALPHABET[digit])
+    return ''.join(reversed(chars))
@@ -5,19 +5,7 @@ import { motion, AnimatePresence } from 'framer-motion'
 import { User, ChevronDown, ChevronRight, Search, ZoomIn, ZoomOut, Layout, ListTree, Share2 } from 'lucide-react'
 import { Button } from '@/components/ui/button'
 import { Sidebar } from '@/components/layout/Sidebar'
-
-interface TreeNode {
-    id: number
-    username: string
-    email: string
-    role: string
-    is_active: boolean
-    level: number
-    referral_code: string
-    referred_by_id: number | null
-    children: TreeNode[]
-    total_team_size?: number
-}
+import { ChildNode as TreeNode, fetchChildren, useLazyChildren } from '@/components/referral/useLazyChildren'
 
 export default function NetworkPage() {
     const [treeData, setTreeData] = useState<TreeNode[]>([])
@@ -34,15 +22,7 @@ export default function NetworkPage() {
     const fetchTree = async () => {
         setLoading(true)
         try {
-            const token = localStorage.getItem('token')
-            const res = await fetch(`http://localhost:8000/api/referral/admin/tree?depth=20`, {
-                headers: { 'Authorization': `Bearer ${token}` }
-            })
-            if (res.ok) {
-                const flatList = await res.json()
-                const hierarchy = buildHierarchy(flatList)
-                setTreeData(hierarchy)
-            }
+            setTreeData(await fetchChildren())
         } catch (err) {
             console.error(err)
         } finally {
@@ -50,35 +30,6 @@ export default function NetworkPage() {
         }
     }
 
-    const buildHierarchy = (nodes: any[]): TreeNode[] => {
-        const map: { [key: number]: TreeNode } = {}
-        const roots: TreeNode[] = []
-
-        nodes.forEach(node => {
-            map[node.id] = { ...node, children: [] }
-        })
-
-        nodes.forEach(node => {
-            const mappedNode = map[node.id]
-            if (node.referred_by_id && map[node.referred_by_id]) {
-                map[node.referred_by_id].children.push(mappedNode)
-            } else {
-                roots.push(mappedNode)
-            }
-        })
-
-        const calcSize = (node: TreeNode): number => {
-            let size = 0
-            node.children.forEach(child => {
-                size += 1 + calcSize(child)
-            })
-            node.total_team_size = size
-            return size
-        }
-        roots.forEach(root => calcSize(root))
-        return roots
-    }
-
     return (
         <div className="min-h-screen bg-background text-foreground flex dark">
             <Sidebar collapsed={!isSidebarOpen} onToggle={() => setIsSidebarOpen(!isSidebarOpen)} />
@@ -147,11 +98,11 @@ export default function NetworkPage() {
                         ) : (
                             viewMode === 'chart' ? (
                                 <div className="flex gap-16">
-                                    {treeData.map(root => <ChartNode key={root.id} node={root} />)}
+                                    {treeData.map(root => <ChartNode key={root.id} node={root} initiallyExpanded />)}
                                 </div>
                             ) : (
                                 <div className="max-w-4xl mx-auto space-y-4">
-                                    {treeData.map(root => <ListNode key={root.id} node={root} level={0} />)}
+                                    {treeData.map(root => <ListNode key={root.id} node={root} level={0} initiallyExpanded />)}
                                 </div>
                             )
                         )}
@@ -163,9 +114,9 @@ export default function NetworkPage() {
 }
 
 // --- Horizontal Chart View ---
-const ChartNode = ({ node }: { node: TreeNode }) => {
-    const [expanded, setExpanded] = useState(true)
-    const hasChildren = node.children && node.children.length > 0
+const ChartNode = ({ node, initiallyExpanded = false }: { node: TreeNode, initiallyExpanded?: boolean }) => {
+    const { expanded, children, loadingChildren, toggle } = useLazyChildren(node, initiallyExpanded)
+    const hasChildren = node.has_children
 
     return (
         <div className="flex flex-col items-center">
@@ -174,7 +125,7 @@ const ChartNode = ({ node }: { node: TreeNode }) => {
                 relative z-10 w-64 bg-card border rounded-xl shadow-sm transition-all duration-200 group
                 ${node.is_active ? 'border-border hover:border-primary/50' : 'border-red-500/30 bg-red-500/5'}
             `}>
-                <div className="p-4 cursor-pointer" onClick={() => setExpanded(!expanded)}>
+                <div className="p-4 cursor-pointer" onClick={toggle}>
                     <div className="flex justify-between items-start mb-2">
                         <div className={`p-1.5 rounded-md ${node.is_active ? 'bg-primary/10 text-primary' : 'bg-red-500/10 text-red-500'}`}>
                             <User className="h-4 w-4" />
@@ -201,17 +152,19 @@ const ChartNode = ({ node }: { node: TreeNode }) => {
                 {/* Expander Button */}
                 {hasChildren && (
                     <button
-                        onClick={() => setExpanded(!expanded)}
+                        onClick={toggle}
                         className="absolute -bottom-3 left-1/2 -translate-x-1/2 h-6 w-6 bg-background border rounded-full flex items-center justify-center hover:bg-muted text-muted-foreground transition-colors z-20"
                     >
-                        {expanded ? <ChevronDown className="h-3 w-3" /> : <ChevronRight className="h-3 w-3" />}
+                        {loadingChildren
+                            ? <div className="h-3 w-3 animate-spin border border-primary border-t-transparent rounded-full" />
+                            : expanded ? <ChevronDown className="h-3 w-3" /> : <ChevronRight className="h-3 w-3" />}
                     </button>
                 )}
             </div>
 
             {/* Children & Lines */}
             <AnimatePresence>
-                {expanded && hasChildren && (
+                {expanded && children.length > 0 && (
                     <motion.div
                         initial={{ opacity: 0, height: 0 }}
                         animate={{ opacity: 1, height: 'auto' }}
@@ -236,11 +189,11 @@ const ChartNode = ({ node }: { node: TreeNode }) => {
                             {/* Simplified Connector: Flex Row with lines going up */}
                             <div className="flex gap-8 relative items-start pt-8">
                                 {/* The Magic Horizontal Bar */}
-                                {node.children.length > 1 && (
+                                {children.length > 1 && (
                                     <div className="absolute top-0 left-0 right-0 h-px bg-border/60 mx-[8rem]"></div> /* 8rem = half of w-64 */
                                 )}
 
-                                {node.children.map((child, index) => (
+                                {children.map((child, index) => (
                                     <div key={child.id} className="flex flex-col items-center relative">
                                         {/* Upward Line from Child to Horizontal Bar */}
                                         <div className="absolute top-[-2rem] h-8 w-px bg-border/60"></div>
@@ -257,9 +210,9 @@ const ChartNode = ({ node }: { node: TreeNode }) => {
 }
 
 // --- Vertical List View ---
-const ListNode = ({ node, level }: { node: TreeNode, level: number }) => {
-    const [expanded, setExpanded] = useState(true)
-    const hasChildren = node.children && node.children.length > 0
+const ListNode = ({ node, level, initiallyExpanded = false }: { node: TreeNode, level: number, initiallyExpanded?: boolean }) => {
+    const { expanded, children, loadingChildren, toggle } = useLazyChildren(node, initiallyExpanded)
+    const hasChildren = node.has_children
 
     return (
         <div>
@@ -270,7 +223,7 @@ const ListNode = ({ node, level }: { node: TreeNode, level: number }) => {
                 `}
                 style={{ marginLeft: `${level * 24}px` }}
             >
-                <div onClick={() => setExpanded(!expanded)} className="cursor-pointer text-muted-foreground hover:text-foreground">
+                <div onClick={toggle} className="cursor-pointer text-muted-foreground hover:text-foreground">
                     {hasChildren ? (
                         expanded ? <ChevronDown className="h-4 w-4" /> : <ChevronRight className="h-4 w-4" />
                     ) : <div className="w-4" />}
@@ -301,7 +254,7 @@ const ListNode = ({ node, level }: { node: TreeNode, level: number }) => {
             </div>
 
             <AnimatePresence>
-                {expanded && hasChildren && (
+                {expanded && children.length > 0 && (
                     <motion.div
                         initial={{ opacity: 0, height: 0 }}
                         animate={{ opacity: 1, height: 'auto' }}
@@ -311,7 +264,7 @@ const ListNode = ({ node, level }: { node: TreeNode, level: number }) => {
                         {/* Vertical Guide Line */}
                         <div className="relative">
                             <div className="absolute left-[calc(1rem+4px)] top-0 bottom-0 w-px bg-border/40" style={{ left: `${(level * 24) + 21}px` }}></div>
-                            {node.children.map(child => (
+                            {children.map(child => (
                                 <ListNode key={child.id} node={child} level={level + 1} />
                             ))}
                         </div>
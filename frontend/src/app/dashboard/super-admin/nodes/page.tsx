@@ -25,17 +25,12 @@ export default function NodesPage() {
                 {/* Content - Full Screen Graph */}
                 <div className="flex-1 p-4 overflow-hidden h-full flex flex-col">
                     <div className="flex-1 border rounded-xl bg-card overflow-hidden shadow-sm relative">
-                        {/* We use key to force re-render if needed, but endpoint is static here */}
-                        <ReferralChart
-                            key="full-chart"
-                            endpoint="/api/referral/admin/tree"
-                            maxDepth={20}
-                        // miniMap={false} // Implicit
-                        />
+                        {/* Lazy: one level of /api/referral/children per expanded node, never the whole tree */}
+                        <ReferralChart key="full-chart" lazy />
                         {/* Overlay Explainer */}
                         <div className="absolute top-4 left-4 bg-background/80 backdrop-blur border rounded-lg p-3 text-xs text-muted-foreground z-10 max-w-xs shadow-sm pointer-events-none">
                             <h4 className="font-semibold text-foreground mb-1">Hierarchy Map</h4>
-                            <p>This page visualizes the entire user database as a node tree. Use scroll to pan and pinch/buttons to zoom.</p>
+                            <p>This page visualizes the entire user database as a node tree. Expand a node to load its referrals. Use scroll to pan and pinch/buttons to zoom.</p>
                         </div>
                     </div>
                 </div>
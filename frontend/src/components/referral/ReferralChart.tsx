@@ -4,6 +4,7 @@ import React, { useState, useEffect } from 'react'
 import { motion, AnimatePresence } from 'framer-motion'
 import { User, ChevronDown, ChevronRight, Share2, ZoomIn, ZoomOut, Loader2 } from 'lucide-react'
 import { Button } from '@/components/ui/button'
+import { ChildNode, fetchChildren, useLazyChildren } from './useLazyChildren'
 
 export interface TreeNode {
     id: number
@@ -16,16 +17,19 @@ export interface TreeNode {
     referred_by_id: number | null
     children: TreeNode[]
     total_team_size?: number
+    has_children?: boolean
 }
 
 interface ReferralChartProps {
-    endpoint: string
+    endpoint?: string
     maxDepth?: number
+    // Load one level at a time from /api/referral/children instead of the whole tree from `endpoint`
+    lazy?: boolean
     viewType?: 'chart' | 'list'
     miniMap?: boolean
 }
 
-export default function ReferralChart({ endpoint, maxDepth = 20, viewType = 'chart', miniMap = false }: ReferralChartProps) {
+export default function ReferralChart({ endpoint = '/api/referral/admin/tree', maxDepth = 20, lazy = false, viewType = 'chart', miniMap = false }: ReferralChartProps) {
     const [treeData, setTreeData] = useState<TreeNode[]>([])
     const [loading, setLoading] = useState(true)
     const [zoomLevel, setZoomLevel] = useState(miniMap ? 0.8 : 1)
@@ -33,12 +37,17 @@ export default function ReferralChart({ endpoint, maxDepth = 20, viewType = 'cha
 
     useEffect(() => {
         fetchTree()
-    }, [endpoint])
+    }, [endpoint, lazy])
 
     const fetchTree = async () => {
         setLoading(true)
         setError('')
         try {
+            if (lazy) {
+                const roots = await fetchChildren()
+                setTreeData(roots.map(root => ({ ...root, children: [] })))
+                return
+            }
             const token = localStorage.getItem('token') || localStorage.getItem('access_token')
             const baseUrl = endpoint.startsWith('http') ? endpoint : `http://localhost:8000${endpoint}`
             const url = new URL(baseUrl)
@@ -117,7 +126,7 @@ export default function ReferralChart({ endpoint, maxDepth = 20, viewType = 'cha
                     style={{ transform: `scale(${zoomLevel})` }}
                 >
                     <div className="flex gap-24">
-                        {treeData.map(root => <ChartNode key={root.id} node={root} isRoot={true} />)}
+                        {treeData.map(root => <ChartNode key={root.id} node={root} isRoot={true} lazy={lazy} />)}
                     </div>
                 </div>
             </div>
@@ -125,9 +134,16 @@ export default function ReferralChart({ endpoint, maxDepth = 20, viewType = 'cha
     )
 }
 
-const ChartNode = ({ node, isRoot = false }: { node: TreeNode, isRoot?: boolean }) => {
-    const [expanded, setExpanded] = useState(true)
-    const hasChildren = node.children && node.children.length > 0
+const ChartNode = ({ node, isRoot = false, lazy = false }: { node: TreeNode, isRoot?: boolean, lazy?: boolean }) => {
+    const [expandedAll, setExpandedAll] = useState(true)
+    // Lazy charts open the roots and fetch everything below on demand
+    const lazyChildren = useLazyChildren(node as unknown as ChildNode, lazy && isRoot)
+    const expanded = lazy ? lazyChildren.expanded : expandedAll
+    const children: TreeNode[] = lazy
+        ? lazyChildren.children.map(child => ({ ...child, children: [] }))
+        : node.children
+    const hasChildren = lazy ? Boolean(node.has_children) : children && children.length > 0
+    const toggle = () => lazy ? lazyChildren.toggle() : setExpandedAll(!expandedAll)
 
     // Wire Color - Glowing Cyan/Primary
     const wireClass = "bg-primary/50 shadow-[0_0_10px_rgba(var(--primary),0.3)]"
@@ -164,20 +180,22 @@ const ChartNode = ({ node, isRoot = false }: { node: TreeNode, isRoot?: boolean
                 {/* Expander Toggle (Small bubble on circle edge) */}
                 {hasChildren && (
                     <button
-                        onClick={(e) => { e.stopPropagation(); setExpanded(!expanded); }}
+                        onClick={(e) => { e.stopPropagation(); toggle(); }}
                         className={`
                             absolute -bottom-2 w-6 h-6 rounded-full flex items-center justify-center border text-white transition-colors z-30 cursor-pointer shadow-md
                             ${expanded ? 'bg-zinc-800 border-zinc-600 hover:bg-zinc-700' : 'bg-primary border-primary hover:bg-primary/90'}
                         `}
                     >
-                        {expanded ? <ChevronDown className="h-3 w-3" /> : <Share2 className="h-3 w-3" />}
+                        {lazyChildren.loadingChildren
+                            ? <Loader2 className="h-3 w-3 animate-spin" />
+                            : expanded ? <ChevronDown className="h-3 w-3" /> : <Share2 className="h-3 w-3" />}
                     </button>
                 )}
             </div>
 
             {/* Children & Wires */}
             <AnimatePresence>
-                {expanded && hasChildren && (
+                {expanded && children.length > 0 && (
                     <motion.div
                         initial={{ opacity: 0, height: 0 }}
                         animate={{ opacity: 1, height: 'auto' }}
@@ -190,7 +208,7 @@ const ChartNode = ({ node, isRoot = false }: { node: TreeNode, isRoot?: boolean
                         {/* 2. Horizontal Bus & Children */}
                         <div className="flex relative pt-8">
                             {/* The Horizontal Bus Line */}
-                            {node.children.length > 1 && (
+                            {children.length > 1 && (
                                 <div
                                     className={`absolute top-0 h-0.5 ${wireClass}`}
                                     style={{
@@ -214,10 +232,10 @@ const ChartNode = ({ node, isRoot = false }: { node: TreeNode, isRoot?: boolean
                                 </div>
                             )}
 
-                            {node.children.map((child, index) => {
+                            {children.map((child, index) => {
                                 const isFirst = index === 0;
-                                const isLast = index === node.children.length - 1;
-                                const isOnly = node.children.length === 1;
+                                const isLast = index === children.length - 1;
+                                const isOnly = children.length === 1;
 
                                 return (
                                     <div key={child.id} className="flex flex-col items-center relative px-4">
@@ -239,7 +257,7 @@ const ChartNode = ({ node, isRoot = false }: { node: TreeNode, isRoot?: boolean
                                         {/* Vertical Line Up from Child to Horizontal Line */}
                                         <div className={`absolute top-[-2rem] left-1/2 -ml-[1px] w-0.5 h-8 ${wireClass}`}></div>
 
-                                        <ChartNode node={child} />
+                                        <ChartNode node={child} lazy={lazy} />
                                     </div>
                                 )
                             })}
@@ -0,0 +1,56 @@
+'use client'
+
+import { useState, useEffect } from 'react'
+
+export interface ChildNode {
+    id: number
+    username: string
+    email: string
+    role: string
+    is_active: boolean
+    level: number
+    referral_code: string
+    referred_by_id: number | null
+    total_team_size: number
+    total_directs: number
+    has_children: boolean
+}
+
+// Children are fetched one level at a time, only when a node is expanded
+export const fetchChildren = async (parent?: ChildNode): Promise<ChildNode[]> => {
+    const token = localStorage.getItem('token')
+    const query = parent ? `?parent_id=${parent.id}` : ''
+    const res = await fetch(`http://localhost:8000/api/referral/children${query}`, {
+        headers: { 'Authorization': `Bearer ${token}` }
+    })
+    if (!res.ok) return []
+    const children = await res.json()
+    return children.map((child: ChildNode) => ({ ...child, level: parent ? parent.level + 1 : 1 }))
+}
+
+export const useLazyChildren = (node: ChildNode, initiallyExpanded: boolean) => {
+    const [expanded, setExpanded] = useState(false)
+    const [children, setChildren] = useState<ChildNode[] | null>(null)
+    const [loadingChildren, setLoadingChildren] = useState(false)
+
+    const toggle = async () => {
+        if (!expanded && children === null && node.has_children) {
+            setLoadingChildren(true)
+            try {
+                setChildren(await fetchChildren(node))
+            } catch (err) {
+                console.error(err)
+            } finally {
+                setLoadingChildren(false)
+            }
+        }
+        setExpanded(!expanded)
+    }
+
+    useEffect(() => {
+        if (initiallyExpanded) toggle()
+        // eslint-disable-next-line react-hooks/exhaustive-deps
+    }, [])
+
+    return { expanded, children: children || [], loadingChildren, toggle }
+}